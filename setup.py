@@ -36,6 +36,7 @@ setup(
         'test': ['pytest', 'pytest-qt'],
         'ez': ['PyYAML', 'pyqtgraph', 'matplotlib'],
         'edf': ['fabio'],
+        'hdf5': ['h5py'],
     },
     description="A fast, versatile and user-friendly image "\
                 "processing toolkit for computed tomography",
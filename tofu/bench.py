@@ -0,0 +1,177 @@
+"""Benchmark of the general reconstruction on dummy data."""
+import copy
+import itertools
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+from tofu import __version__
+
+
+LOG = logging.getLogger(__name__)
+BENCH_VERSION = 2
+GEOMETRIES = ('parallel', 'cone', 'lamino')
+SWITCHES = ('off', 'on')
+SCHEDULINGS = ('static', 'dynamic')
+
+
+def make_cases(args):
+    """Get all combinations of the swept parameters from *args* as a list of dictionaries."""
+    for geometry in args.bench_geometries:
+        if geometry not in GEOMETRIES:
+            raise ValueError("Unknown geometry `{}', must be one of {}".format(geometry,
+                                                                               GEOMETRIES))
+    for switch in args.bench_phase_retrieval:
+        if switch not in SWITCHES:
+            raise ValueError("--bench-phase-retrieval must contain only {}".format(SWITCHES))
+    for scheduling in args.bench_region_scheduling:
+        if scheduling not in SCHEDULINGS:
+            raise ValueError("--bench-region-scheduling must contain only {}".format(SCHEDULINGS))
+    keys = ('size', 'number', 'geometry', 'phase_retrieval', 'store_type', 'region_scheduling')
+    values = (args.bench_sizes, args.bench_numbers, args.bench_geometries,
+              args.bench_phase_retrieval, args.bench_store_types, args.bench_region_scheduling)
+
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def get_case_name(case):
+    return ('size={size} number={number} geometry={geometry} phase-retrieval={phase_retrieval} '
+            'store-type={store_type} region-scheduling={region_scheduling}'.format(**case))
+
+
+def make_case_args(args, case, perf_report):
+    """Make genreco arguments from *args* for benchmark *case* which write the performance
+    report to *perf_report*.
+    """
+    case_args = copy.deepcopy(args)
+    size = case['size']
+    case_args.dry_run = True
+    case_args.projections = None
+    case_args.darks = None
+    case_args.flats = None
+    case_args.flats2 = None
+    case_args.resume = False
+    case_args.perf_report = perf_report
+    case_args.width = size
+    case_args.height = size
+    case_args.number = case['number']
+    case_args.store_type = case['store_type']
+    case_args.region_scheduling = case['region_scheduling']
+    case_args.center_position_x = [size / 2.]
+    case_args.center_position_z = [size / 2.]
+    case_args.z_parameter = 'z'
+    case_args.region = [-args.bench_slices / 2., args.bench_slices / 2., 1.]
+    case_args.overall_angle = 180. if case['geometry'] == 'parallel' else 360.
+    if case['geometry'] == 'cone':
+        case_args.source_position_y = [-10. * size]
+    elif case['geometry'] == 'lamino':
+        case_args.axis_angle_x = [args.bench_lamino_angle]
+    if case['phase_retrieval'] == 'on':
+        case_args.energy = 20.
+        case_args.propagation_distance = [0.1]
+        case_args.pixel_size = 1e-6
+
+    return case_args
+
+
+def summarize(case, report):
+    """Make the benchmark result of *case* from its genreco performance *report*."""
+    executors = report['executors']
+    result = dict(case)
+    result.update({
+        'name': get_case_name(case),
+        'gups': report['total_gups'],
+        'ufo_gups': report['ufo_gups'],
+        'total_time': report['total_time'],
+        'ufo_time': report['ufo_time'],
+        'stages': {
+            'setup': sum(stats['setup_time'] for stats in executors),
+            'process': sum(stats['wall_time'] for stats in executors),
+            'output_wait': sum(stats['output_wait_time'] for stats in executors),
+            'write': sum(stats['write_time'] for stats in executors),
+        },
+    })
+    if 'trace' in report:
+        result['trace'] = report['trace']
+
+    return result
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compare benchmark *results* to the ones from *baseline* with the same name. Return a list
+    of (name, GUPS, baseline GUPS) of the results which are slower than *threshold* (fraction)
+    compared to the baseline.
+    """
+    baseline_gups = {result['name']: result['gups'] for result in baseline['results']}
+    regressions = []
+
+    for result in results:
+        if result['name'] not in baseline_gups:
+            LOG.info("No baseline for `%s'", result['name'])
+            continue
+        reference = baseline_gups[result['name']]
+        if result['gups'] < reference * (1 - threshold):
+            regressions.append((result['name'], result['gups'], reference))
+
+    return regressions
+
+
+def run(args):
+    """Run all benchmark cases given by *args*, store the results and compare them to the
+    baseline. Raise RuntimeError if there are regressions.
+    """
+    from tofu.genreco import genreco
+
+    cases = make_cases(args)
+    results = []
+    tmpdir = tempfile.mkdtemp(prefix='tofu-bench-')
+    filename = os.path.join(tmpdir, 'report.json')
+
+    try:
+        for i, case in enumerate(cases):
+            LOG.info('Benchmark %d/%d: %s', i + 1, len(cases), get_case_name(case))
+            reports = []
+            for j in range(args.bench_repeats):
+                genreco(make_case_args(args, case, filename))
+                with open(filename) as f:
+                    reports.append(json.load(f))
+            # Take the best run, the other ones were disturbed by something else
+            result = summarize(case, max(reports, key=lambda report: report['total_gups']))
+            results.append(result)
+            sys.stdout.write('{:<80} {:>8.2f} GUPS  total={:.3f}s  ufo={:.3f}s\n'.format(
+                result['name'], result['gups'], result['total_time'], result['ufo_time']))
+            sys.stdout.flush()
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rmdir(tmpdir)
+
+    bench = {
+        'version': BENCH_VERSION,
+        'tofu_version': __version__,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': platform.node(),
+        'results': results,
+    }
+    if args.bench_output:
+        with open(args.bench_output, 'w') as f:
+            json.dump(bench, f, indent=4)
+        LOG.info("Benchmark results written to `%s'", args.bench_output)
+
+    if args.bench_baseline:
+        with open(args.bench_baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, threshold=args.bench_threshold)
+        for name, gups, reference in regressions:
+            sys.stdout.write('Regression: {}: {:.2f} GUPS, baseline {:.2f} GUPS ({:+.1f} %)\n'
+                             .format(name, gups, reference, (gups / reference - 1) * 100))
+        if regressions:
+            raise RuntimeError('{} of {} benchmarks are more than {:g} % slower than the '
+                               'baseline'.format(len(regressions), len(results),
+                                                 args.bench_threshold * 100))
+        LOG.info('No regressions compared to baseline from %s', baseline.get('date'))
+
+    return bench
@@ -126,12 +126,12 @@ SECTIONS['flat-correction'] = {
     'projections': {
         'default': None,
         'type': str,
-        'help': "Location with projections",
+        'help': "Location with projections or HDF5 dataset as file.h5:/path/to/dataset",
         'metavar': 'PATH'},
     'darks': {
         'default': None,
         'type': str,
-        'help': "Location with darks",
+        'help': "Location with darks or HDF5 dataset",
         'metavar': 'PATH'},
     'dark-scale': {
         'default': 1,
@@ -148,12 +148,12 @@ SECTIONS['flat-correction'] = {
     'flats': {
         'default': None,
         'type': str,
-        'help': "Location with flats",
+        'help': "Location with flats or HDF5 dataset",
         'metavar': 'PATH'},
     'flats2': {
         'default': None,
         'type': str,
-        'help': "Location with flats 2 for interpolation correction",
+        'help': "Location with flats 2 or HDF5 dataset for interpolation correction",
         'metavar': 'PATH'},
     'flat-scale': {
         'default': 1,
@@ -162,7 +162,19 @@ SECTIONS['flat-correction'] = {
     'absorptivity': {
         'default': False,
         'action': 'store_true',
-        'help': 'Do absorption correction'}}
+        'help': 'Do absorption correction'},
+    'disable-flat-cache': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Reduce darks and flats in every pipeline instead of taking them from the cache "
+                "of reduced darks and flats (tif, EDF and HDF5 input only, other formats are "
+                "always reduced in the pipeline)"},
+    'flat-cache-directory': {
+        'default': None,
+        'type': str,
+        'help': "Directory of the cache of reduced darks and flats (default: "
+                "$XDG_CACHE_HOME/tofu/reduced or ~/.cache/tofu/reduced)",
+        'metavar': 'PATH'}}
 
 SECTIONS['distortion-correction'] = {
     'x-field': {
@@ -268,7 +280,19 @@ SECTIONS['sinos'] = {
     'pass-size': {
         'type': restrict_value((0, None), dtype=int),
         'default': 0,
-        'help': 'Number of sinograms to process per pass'}}
+        'help': 'Number of sinograms to process per pass'},
+    'sinos-cache': {
+        'default': 'none',
+        'type': str,
+        'help': "With more passes, read the projections only once into a buffer of sinograms in "
+                "host memory (ram, on disk if they do not fit) or on disk (disk), none (default) "
+                "reads them in every pass",
+        'choices': ['none', 'ram', 'disk']},
+    'sinos-cache-directory': {
+        'default': None,
+        'type': str,
+        'help': "Directory of the temporary file of --sinos-cache disk (default: system "
+                "temporary directory)"}}
 
 SECTIONS['reconstruction'] = {
     'sinograms': {
@@ -477,7 +501,22 @@ SECTIONS['estimate'] = {
         'type': str,
         'default': 'correlation',
         'help': 'Rotation axis estimation algorithm',
-        'choices': ['reconstruction', 'correlation']}}
+        'choices': ['reconstruction', 'correlation']},
+    'estimate-num-pairs': {
+        'default': 4,
+        'type': restrict_value((1, None), dtype=int),
+        'help': "Maximum number of projection pairs 180 degrees apart used by the correlation "
+                "estimation method"},
+    'estimate-num-candidates': {
+        'default': 16,
+        'type': restrict_value((3, None), dtype=int),
+        'help': "Number of centers reconstructed at once in every iteration of the "
+                "reconstruction estimation method"},
+    'estimate-precision': {
+        'default': 0.01,
+        'type': restrict_value((0, None)),
+        'help': "Stop the reconstruction estimation method when the candidate centers are closer "
+                "than this (pixels)"}}
 
 SECTIONS['perf'] = {
     'num-runs': {
@@ -576,6 +615,21 @@ SECTIONS['general-reconstruction'] = {
                 "The total amount of consumed memory will be larger depending on the "
                 "complexity of the graph. In case of OpenCL memory allocation errors, "
                 "try reducing this value."},
+    'device-memory-model': {
+        'default': 'slices',
+        'type': str,
+        'help': "How to determine the number of slices per device if --slices-per-device is not "
+                "given. 'slices': slices take --slice-memory-coeff of the GPU memory, 'graph': "
+                "estimate the memory of the whole graph (projection buffers, padding, burst) "
+                "which takes --slice-memory-coeff of the GPU memory, calibrated by the stored "
+                "device profile if there is one, 'probe': like 'graph' but calibrate the "
+                "estimate by short dry runs first and store it in the device profile",
+        'choices': ['slices', 'graph', 'probe']},
+    'device-profiles': {
+        'default': None,
+        'type': str,
+        'help': "JSON file with device memory calibrations (default: "
+                "$XDG_CACHE_HOME/tofu/device-profiles.json)"},
     'num-gpu-threads': {
         'default': 1,
         'ezdefault': None,
@@ -596,6 +650,13 @@ SECTIONS['general-reconstruction'] = {
         'help': "'one': one GPU should process as many slices as possible, "
                 "'many': slices should be spread across as many GPUs as possible",
         'choices': ['one', 'many']},
+    'region-scheduling': {
+        'default': 'static',
+        'type': str,
+        'help': "'static': process the passes given by --data-splitting-policy, 'dynamic': every "
+                "GPU thread takes the next slices from a shared queue as soon as it is done with "
+                "the previous ones, which is faster with GPUs of different speed",
+        'choices': ['static', 'dynamic']},
     'projection-margin': {
         'default': 0,
         'type': restrict_value((0, None), dtype=int),
@@ -736,7 +797,74 @@ SECTIONS['general-reconstruction'] = {
     'slice-gray-map': {
         'default': "0,0",
         'type': tupleize(num_items=2, conv=float),
-        'help': "Minimum and maximum gray value mapping if store-type is integer-based"}
+        'help': "Minimum and maximum gray value mapping if store-type is integer-based"},
+    'projection-cache': {
+        'default': 'none',
+        'type': str,
+        'help': "Preprocess the projections only once and use them in all passes from host "
+                "memory ('ram') or from a memory-mapped temporary file ('disk'), falls back "
+                "from 'ram' to 'disk' and from 'disk' to no cache if the projections do not fit",
+        'choices': ['none', 'ram', 'disk']},
+    'projection-cache-directory': {
+        'default': None,
+        'type': str,
+        'help': "Directory of the temporary file of --projection-cache disk (default: system "
+                "temporary directory)"},
+    'shared-reader': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Read and preprocess the projection rows needed by all regions of a pass only "
+                "once and share them among the GPUs (static region scheduling only)"},
+    'resume': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Record finished parts of the volume in a journal and skip the ones recorded "
+                "by a previous run with the same parameters (not supported for single-file TIFF "
+                "output)"},
+    'journal': {
+        'default': None,
+        'type': str,
+        'help': "Journal of finished parts of the volume, written only with --resume or this "
+                "option (default with --resume: output + .journal.json)",
+        'metavar': 'PATH'},
+    'workers': {
+        'default': None,
+        'type': str,
+        'nargs': '+',
+        'help': "Split the region between worker processes given as host or host:gpu,gpu,... "
+                "(localhost runs locally, other hosts via ssh with a shared file system), e.g. "
+                "localhost:0 localhost:1 node2"},
+    'worker-command': {
+        'default': 'tofu',
+        'type': str,
+        'help': "Command which runs tofu on the worker hosts"},
+    'perf-report': {
+        'default': None,
+        'type': str,
+        'help': "Write a JSON report with the duration, read and written data and performance "
+                "of every pass and region (and per-task totals from the UFO trace if "
+                "--enable-tracing is on) to this file"},
+    'output-buffer-depth': {
+        'default': None,
+        'type': restrict_value((1, None), dtype=int),
+        'help': "Maximum number of slices buffered in host memory for writing single-file "
+                "output in order while the GPUs hand over their slices in any order (default: "
+                "slices of one pass), limited to half of the available host memory"},
+    'output-mmap': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Preallocate single-file TIFF output and let all GPUs write their slices "
+                "directly to it via memory mapping instead of writing them in order"},
+    'output-chunks': {
+        'default': None,
+        'type': tupleize(num_items=3, conv=int),
+        'help': "Chunk shape of HDF5 output (--output ending with .h5 or .hdf5) as "
+                "slices,height,width (automatic if not specified)"},
+    'output-compression': {
+        'default': 'none',
+        'type': str,
+        'help': "Compression of HDF5 output",
+        'choices': ['none', 'gzip', 'lzf']}
     }
 
 SECTIONS['find-large-spots'] = {
@@ -803,6 +931,13 @@ SECTIONS['find-large-spots'] = {
         'help': "How to average input images (first = take a single image, "
                 "only available with --method median)",
         'choices': ['first', 'mean', 'median']},
+    'averaging-bytes': {
+        'default': '1g',
+        'type': convert_filesize,
+        'help': "Maximum memory used for median averaging of input images, the images are "
+                "processed in blocks of rows fitting into this memory, 'k', 'm', 'g', 't' "
+                "suffixes can be used",
+        'metavar': 'BYTES'},
     'spot-threshold': {
         'default': 0.0,
         'ezdefault': 2000.0,
@@ -878,6 +1013,76 @@ SECTIONS['ez'] = {
         'metavar': 'PATH'},
 }
 
+SECTIONS['index'] = {
+    'directories': {
+        'default': None,
+        'type': str,
+        'nargs': '+',
+        'help': "Directories with tif files for which a manifest is written",
+        'metavar': 'PATH'},
+    'recursive': {
+        'default': False,
+        'action': 'store_true',
+        'help': "Write manifests also for all subdirectories with tif files"},
+}
+
+SECTIONS['bench'] = {
+    'bench-sizes': {
+        'default': "256,512",
+        'type': tupleize(conv=int),
+        'unit': "pixel",
+        'help': "Projection widths and heights, which are also the slice widths and heights"},
+    'bench-numbers': {
+        'default': "256",
+        'type': tupleize(conv=int),
+        'help': "Numbers of projections"},
+    'bench-slices': {
+        'default': 16,
+        'type': restrict_value((1, None), dtype=int),
+        'help': "Number of reconstructed slices"},
+    'bench-geometries': {
+        'default': "parallel,cone,lamino",
+        'type': tupleize(conv=str),
+        'help': "Geometries from parallel, cone and lamino (parallel beam laminography)"},
+    'bench-lamino-angle': {
+        'default': 30.,
+        'type': float,
+        'unit': "deg",
+        'help': "Axis tilt of the lamino geometry"},
+    'bench-phase-retrieval': {
+        'default': "off",
+        'type': tupleize(conv=str),
+        'help': "Phase retrieval off, on or both (off,on)"},
+    'bench-store-types': {
+        'default': "float",
+        'type': tupleize(conv=str),
+        'help': "Data types of the output volume"},
+    'bench-region-scheduling': {
+        'default': "static",
+        'type': tupleize(conv=str),
+        'help': "Region scheduling static, dynamic or both (static,dynamic), see "
+                "--region-scheduling"},
+    'bench-repeats': {
+        'default': 3,
+        'type': restrict_value((1, None), dtype=int),
+        'help': "Number of runs of every benchmark, the fastest one is reported"},
+    'bench-output': {
+        'default': None,
+        'type': str,
+        'help': "JSON file for the results, which can be used as a baseline later",
+        'metavar': 'PATH'},
+    'bench-baseline': {
+        'default': None,
+        'type': str,
+        'help': "JSON file with baseline results to compare to",
+        'metavar': 'PATH'},
+    'bench-threshold': {
+        'default': 0.1,
+        'type': restrict_value((0, 1)),
+        'help': "Benchmarks slower than the baseline by more than this fraction are "
+                "regressions, which make the command fail"},
+}
+
 TOMO_PARAMS = ('flat-correction', 'reconstruction', 'tomographic-reconstruction', 'fbp', 'dfi', 'ir', 'sart', 'sbtv')
 
 PREPROC_PARAMS = ('preprocess', 'cone-beam-weight', 'flat-correction', 'retrieve-phase', 'distortion-correction')
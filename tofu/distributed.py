@@ -0,0 +1,243 @@
+"""Distributed general reconstruction. A coordinator splits the reconstructed region between worker
+processes (``tofu reco`` on this or other hosts), which write their parts to a shared directory, and
+assembles the parts to the output requested by the user.
+"""
+import copy
+import glob
+import logging
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from tofu import config
+from tofu.util import get_reconstruction_regions
+
+
+LOG = logging.getLogger(__name__)
+LOCAL_HOSTS = ('localhost', '127.0.0.1')
+# Options which the coordinator sets for every worker or which do not apply to workers
+WORKER_IGNORED_OPTIONS = ('config', 'log', 'output', 'region', 'gpus', 'workers',
+                          'worker-command', 'perf-report', 'journal', 'resume')
+# Region file name written by genreco, e.g. output-003-0012.tif
+REGION_FILE_PATTERN = re.compile(r'-(\d+)-(\d+)(\.\w+)$')
+
+
+def parse_worker(spec):
+    """Parse worker *spec* given as host or host:gpu,gpu,... to a tuple (host, list of GPU indices
+    or None).
+    """
+    if ':' not in spec:
+        return (spec, None)
+    host, gpus = spec.split(':', 1)
+
+    return (host, [int(gpu) for gpu in gpus.split(',') if gpu])
+
+
+def split_region(region, num_parts):
+    """Split *region* (from, to, step) to at most *num_parts* contiguous regions with the same
+    number of values (the last one may have less).
+    """
+    start, stop, step = region
+    num_values = len(np.arange(start, stop, step))
+    per_part = (num_values - 1) // num_parts + 1
+    parts = []
+    for first in range(0, num_values, per_part):
+        last = min(first + per_part, num_values)
+        # Stop half a step behind the last value, so that rounding cannot add one more value
+        parts.append([start + first * step, start + (last - 0.5) * step, step])
+
+    return parts
+
+
+def make_arguments(args, sections=config.GEN_RECO_PARAMS + ('general', 'reading')):
+    """Convert *args* from *sections* back to command line arguments, except for
+    :data:`WORKER_IGNORED_OPTIONS`.
+    """
+    arguments = []
+    for section in sections:
+        for name, opts in sorted(config.SECTIONS[section].items()):
+            if name in WORKER_IGNORED_OPTIONS or not hasattr(args, name.replace('-', '_')):
+                continue
+            value = getattr(args, name.replace('-', '_'))
+            if value is None:
+                continue
+            if opts.get('action') == 'store_true':
+                if value:
+                    arguments.append('--{}'.format(name))
+                continue
+            if isinstance(value, (list, tuple)):
+                if not value:
+                    continue
+                if opts.get('nargs') == '+':
+                    arguments += ['--{}'.format(name)] + [str(item) for item in value]
+                    continue
+                value = ','.join(str(item) for item in value)
+            arguments.append('--{}={}'.format(name, value))
+
+    return arguments
+
+
+def get_part_output(args, part_dir, index):
+    """Get the output of worker *index* in *part_dir*, which has the same kind as args.output."""
+    from tofu.genreco import is_output_hdf5, is_output_single_file
+
+    name = os.path.join(part_dir, 'worker-{:03}'.format(index))
+    if is_output_hdf5(args):
+        return name + '.h5'
+    if is_output_single_file(args):
+        return name + '.tif'
+
+    return os.path.join(name, 'slice')
+
+
+def make_worker_command(args, host, gpus, region, output):
+    """Make the command which runs a worker on *host* with *gpus* for *region* writing to
+    *output*.
+    """
+    command = shlex.split(args.worker_command) + ['reco'] + make_arguments(args)
+    command.append('--region={}'.format(','.join(str(value) for value in region)))
+    command.append('--output={}'.format(output))
+    if gpus:
+        command += ['--gpus'] + [str(gpu) for gpu in gpus]
+    if host not in LOCAL_HOSTS:
+        command = ['ssh', host, ' '.join(shlex.quote(item) for item in command)]
+
+    return command
+
+
+def run(args):
+    """Split the region given by *args* between args.workers, run them and assemble their outputs
+    to args.output.
+    """
+    from tofu.genreco import is_output_hdf5, is_output_single_file
+
+    region = get_reconstruction_regions(copy.deepcopy(args), dtype=float)[2]
+    workers = [parse_worker(spec) for spec in args.workers]
+    regions = split_region(region, len(workers))
+    part_dir = os.path.join(os.path.dirname(os.path.abspath(args.output)),
+                            '.tofu-workers-{}'.format(os.getpid()))
+    os.makedirs(part_dir)
+    outputs = [get_part_output(args, part_dir, i) for i in range(len(regions))]
+
+    processes = []
+    try:
+        for i, ((host, gpus), region) in enumerate(zip(workers, regions)):
+            command = make_worker_command(args, host, gpus, region, outputs[i])
+            LOG.info('Worker %d on %s: region %s', i, host, region)
+            LOG.debug('Worker %d command: %s', i,
+                      ' '.join(shlex.quote(item) for item in command))
+            processes.append(subprocess.Popen(command))
+        failed = [i for (i, process) in enumerate(processes) if process.wait()]
+    except KeyboardInterrupt:
+        LOG.info('Processing interrupted, terminating workers')
+        for process in processes:
+            process.terminate()
+        raise
+    if failed:
+        raise RuntimeError('Workers {} failed, their outputs are kept in `{}\''.format(
+            ', '.join(str(i) for i in failed), part_dir))
+
+    if not args.dry_run:
+        if is_output_hdf5(args):
+            merge_hdf5(outputs, args.output, chunks=args.output_chunks,
+                       compression=args.output_compression)
+        elif is_output_single_file(args):
+            merge_tiff(outputs, args.output)
+        else:
+            merge_region_files(outputs, args.output)
+    shutil.rmtree(part_dir)
+
+
+def merge_region_files(outputs, output):
+    """Rename region files written by workers with *outputs* prefixes in their order to *output*
+    prefixed files with consecutive region indices.
+    """
+    dirname = os.path.dirname(output)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    index = 0
+    for prefix in outputs:
+        files = {}
+        for filename in glob.glob(glob.escape(prefix) + '-*'):
+            match = REGION_FILE_PATTERN.search(filename)
+            if match:
+                files.setdefault(int(match.group(1)), []).append(match)
+        for region_index in sorted(files):
+            for match in files[region_index]:
+                os.rename(match.string,
+                          '{}-{:>03}-{}{}'.format(output, index, match.group(2), match.group(3)))
+            index += 1
+    LOG.debug('Merged %d regions to %s', index, output)
+
+
+def merge_tiff(outputs, output, num_threads=None):
+    """Copy pages of all tif files *outputs* in their order to *output*, which is preallocated
+    and memory-mapped (see :class:`tofu.genreco.MappedTiffWriter`), so that the parts are copied
+    to their positions concurrently by *num_threads* (one per part if None).
+    """
+    import tifffile
+    from tofu.genreco import MappedTiffWriter
+
+    offsets = [0]
+    for filename in outputs:
+        with tifffile.TiffFile(filename) as tif:
+            if len(offsets) == 1:
+                shape = tif.pages[0].shape
+                dtype = tif.pages[0].dtype
+            offsets.append(offsets[-1] + len(tif.pages))
+    shape = (offsets[-1],) + tuple(shape)
+    bigtiff = np.prod(shape) * np.dtype(dtype).itemsize > 2 ** 32 - 2 ** 25
+    dirname = os.path.dirname(output)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    writer = MappedTiffWriter(output, shape, dtype, bigtiff=bigtiff)
+
+    def copy_part(index):
+        with tifffile.TiffFile(outputs[index]) as tif:
+            for i, page in enumerate(tif.pages):
+                writer.save(page.asarray(), offsets[index] + i)
+
+    try:
+        with ThreadPool(processes=num_threads or len(outputs)) as pool:
+            pool.map(copy_part, range(len(outputs)))
+    finally:
+        writer.close()
+    LOG.debug('Merged %d slices to %s', shape[0], output)
+
+
+def merge_hdf5(outputs, output, chunks=None, compression=None, block_nbytes=2 ** 27):
+    """Copy the volumes from HDF5 files *outputs* in their order to one volume in *output*. The
+    parts are read in blocks of whole chunk layers of about *block_nbytes*, so that every chunk is
+    decompressed only once.
+    """
+    import h5py
+    from tofu.genreco import HDF5_DATASET, HDF5VolumeWriter
+
+    parts = [h5py.File(filename, 'r') for filename in outputs]
+    try:
+        datasets = [part[HDF5_DATASET] for part in parts]
+        num_slices = sum(dataset.shape[0] for dataset in datasets)
+        attrs = dict(datasets[0].attrs)
+        start, stop, step = attrs['z_region']
+        attrs['z_region'] = np.array([start, start + num_slices * step, step])
+        writer = HDF5VolumeWriter(output, (num_slices,) + datasets[0].shape[1:],
+                                  datasets[0].dtype, chunks=chunks, compression=compression,
+                                  attrs=attrs)
+        try:
+            index = 0
+            for dataset in datasets:
+                depth = dataset.chunks[0] if dataset.chunks else 1
+                slice_nbytes = np.prod(dataset.shape[1:]) * dataset.dtype.itemsize
+                block_size = max(1, int(block_nbytes // (depth * slice_nbytes))) * depth
+                for first in range(0, dataset.shape[0], block_size):
+                    for image in dataset[first:first + block_size]:
+                        writer.save(image, index)
+                        index += 1
+        finally:
+            writer.close()
+    finally:
+        for part in parts:
+            part.close()
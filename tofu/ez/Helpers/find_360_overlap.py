@@ -13,7 +13,7 @@ import tifffile
 
 from tofu.ez.params import EZVARS, EZVARS_aux
 from tofu.ez.Helpers.stitch_funcs import findCTdirs, stitch
-from tofu.util import get_filenames, get_image_shape, TiffSequenceReader
+from tofu.util import get_filenames, get_image_shape, TiffSequenceReader, read_ahead
 from tofu.ez.ufo_cmd_gen import get_filter2d_sinos_cmd
 #from tofu.ez.find_axis_cmd_gen import evaluate_images_simp
 from tofu.ez.evaluate_sharpness import evaluate_metrics_360_olap_search
@@ -23,24 +23,24 @@ from tofu.ez.ufo_cmd_gen import get_pre_cmd
 from tofu.ez.tofu_cmd_gen import fmt_pr_cmd
 
 def extract_row(dir_name, row):
-    tsr = TiffSequenceReader(dir_name)
+    tsr = TiffSequenceReader(dir_name, memmap=True)
     tmp = tsr.read(0)
     (N, M) = tmp.shape
     if (row < 0) or (row > N):
         row = N//2
     num_images = tsr.num_images
+    num_read = num_images
     if num_images == 1:
         print(f"Single image in {dir_name}, duplicating.")
         num_images = 2
-        tsr._filenames = 2 * tsr._filenames
-        assert num_images == tsr.num_images
     if num_images % 2 == 1:
         # print(f"odd number of images ({num_images}) in {dir_name}, "
         #       f"discarding the last one before stitching pairs")
         num_images-=1
     A = np.empty((num_images, M), dtype=np.uint16)
-    for i in range(num_images):
-        A[i, :] = tsr.read(i)[row, :]
+    indices = [i % num_read for i in range(num_images)]
+    for i, image in enumerate(read_ahead(tsr, indices=indices, rows=(row, row + 1))):
+        A[i, :] = image[0]
     tsr.close()
     return A
 
@@ -7,7 +7,7 @@ import tifffile
 from mpi4py import MPI
 
 from tofu.ez.Helpers.stitch_funcs import stitch
-from tofu.util import TiffSequenceReader
+from tofu.util import TiffSequenceReader, read_ahead
 
 path_to_script, ax, crop, bigtif_name, out_fmt = sys.argv
 
@@ -17,16 +17,18 @@ size = comm.Get_size()
 # t0 = time.time()
 #print(f"{t0:.2f}: Private {rank} of {size} is at your service")
 
-tfs = TiffSequenceReader(bigtif_name)
+tfs = TiffSequenceReader(bigtif_name, memmap=True)
 npairs = tfs.num_images//2
 n_my_pairs = int(npairs/size) + (1 if npairs%size > rank else 0)
 #print(f'Private {rank} got {n_my_pairs} pairs to process out of total {npairs}')
 
-for pair_number in range(n_my_pairs):
-    idx = rank + pair_number * size
+my_indices = [rank + pair_number * size for pair_number in range(n_my_pairs)]
+images = read_ahead(tfs, indices=[i for idx in my_indices for i in (idx, idx + npairs)])
+
+for idx in my_indices:
  #   print(f'Private {rank} processing pair {idx} - {idx+npairs}')
-    first = tfs.read(idx)
-    second = tfs.read(idx+npairs)[:, ::-1]
+    first = next(images)
+    second = next(images)[:, ::-1]
 
     #stitched = stitch(first, second, int(ax), int(crop))
 
@@ -210,8 +210,8 @@ def exec_sti_mp(indir, pout, N, Nnew, Vsteps, dx, M, ramp, indtype, j):
         else:
             tmp = sorted(glob.glob(tmp))[index]
             tmp1 = sorted(glob.glob(tmp1))[index]
-        first = read_image(tmp)
-        second = read_image(tmp1)
+        first = read_image(tmp, memmap=True)
+        second = read_image(tmp1, memmap=True)
         # sample moved downwards
         if EZVARS_aux['vert-sti']['flipud']['value']:
             first, second = np.flipud(first), np.flipud(second)
@@ -268,7 +268,7 @@ def exec_conc_mp(example_im, l, zfold, indir, pout, indtype, j):
             fname = sorted(glob.glob(tmp))[j]
         else:
             fname = sorted(glob.glob(tmp))[index]
-        frame = read_image(fname)[EZVARS_aux['vert-sti']['conc_row_top']['value']:
+        frame = read_image(fname, memmap=True)[EZVARS_aux['vert-sti']['conc_row_top']['value']:
                                   EZVARS_aux['vert-sti']['conc_row_bottom']['value'], :]
         if EZVARS_aux['vert-sti']['flipud']['value']:
             Large[i*N:N*(i+1), :] = np.flipud(frame)
@@ -6,6 +6,7 @@ Created on Apr 5, 2018
 
 import os
 from tofu.ez.params import EZVARS
+from tofu.manifest import MANIFEST_NAME
 
 VALID_EXTS = ['.tif', '.tiff', '.edf']
 
@@ -153,6 +154,8 @@ class WalkCTdirs:
         :return: 0 if invalid item found in directory - 1 if no invalid items found in directory
         """
         for i in os.listdir(tmpath):
+            if i == MANIFEST_NAME:
+                continue
             if os.path.isdir(i):
                 print(f"Directory {tmpath} contains a subdirectory")
                 return 0
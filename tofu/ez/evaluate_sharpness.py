@@ -8,7 +8,7 @@ from functools import partial
 from tofu.util import read_image
 from scipy.stats import skew, kurtosis
 from scipy import signal
-from tofu.util import TiffSequenceReader
+from tofu.util import TiffSequenceReader, read_ahead
 
 
 def sum_abs_gradient(data):
@@ -165,8 +165,8 @@ def evaluate_metrics_360_olap_search(images, out_prefix, x_data, *args, **kwargs
     merged = {}
     results = []
     tfs = TiffSequenceReader(images)
-    for i in range(tfs.num_images):
-        results.append(evaluate(tfs.read(i), *args, ** kwargs))
+    for image in read_ahead(tfs):
+        results.append(evaluate(image, *args, ** kwargs))
     tfs.close()
 
     for metric in results[0].keys():
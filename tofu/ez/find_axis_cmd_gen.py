@@ -4,11 +4,11 @@ Created on Apr 6, 2018
 
 @author: gasilos
 """
-import glob, os, tifffile
+import glob, os
 import numpy as np
 from tofu.ez.evaluate_sharpness import process as process_metrics
 from tofu.ez.util import enquote, make_inpaths
-from tofu.util import get_filenames, read_image
+from tofu.util import estimate_rotation_axis, TiffSequenceReader
 from tofu.ez.params import EZVARS
 from tofu.config import SECTIONS
 from tofu.ez.tofu_cmd_gen import check_lamino, gpu_optim
@@ -55,61 +55,30 @@ def find_axis_std(ctset, tmpdir, ax_range, p_width, nviews, wh, reduction_mode="
     points, maximum = evaluate_images_simp(out_pattern + "*.tif", "msag")
     return res[0] + res[2] * maximum
 
-def find_axis_corr(ctset, vcrop, y, height, multipage):
-    #TODO use tiffsequencereader
-    indir = make_inpaths(ctset[0], ctset[1])
-    """Use correlation to estimate center of rotation for tomography."""
-    from scipy.signal import fftconvolve
-
-    def flat_correct(flat, radio):
-        nonzero = np.where(radio != 0)
-        result = np.zeros_like(radio)
-        result[nonzero] = flat[nonzero] / radio[nonzero]
-        # log(1) = 0
-        result[result <= 0] = 1
-
-        return np.log(result)
-
-    if multipage:
-        with tifffile.TiffFile(get_filenames(indir[2])[0]) as tif:
-            first = tif.pages[0].asarray().astype(float)
-        with tifffile.TiffFile(get_filenames(indir[2])[-1]) as tif:
-            last = tif.pages[-1].asarray().astype(float)
-        with tifffile.TiffFile(get_filenames(indir[0])[-1]) as tif:
-            dark = tif.pages[-1].asarray().astype(float)
-        with tifffile.TiffFile(get_filenames(indir[1])[0]) as tif:
-            flat1 = tif.pages[-1].asarray().astype(float) - dark
-    else:
-        first = read_image(get_filenames(indir[2])[0]).astype(float)
-        last = read_image(get_filenames(indir[2])[-1]).astype(float)
-        dark = read_image(get_filenames(indir[0])[-1]).astype(float)
-        flat1 = read_image(get_filenames(indir[1])[-1]) - dark
-
-    first = flat_correct(flat1, first - dark)
+def find_axis_corr(ctset, vcrop, y, height, multipage, num_pairs=4):
+    """Use correlation to estimate center of rotation for tomography (see
+    :func:`tofu.util.estimate_rotation_axis`). The projections are flat-field corrected by the
+    last dark and the last flat field, for *multipage* input the last flat field of the first file.
+    """
+    def get_last_flat_index(path):
+        if not multipage:
+            return -1
+        with TiffSequenceReader(path) as reader:
+            return reader.offsets[1] - 1
 
-    if ctset[1] == 4:
-        if multipage:
-            with tifffile.TiffFile(get_filenames(indir[3])[0]) as tif:
-                flat2 = tif.pages[-1].asarray().astype(float) - dark
-        else:
-            flat2 = read_image(get_filenames(indir[3])[-1]) - dark
-        last = flat_correct(flat2, last - dark)
-    else:
-        last = flat_correct(flat1, last - dark)
-
-    if vcrop:
-        y_region = slice(y, min(y + height, first.shape[0]), 1)
-        first = first[y_region, :]
-        last = last[y_region, :]
-
-    width = first.shape[1]
-    first = first - first.mean()
-    last = last - last.mean()
+    indir = make_inpaths(ctset[0], ctset[1])
+    overall_angle = 180.
+    if (EZVARS['advanced']['more-reco-params']['value'] is True and
+            SECTIONS['general-reconstruction']['overall-angle']['value'] != ''):
+        overall_angle = float(SECTIONS['general-reconstruction']['overall-angle']['value'])
 
-    conv = fftconvolve(first, last[::-1, :], mode="same")
-    center = np.unravel_index(conv.argmax(), conv.shape)[1]
+    flats2 = indir[3] if ctset[1] == 4 else None
 
-    return (width / 2.0 + center) / 2.0
+    return estimate_rotation_axis(indir[2], overall_angle=overall_angle, num_pairs=num_pairs,
+                                  y=y if vcrop else 0, height=height if vcrop else None,
+                                  darks=indir[0], flats=indir[1], flats2=flats2, dark_index=-1,
+                                  flat_index=get_last_flat_index(indir[1]),
+                                  flat2_index=get_last_flat_index(flats2) if flats2 else -1)
 
 # Find midpoint width of image and return its value
 def find_axis_image_midpoint(height_width):
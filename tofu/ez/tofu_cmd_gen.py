@@ -151,6 +151,8 @@ def get_sinos_ffc_cmd(ctset, tmpdir, nviews, wh, n_per_pass, reduction_mode="med
         cmd += " --output-bytes-per-file 0"
     cmd += ' --flat-scale {}'.format(EZVARS['flat-correction']['flat-scale']['value'])
     cmd += f" --pass-size {n_per_pass}"
+    # Read the input only once instead of in every pass
+    cmd += " --sinos-cache ram"
     return cmd
 
 def get_sinos_noffc_cmd(ctsetpath, tmpdir, nviews, wh, n_per_pass):
@@ -170,6 +172,8 @@ def get_sinos_noffc_cmd(ctsetpath, tmpdir, nviews, wh, n_per_pass):
         # because second RR algorithm does not know how to work with multipage tiffs
         cmd += " --output-bytes-per-file 0"
     cmd += f" --pass-size {n_per_pass}"
+    # Read the input only once instead of in every pass
+    cmd += " --sinos-cache ram"
     return cmd
 
 def get_sinos2proj_cmd(proj_height, n_per_pass):
@@ -184,6 +188,8 @@ def get_sinos2proj_cmd(proj_height, n_per_pass):
     else:
         cmd += ' --number {}'.format(int(SECTIONS['reading']['height']['value'] / SECTIONS['reading']['y-step']['value']))
     cmd += f" --pass-size {n_per_pass}"
+    # Read the input only once instead of in every pass
+    cmd += " --sinos-cache ram"
     return cmd
 
 def get_sinFFC_cmd(ctset, reduction_mode="median"):
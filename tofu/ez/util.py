@@ -3,7 +3,7 @@ Created on Apr 20, 2020
 
 @author: gasilos
 """
-import os, glob, tifffile
+import os, tifffile
 import shutil
 
 from tofu.ez.ctdir_walker import VALID_EXTS
@@ -13,7 +13,8 @@ from tofu.util import get_filenames, get_first_filename, get_image_shape, read_i
 from pyqtgraph.Qt.QtCore import QRegularExpression
 from pyqtgraph.Qt.QtGui import QRegularExpressionValidator
 import argparse
-from tofu.util import TiffSequenceReader
+from tofu.flatcache import get_reduced
+from tofu.manifest import get_manifest_entry
 import numpy as np
 import yaml
 import logging
@@ -40,11 +41,16 @@ def get_dims(pth):
 
 def get_data_cube_info(pth):
     ext = os.path.splitext(get_first_filename(pth, valid_exts=VALID_EXTS))[1]
-    im_names = glob.glob(os.path.join(pth, '*' + ext))
+    im_names = get_filenames(os.path.join(pth, '*' + ext))
     nslices = len(im_names)
-    im = read_image(im_names[0])
-    N, M = im.shape
-    tmp = im.dtype
+    entry = get_manifest_entry(im_names[0])
+    if entry:
+        N, M = entry['shape']
+        tmp = np.dtype(entry['dtype'])
+    else:
+        im = read_image(im_names[0])
+        N, M = im.shape
+        tmp = im.dtype
     bit = 0; dt = 'unsupported'
     if tmp == 'uint8':
         bit = 8; dt = 'uint8'
@@ -57,14 +63,10 @@ def get_data_cube_info(pth):
     return nslices, N, M, bit, dt, n_per_pass, ext
 
 def bad_vert_ROI(multipage, path2proj, y, height):
-    if multipage:
-        with tifffile.TiffFile(get_filenames(path2proj)[0]) as tif:
-            proj = tif.pages[0].asarray().astype(float)
-    else:
-        proj = read_image(get_filenames(path2proj)[0]).astype(float)
-    y_region = slice(y, min(y + height, proj.shape[0]), 1)
-    proj = proj[y_region, :]
-    if proj.shape[0] == 0:
+    # Only the image height is needed, which does not require reading the projection
+    proj_height = get_image_shape(get_filenames(path2proj)[0])[-2]
+    y_region = slice(y, min(y + height, proj_height), 1)
+    if len(range(*y_region.indices(proj_height))) == 0:
         return True
     else:
         return False
@@ -476,26 +478,12 @@ def reverse_tupleize(num_items=None, conv=float):
     return combine_to_string
 
 def get_median_flat(path2flat):
-    tsr = TiffSequenceReader(path2flat)
-    tmp = tsr.read(0)
-    data = np.empty((tsr.num_images, tmp.shape[0], tmp.shape[1]), np.uint16)
-    for i in range(tsr.num_images):
-        data[i, :, :] = tsr.read(i)
-    tsr.close()
-    x = np.median(data, axis=0)
-    del data
-    return x
+    """Median of the flats in *path2flat* from the cache of reduced flats (see tofu.flatcache)."""
+    return get_reduced(path2flat, 'median')
 
 def get_mean_flat(path2flat):
-    tsr = TiffSequenceReader(path2flat)
-    tmp = tsr.read(0)
-    data = np.empty((tsr.num_images, tmp.shape[0], tmp.shape[1]), np.uint16)
-    for i in range(tsr.num_images):
-        data[i, :, :] = tsr.read(i)
-    tsr.close()
-    x = np.mean(data, axis=0)
-    del data
-    return x
+    """Mean of the flats in *path2flat* from the cache of reduced flats (see tofu.flatcache)."""
+    return get_reduced(path2flat, 'average')
 
 def read_yaml(filePath):
     with open(filePath) as f:
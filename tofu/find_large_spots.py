@@ -4,10 +4,14 @@ from tofu.util import (
     get_filtering_padding,
     set_node_props,
     determine_shape,
+    is_tiff_input,
+    read_ahead,
     read_image,
+    read_images,
     setup_read_task,
     setup_padding,
-    write_image
+    write_image,
+    TiffSequenceReader
 )
 from tofu.tasks import get_task, get_writer
 
@@ -15,6 +19,51 @@ from tofu.tasks import get_task, get_writer
 LOG = logging.getLogger(__name__)
 
 
+def average_images(filename, mode, max_bytes=2 ** 30):
+    """Average images in *filename* by *mode*, which is one of 'first', 'mean' and 'median', without
+    holding all of them in memory. Mean is accumulated image by image, median is computed in blocks
+    of rows so that one block of all images takes at most *max_bytes*, only the rows of the current
+    block are read from every image.
+    """
+    import numpy as np
+
+    if mode == "first":
+        return read_image(filename)
+    if mode == "mean":
+        image = None
+        num = 0
+        for num, current in enumerate(read_images(filename, memmap=True), start=1):
+            if image is None:
+                image = current.astype(float)
+            else:
+                image += current
+        if not num:
+            raise ValueError(f"No images to average in `{filename}'")
+
+        return image / num
+    if mode != "median":
+        raise ValueError(f"Unknown averaging mode `{mode}'")
+    if not is_tiff_input(filename):
+        return np.median([read_image(filename)], axis=0)
+
+    with TiffSequenceReader(filename, memmap=True) as reader:
+        first = reader.read(0)
+        height, width = first.shape
+        num = reader.num_images
+        rows = int(min(height, max(1, max_bytes // (num * width * first.dtype.itemsize))))
+        LOG.debug("Computing median of %d images in blocks of %d rows", num, rows)
+        image = np.empty(first.shape, dtype=float)
+        block = np.empty((num, rows, width), dtype=first.dtype)
+        for start in range(0, height, rows):
+            stop = min(start + rows, height)
+            # Read and decode only the rows of the current block
+            for i, current in enumerate(read_ahead(reader, rows=(start, stop))):
+                block[i, :stop - start] = current
+            image[start:stop] = np.median(block[:, :stop - start], axis=0)
+
+    return image
+
+
 def find_large_spots_median(args):
     import numpy as np
     import skimage.morphology as sm
@@ -24,14 +73,7 @@ def find_large_spots_median(args):
     from skimage.restoration import estimate_sigma
     from scipy.ndimage import binary_fill_holes
 
-    images = read_image(args.images, allow_multi=True)
-    if args.averaging_mode == "first":
-        image = images[0]
-    if args.averaging_mode == "mean":
-        image = np.mean(images, axis=0)
-    if args.averaging_mode == "median":
-        image = np.median(images, axis=0)
-
+    image = average_images(args.images, args.averaging_mode, max_bytes=args.averaging_bytes)
     mask = np.zeros_like(image, dtype=np.uint8)
 
     if args.median_direction == 'both':
@@ -0,0 +1,169 @@
+"""Cache of reduced (averaged or median) dark and flat fields. A reduced image is stored as a .npy
+file in the cache directory under a key computed from the input file names, their modification times
+and sizes and the reduction mode, so that all tofu and ez steps which need the same reduced image
+compute it only once. The reduction is computed per pixel, so whole images are cached and regions of
+interest are cropped from them. Changed input files produce a new key, old entries are never used
+again and can be deleted at any time. Only tif, EDF and HDF5 input is supported (see
+:func:`is_supported`), other formats (e.g. raw files) are reduced by UFO pipelines instead.
+"""
+import hashlib
+import json
+import logging
+import os
+from threading import Lock
+from tofu.util import (get_filenames, get_image_shape, get_num_images, is_hdf5_path, is_tiff_input,
+                       read_ahead, read_hdf5_blocks, read_hdf5_images, read_image, split_hdf5_path,
+                       TiffSequenceReader)
+
+
+LOG = logging.getLogger(__name__)
+CACHE_VERSION = 1
+REDUCTION_MODES = ('average', 'median')
+SUPPORTED_EXTS = ('.tif', '.tiff', '.edf')
+# Reduced images already loaded or computed by this process
+REDUCED = {}
+_LOCK = Lock()
+
+
+def get_default_cache_directory():
+    """Get $XDG_CACHE_HOME/tofu/reduced (~/.cache/tofu/reduced if XDG_CACHE_HOME is not set)."""
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(cache_dir, 'tofu', 'reduced')
+
+
+def is_supported(path):
+    """Return True if images in *path* can be read by the cache, i.e. they are tif or EDF files or
+    an HDF5 dataset.
+    """
+    if is_hdf5_path(path):
+        return True
+    filenames = get_filenames(path)
+
+    return bool(filenames) and all(os.path.splitext(filename)[1].lower() in SUPPORTED_EXTS
+                                   for filename in filenames)
+
+
+def get_cache_key(path, mode):
+    """Get the cache key of images in *path* (a file pattern, directory or HDF5 dataset) reduced by
+    *mode*.
+    """
+    dataset = None
+    if is_hdf5_path(path):
+        filename, dataset = split_hdf5_path(path)
+        filenames = [filename]
+    else:
+        filenames = get_filenames(path)
+    if not filenames:
+        raise RuntimeError("No files found in `{}'".format(path))
+
+    files = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        files.append([os.path.abspath(filename), stat.st_mtime_ns, stat.st_size])
+    description = {'version': CACHE_VERSION, 'files': files, 'dataset': dataset, 'mode': mode}
+
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def _average(blocks):
+    """Average images from *blocks*, which are images or stacks of images."""
+    import numpy as np
+
+    result = None
+    num_images = 0
+    for block in blocks:
+        block = block.reshape((-1,) + block.shape[-2:])
+        current = block.astype(np.float64).sum(axis=0)
+        result = current if result is None else result + current
+        num_images += len(block)
+
+    return (result / num_images).astype(np.float32)
+
+
+def _median_by_rows(read_rows, num_images, height, width, max_bytes):
+    """Median of *num_images* images with *height* and *width* computed in blocks of rows, so that
+    one block of all images takes at most *max_bytes*. *read_rows* is a function which returns
+    the rows from start to stop of all images.
+    """
+    import numpy as np
+
+    rows = int(min(height, max(1, max_bytes // (num_images * width * 4))))
+    LOG.debug('Computing median of %d images in blocks of %d rows', num_images, rows)
+    result = np.empty((height, width), dtype=np.float32)
+    for start in range(0, height, rows):
+        stop = min(start + rows, height)
+        result[start:stop] = np.median(read_rows(start, stop), axis=0)
+
+    return result
+
+
+def reduce_images(path, mode, max_bytes=2 ** 30):
+    """Reduce images in *path* by *mode* ('average' or 'median') and return the result as a float32
+    array. Average is accumulated image by image, median of tif and HDF5 input is computed in
+    blocks of rows so that one block of all images takes at most *max_bytes*.
+    """
+    import numpy as np
+
+    if is_hdf5_path(path):
+        if mode == 'average':
+            return _average(read_hdf5_blocks(path))
+        height, width = get_image_shape(path)[-2:]
+
+        def read_rows(start, stop):
+            return read_hdf5_images(path, y=start, height=stop - start)
+
+        return _median_by_rows(read_rows, get_num_images(path), height, width, max_bytes)
+    if is_tiff_input(path):
+        with TiffSequenceReader(path) as reader:
+            if mode == 'average':
+                return _average(read_ahead(reader))
+            height, width = reader.read(0).shape
+
+            def read_rows(start, stop):
+                return np.array(list(read_ahead(reader, rows=(start, stop))), dtype=np.float32)
+
+            return _median_by_rows(read_rows, reader.num_images, height, width, max_bytes)
+
+    # EDF files cannot be read by rows
+    images = [read_image(filename) for filename in get_filenames(path)]
+    if mode == 'average':
+        return _average(images)
+
+    return np.median(np.array(images, dtype=np.float32), axis=0).astype(np.float32)
+
+
+def get_reduced(path, mode, y=0, height=None, y_step=1, directory=None):
+    """Get images in *path* reduced by *mode* ('average' or 'median') from the cache in *directory*
+    (see :func:`get_default_cache_directory`), compute and store them if they are not there yet.
+    Return the rows given by *y*, *height* and *y_step* as a contiguous float32 array.
+    """
+    import numpy as np
+
+    mode = mode.lower()
+    if mode not in REDUCTION_MODES:
+        raise ValueError("Invalid reduction mode `{}', must be one of {}".format(mode,
+                                                                               REDUCTION_MODES))
+    key = get_cache_key(path, mode)
+    filename = os.path.join(directory or get_default_cache_directory(), key + '.npy')
+
+    with _LOCK:
+        if key in REDUCED:
+            result = REDUCED[key]
+        elif os.path.exists(filename):
+            LOG.debug("Using reduced `%s' (%s) from `%s'", path, mode, filename)
+            result = np.load(filename)
+        else:
+            LOG.debug("Reducing `%s' (%s)", path, mode)
+            result = reduce_images(path, mode)
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+                with open(tmp_filename, 'wb') as f:
+                    np.save(f, result)
+                os.replace(tmp_filename, filename)
+            except OSError as exc:
+                LOG.warning("Cannot store reduced `%s' in the cache: %s", path, exc)
+        REDUCED[key] = result
+
+    return np.ascontiguousarray(result[y:y + height if height else None:y_step])
@@ -2,19 +2,24 @@
 sets.
 """
 import copy
+import glob
 import itertools
+import json
 import logging
 import os
 import time
 import numpy as np
+from contextlib import contextmanager
 from multiprocessing.pool import ThreadPool
-from threading import Event, Thread
-from gi.repository import Ufo
+from threading import Condition, Lock, Thread
+from gi.repository import GLib, Ufo
 from .preprocess import create_preprocessing_pipeline
 from .util import (fbp_filtering_in_phase_retrieval, get_filtering_padding,
                    get_reconstructed_cube_shape, get_reconstruction_regions,
-                   get_filenames, determine_shape, get_scarray_value, Vector)
-from .tasks import get_task, get_writer
+                   get_num_images, determine_shape, get_available_memory,
+                   allocate_projection_cache, next_power_of_two, get_filenames, is_hdf5_path,
+                   is_module_available, is_tiff_input, prefetch_rows, split_hdf5_path)
+from .tasks import check_read_errors, get_memory_in, get_task, get_writer
 
 
 LOG = logging.getLogger(__name__)
@@ -24,16 +29,50 @@ DTYPE_CL_SIZE = {'float': 4,
                  'uchar': 1,
                  'ushort': 2,
                  'uint': 4}
+DTYPE_CL_NUMPY = {'float': np.float32,
+                  'double': np.float64,
+                  'half': np.float16,
+                  'uchar': np.uint8,
+                  'ushort': np.uint16,
+                  'uint': np.uint32}
+HDF5_DATASET = 'volume'
+HDF5_GEOMETRY_ATTRS = ('x_region', 'y_region', 'z_region', 'z_parameter', 'z', 'number',
+                       'overall_angle', 'center_position_x', 'center_position_z',
+                       'source_position_x', 'source_position_y', 'source_position_z',
+                       'detector_position_x', 'detector_position_y', 'detector_position_z',
+                       'detector_angle_x', 'detector_angle_y', 'detector_angle_z',
+                       'axis_angle_x', 'axis_angle_y', 'axis_angle_z',
+                       'volume_angle_x', 'volume_angle_y', 'volume_angle_z')
+# Number of projections backprojected at once assumed by the memory model if --burst is not given
+DEFAULT_BURST = 16
+# Arguments which do not change the reconstructed volume and may differ in a resumed run
+JOURNAL_IGNORED_ARGS = ('config', 'verbose', 'log', 'commands', 'resume', 'journal', 'gpus',
+                        'num_gpu_threads', 'slices_per_device', 'slice_memory_coeff',
+                        'data_splitting_policy', 'region_scheduling', 'device_memory_model',
+                        'device_profiles', 'projection_cache', 'projection_cache_directory',
+                        'output_buffer_depth', 'enable_tracing', 'perf_report', 'workers',
+                        'worker_command', 'shared_reader')
+# Arguments which determine the regions written to separate files, see get_journal_layout
+JOURNAL_LAYOUT_ARGS = ('gpus', 'num_gpu_threads', 'slices_per_device', 'slice_memory_coeff',
+                       'data_splitting_policy', 'region_scheduling', 'device_memory_model')
 
 
 def genreco(args):
+    if args.workers:
+        from tofu import distributed
+        distributed.run(args)
+        return
     st = time.time()
-    if is_output_single_file(args):
-        try:
-            import ufo.numpy
-        except ImportError:
-            LOG.error('You must install ufo python support (in ufo-core/python) to be able to write single-file output')
-            return
+    if is_output_single_file(args) and not is_module_available('ufo.numpy'):
+        LOG.error('You must install ufo python support (in ufo-core/python) to be able to write single-file output')
+        return
+    if args.projection_cache != 'none' and not is_module_available('ufo.numpy'):
+        LOG.error('You must install ufo python support (in ufo-core/python) to be able to '
+                  'cache projections')
+        return
+    if is_output_hdf5(args) and not is_module_available('h5py'):
+        LOG.error('You must install h5py to be able to write HDF5 output')
+        return
     if (args.energy is not None and args.propagation_distance is not None and not
             (args.projection_margin or args.disable_projection_crop)):
         LOG.warning('Phase retrieval without --projection-margin specification or '
@@ -54,17 +93,35 @@ def genreco(args):
         raise ValueError('--gpus contains invalid indices')
     
     gpus = gpus[gpu_indices]
-    duration = 0
     for i, gpu in enumerate(gpus):
         print('Max mem for {}: {:.2f} GB'.format(i, gpu.get_info(0) / 2. ** 30))
 
+    memory_model = None
+    if args.device_memory_model != 'slices' and not args.slices_per_device:
+        memory_model = setup_memory_model(args, resources[0], gpus, gpu_indices, x_region,
+                                          y_region, z_region)
+
     runs = make_runs(gpus, gpu_indices, x_region, y_region, z_region, bpp,
                      slices_per_device=args.slices_per_device,
                      slice_memory_coeff=args.slice_memory_coeff,
                      data_splitting_policy=args.data_splitting_policy,
-                     num_gpu_threads=args.num_gpu_threads)
-
-    for i in range(len(runs[0]) - 1):
+                     num_gpu_threads=args.num_gpu_threads,
+                     memory_model=memory_model)
+
+    journal = None
+    # Only on request, the journal must not end up among the slices read by other programs
+    if (args.resume or args.journal) and not args.dry_run:
+        if is_output_hdf5(args) or not is_output_single_file(args):
+            journal = RegionJournal(args.journal or args.output + '.journal.json',
+                                    get_journal_parameters(args),
+                                    layout=get_journal_layout(args, runs), resume=args.resume)
+        elif args.resume:
+            LOG.warning('Resuming single-file TIFF output is not supported, '
+                        'reconstructing everything')
+
+    lanes = make_lanes(runs)
+    # Two resources per lane, one for the running region and one for setting up the next one
+    for i in range(2 * len(lanes) - 1):
         resources.append(Ufo.Resources())
 
     LOG.info('Number of passes: %d', len(runs))
@@ -72,8 +129,39 @@ def genreco(args):
     for regions in runs:
         LOG.debug('%s', str(regions))
 
-    for i, regions in enumerate(runs):
-        duration += _run(resources, args, x_region, y_region, regions, i, vol_nbytes)
+    projections = None
+    if args.projection_cache != 'none' and not args.dry_run:
+        if len(runs) > 1:
+            projections = make_projection_cache(args, resources[0], runs[0][0][0])
+        else:
+            LOG.debug('Only one pass, not caching projections')
+
+    volume_writer = None
+    if is_output_hdf5(args):
+        volume_writer = HDF5VolumeWriter(args.output, vol_shape[::-1],
+                                         DTYPE_CL_NUMPY[args.store_type],
+                                         chunks=args.output_chunks,
+                                         compression=args.output_compression,
+                                         attrs=get_geometry_attributes(args, x_region, y_region,
+                                                                       z_region),
+                                         resume=bool(journal and journal.resumed),
+                                         on_write=journal.add if journal else None)
+        if journal and journal.resumed and not volume_writer.resumed:
+            LOG.warning("Output `%s' does not match the journal, reconstructing everything",
+                        args.output)
+            journal.clear()
+        if journal:
+            volume_writer.done = journal.get_done_slices()
+
+    executor_stats = [] if args.perf_report else None
+    try:
+        duration = _run(resources, args, x_region, y_region, z_region, runs, lanes, vol_nbytes,
+                        volume_writer=volume_writer, projections=projections, journal=journal,
+                        executor_stats=executor_stats)
+    finally:
+        if volume_writer:
+            volume_writer.close()
+            LOG.debug('HDF5 writer closed')
 
     num_gupdates = num_voxels * args.number * 1e-9
     total_duration = time.time() - st
@@ -82,9 +170,34 @@ def genreco(args):
     LOG.debug('UFO performance: %.2f GUPS', num_gupdates / duration)
     LOG.debug('Total performance: %.2f GUPS', num_gupdates / total_duration)
 
+    if args.perf_report:
+        slices_per_device = {}
+        for regions in runs:
+            for gpu_index, region in regions:
+                num_slices = len(np.arange(*region))
+                slices_per_device[int(gpu_index)] = max(num_slices,
+                                                        slices_per_device.get(int(gpu_index), 0))
+        report = {
+            'total_time': total_duration,
+            'ufo_time': duration,
+            'total_gups': num_gupdates / total_duration,
+            'ufo_gups': num_gupdates / duration,
+            'volume_shape': list(vol_shape[::-1]),
+            'volume_bytes': vol_nbytes,
+            'number': args.number,
+            'num_passes': len(runs),
+            'slices_per_device': slices_per_device,
+            'passes': get_pass_stats(executor_stats),
+            'executors': executor_stats,
+        }
+        if args.enable_tracing:
+            report['trace'] = parse_ufo_trace(glob.glob('.*{}.json'.format(os.getpid())))
+        write_perf_report(args.perf_report, report)
+
 
 def make_runs(gpus, gpu_indices, x_region, y_region, z_region, bpp, slices_per_device=None,
-              slice_memory_coeff=0.8, data_splitting_policy='one', num_gpu_threads=1):
+              slice_memory_coeff=0.8, data_splitting_policy='one', num_gpu_threads=1,
+              memory_model=None):
     gpu_indices = np.array(gpu_indices)
     def _add_region(runs, gpu_index, current, to_process, z_start, z_step):
         current_per_thread = current // num_gpu_threads
@@ -107,7 +220,9 @@ def make_runs(gpus, gpu_indices, x_region, y_region, z_region, bpp, slices_per_d
         slices_per_device = [slices_per_device for i in range(len(gpus))]
     else:
         slices_per_device = get_num_slices_per_gpu(gpus, slice_width, slice_height, bpp,
-                                                   slice_memory_coeff=slice_memory_coeff)
+                                                   slice_memory_coeff=slice_memory_coeff,
+                                                   memory_model=memory_model,
+                                                   num_gpu_threads=num_gpu_threads)
 
     max_slices_per_pass = sum(slices_per_device)
     if not max_slices_per_pass:
@@ -156,77 +271,595 @@ def make_runs(gpus, gpu_indices, x_region, y_region, z_region, bpp, slices_per_d
     return runs
 
 
-def get_num_slices_per_gpu(gpus, width, height, bpp, slice_memory_coeff=0.8):
+def get_num_slices_per_gpu(gpus, width, height, bpp, slice_memory_coeff=0.8, memory_model=None,
+                           num_gpu_threads=1):
+    """Get the number of slices every GPU from *gpus* can reconstruct at once. If *memory_model*
+    is None, only the slices of *width* x *height* pixels with *bpp* bytes per pixel take
+    *slice_memory_coeff* of the memory, otherwise *memory_model* (a :class:`DeviceMemoryModel`)
+    estimates the memory of the whole graph of every of the *num_gpu_threads* threads.
+    """
     num_slices = []
     slice_size = width * height * bpp
 
     for i, gpu in enumerate(gpus):
+        if memory_model:
+            num_slices.append(memory_model.get_num_slices(gpu, memory_coeff=slice_memory_coeff,
+                                                          num_threads=num_gpu_threads))
+            continue
         max_mem = gpu.get_info(Ufo.GpuNodeInfo.GLOBAL_MEM_SIZE)
         num_slices.append(int(np.floor(max_mem * slice_memory_coeff / slice_size)))
 
     return num_slices
 
 
-def _run(resources, args, x_region, y_region, regions, run_number, vol_nbytes):
-    """Execute one pass on all possible GPUs with slice ranges given by *regions*. Use separate
-    thread per GPU and optimize the read projection regions.
+def get_device_key(gpu):
+    """Get a key identifying the kind of *gpu* in device profiles. UFO does not expose the OpenCL
+    device name, so use the node label (if there is one) and the memory sizes.
     """
-    executors = []
-    writer = None
-    last = None
+    label = gpu.get_label() if hasattr(gpu, 'get_label') else None
+
+    return '{}:{}:{}'.format(label or 'gpu', gpu.get_info(Ufo.GpuNodeInfo.GLOBAL_MEM_SIZE),
+                             gpu.get_info(Ufo.GpuNodeInfo.MAX_MEM_ALLOC_SIZE))
+
+
+def get_default_device_profiles_path():
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+
+    return os.path.join(cache_dir, 'tofu', 'device-profiles.json')
+
+
+def load_device_profiles(path):
+    """Load device profiles from *path*, return an empty dictionary if there are none."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as exc:
+        LOG.warning("Could not load device profiles from `%s': %s", path, exc)
+        return {}
+
+
+def save_device_profiles(path, profiles):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        json.dump(profiles, f, indent=4, sort_keys=True)
+    LOG.debug("Device profiles saved to `%s'", path)
+
+
+def make_memory_model(args, x_region, y_region, pool_size=2):
+    """Create a :class:`DeviceMemoryModel` of the reconstruction graph given by *args* for slices
+    given by *x_region* and *y_region*. Every preprocessing task is assumed to keep *pool_size*
+    output buffers. Projections are assumed not to be cropped, so the estimate is an upper bound.
+    """
+    width, height = args.width, args.height
+    if not (width and height):
+        determined_width, determined_height = determine_shape(args, args.projections)
+        width = width or determined_width
+        height = height or determined_height - args.y
+    if args.transpose_input:
+        width, height = height, width
+    proj_nbytes = width * height * 4
+    backprojected_width = width
+
+    # Read projections, reduced flats and darks and flat field corrected projections
+    fixed = proj_nbytes
+    if args.darks and args.flats:
+        fixed += (4 if args.flats2 else 3) * proj_nbytes
+    if args.energy is not None and args.propagation_distance is not None:
+        padded_width = args.retrieval_padded_width or next_power_of_two(width + 64)
+        padded_height = args.retrieval_padded_height or next_power_of_two(height + 64)
+        # Padded real input, complex FFT, retrieval and inverse FFT outputs
+        fixed += padded_width * padded_height * (4 + 3 * 8)
+        if (fbp_filtering_in_phase_retrieval(args) and
+                args.projection_crop_after == 'backprojection'):
+            backprojected_width = padded_width
+    if args.projection_filter != 'none' and not fbp_filtering_in_phase_retrieval(args):
+        padded_width = width + get_filtering_padding(width)
+        # Padded real input, complex FFT, filter and inverse FFT outputs
+        fixed += padded_width * height * (4 + 3 * 8)
+        if args.projection_crop_after == 'backprojection':
+            backprojected_width = padded_width
+    fixed *= pool_size
+    # Projections backprojected at once
+    fixed += (args.burst or DEFAULT_BURST) * backprojected_width * height * 4
+
+    slice_width, slice_height = get_reconstructed_cube_shape(x_region, y_region, [0, 1, 1])[:2]
+    # Intermediate result and stored slice
+    per_slice = slice_width * slice_height * (DTYPE_CL_SIZE[args.result_type] +
+                                              DTYPE_CL_SIZE[args.store_type])
+    LOG.debug('Memory model: %.2f MB fixed, %.2f MB per slice', fixed / 2. ** 20,
+              per_slice / 2. ** 20)
+
+    return DeviceMemoryModel(fixed, per_slice)
+
+
+def setup_memory_model(args, resources, gpus, gpu_indices, x_region, y_region, z_region):
+    """Create the memory model given by *args*, calibrate it by probe runs on *gpus* if
+    args.device_memory_model is 'probe' and store the calibration in the device profiles,
+    otherwise use the stored calibration.
+    """
+    memory_model = make_memory_model(args, x_region, y_region)
+    path = args.device_profiles or get_default_device_profiles_path()
+    profiles = load_device_profiles(path)
+    memory_model.scales = {key: profile['scale'] for (key, profile) in profiles.items()
+                           if 'scale' in profile}
+
+    if args.device_memory_model == 'probe':
+        probed = set()
+        for gpu_index, gpu in zip(gpu_indices, gpus):
+            key = get_device_key(gpu)
+            if key in probed:
+                # Same kind of device
+                continue
+            probed.add(key)
+            scale = probe_memory_scale(args, resources, gpu_index, gpu, memory_model,
+                                       x_region, y_region, z_region,
+                                       memory_coeff=args.slice_memory_coeff,
+                                       num_threads=args.num_gpu_threads)
+            if scale is not None:
+                memory_model.scales[key] = scale
+                profiles[key] = {'scale': scale}
+        save_device_profiles(path, profiles)
+
+    return memory_model
+
+
+@contextmanager
+def capture_opencl_errors():
+    """Collect OpenCL errors which UFO only logs (e.g. failed asynchronous allocations) instead
+    of raising them and yield the list of their messages.
+    """
+    messages = []
+    handlers = []
+
+    def handle(domain, level, message, *user_data):
+        if 'opencl error' in message.lower() or 'CL_' in message:
+            messages.append(message)
+        GLib.log_default_handler(domain, level, message, None)
+
+    levels = GLib.LogLevelFlags.LEVEL_WARNING | GLib.LogLevelFlags.LEVEL_CRITICAL
+    for domain in ('Ufo', None):
+        try:
+            handlers.append((domain, GLib.log_set_handler(domain, levels, handle)))
+        except Exception as exc:
+            LOG.debug('Cannot capture OpenCL errors of domain %s: %s', domain, exc)
+    try:
+        yield messages
+    finally:
+        for domain, handler_id in handlers:
+            GLib.log_remove_handler(domain, handler_id)
+
+
+def _run_probe(executors):
+    """Run *executors* concurrently and return the error message if any of them failed or UFO
+    logged an OpenCL error, None otherwise.
+    """
+    errors = []
 
-    if is_output_single_file(args):
+    def process(executor):
+        try:
+            executor.process()
+        except Exception as exc:
+            errors.append(str(exc))
+
+    with capture_opencl_errors() as messages:
+        threads = [Thread(target=process, args=(executor,)) for executor in executors]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    errors += messages
+
+    return '; '.join(errors) if errors else None
+
+
+def probe_memory_scale(args, resources, gpu_index, gpu, memory_model, x_region, y_region,
+                       z_region, memory_coeff=0.8, scales=(0.8, 1., 1.25, 1.5, 2.),
+                       num_projections=16, num_threads=1, safety_margin=0.1):
+    """Calibrate *memory_model* for *gpu* by reconstructing dummy data with *num_projections* by
+    *num_threads* concurrent graphs, like in the real run, each with its share of the slices
+    given by the model for a scale from *scales*. Scales are tried from the most conservative
+    (largest) to the most aggressive one until a reconstruction fails, OpenCL errors which UFO
+    only logs count as failures as well. Return the smallest scale which succeeded increased by
+    *safety_margin* or None if all fail.
+    """
+    probe_args = copy.deepcopy(args)
+    determine_shape(probe_args, probe_args.projections, store=True)
+    probe_args.dry_run = True
+    probe_args.disable_projection_crop = True
+    probe_args.number = min(args.number, num_projections)
+    # Every graph needs its own resources
+    probe_resources = [resources] + [Ufo.Resources() for i in range(num_threads - 1)]
+    best = None
+
+    for scale in sorted(scales, reverse=True):
+        num_slices = memory_model.get_num_slices(gpu, memory_coeff=memory_coeff,
+                                                 num_threads=num_threads,
+                                                 scale=scale) // num_threads
+        if not num_slices:
+            continue
+        region = [z_region[0], z_region[0] + num_slices * z_region[2], z_region[2]]
+        executors = [Executor(probe_resources[i], probe_args, region, x_region, y_region,
+                              gpu_index, i) for i in range(num_threads)]
+        error = _run_probe(executors)
+        if error:
+            LOG.debug('Memory probe with %d slices in %d threads on device %d failed: %s',
+                      num_slices, num_threads, gpu_index, error)
+            # More aggressive scales would fail as well
+            break
+        LOG.debug('Memory probe with %d slices in %d threads on device %d succeeded, scale: %g',
+                  num_slices, num_threads, gpu_index, scale)
+        best = scale
+
+    if best is None:
+        LOG.warning('Memory probe on device %d failed for all scales, not calibrating', gpu_index)
+        return None
+
+    scale = best * (1 + safety_margin)
+    LOG.info('Memory probe on device %d succeeded down to scale %g, using scale %g',
+             gpu_index, best, scale)
+
+    return scale
+
+
+def make_lanes(runs):
+    """Split the regions of all passes in *runs* into lanes, which are processed one after another
+    on the same GPU. A lane is a list of (pass number, index within pass, GPU index, region), a GPU
+    has as many lanes as the maximum number of its regions in one pass.
+    """
+    lanes = {}
+    for run_number, regions in enumerate(runs):
+        occurrences = {}
+        for index, (gpu_index, region) in enumerate(regions):
+            key = (gpu_index, occurrences.get(gpu_index, 0))
+            occurrences[gpu_index] = key[1] + 1
+            lanes.setdefault(key, []).append((run_number, index, gpu_index, region))
+
+    return list(lanes.values())
+
+
+def make_projection_cache(args, resources, gpu_index, memory_coeff=0.5, mode=None, y=None,
+                          height=None):
+    """Preprocess all projections given by *args* on GPU *gpu_index* from *resources* and store
+    them either in host memory or in a memory-mapped temporary file, based on *mode* ('ram' or
+    'disk', args.projection_cache if None). Host memory is used only if the projections take at
+    most *memory_coeff* of the available memory. If *y* and *height* are given, only these rows
+    are read. Return the stack of preprocessed projections or None if it does not fit anywhere.
+    """
+    import ufo.numpy
+
+    st = time.time()
+    cache_args = copy.deepcopy(args)
+    if height:
+        cache_args.y = y
+        cache_args.height = height
+        cache_args.center_position_z = [position - y for position in args.center_position_z]
+    scheduler = Ufo.FixedScheduler()
+    scheduler.set_resources(resources)
+    gpu = scheduler.get_resources().get_gpu_nodes()[gpu_index]
+    graph = Ufo.TaskGraph()
+    output = Ufo.OutputTask()
+    last = create_preprocessing_pipeline(cache_args, graph, processing_node=gpu,
+                                         cone_beam_weight=not args.disable_cone_beam_weight)
+    graph.connect_nodes(last, output)
+    # setup_graph needs the padded width to shift the center of padded projections
+    args.retrieval_padded_width = cache_args.retrieval_padded_width
+
+    width = cache_args.width
+    if args.projection_filter != 'none' and args.projection_crop_after == 'backprojection':
+        width += get_projection_padding(cache_args, width)[0]
+    shape = (args.number, cache_args.height, width)
+    projections = allocate_projection_cache(shape, mode or args.projection_cache,
+                                            directory=args.projection_cache_directory,
+                                            memory_coeff=memory_coeff)
+    if projections is None:
+        return None
+
+    thread = Thread(target=scheduler.run, args=(graph,))
+    thread.daemon = True
+    thread.start()
+    try:
+        for i in range(args.number):
+            buf = output.get_output_buffer()
+            projections[i] = ufo.numpy.asarray(buf)
+            output.release_output_buffer(buf)
+    except BaseException:
+        scheduler.abort()
+        raise
+    finally:
+        thread.join()
+    check_read_errors()
+    LOG.debug('Projections cached in %.2f s', time.time() - st)
+
+    return projections
+
+
+def _run(resources, args, x_region, y_region, z_region, runs, lanes, vol_nbytes,
+         volume_writer=None, projections=None, journal=None, executor_stats=None):
+    """Execute all passes in *runs* on all possible GPUs and optimize the read projection regions.
+    Passes are pipelined, i.e. every lane from *lanes* (see :func:`make_lanes`) is processed by a
+    separate thread which starts the region of the next pass as soon as the previous one is
+    finished, without waiting for the other GPUs. The graph of the next region (including reading of
+    in-memory input) is set up and its tif input is prefetched (see :meth:`Executor.prefetch`) while
+    the previous one is running. If args.region_scheduling is 'dynamic', the regions from *runs*
+    only determine the maximum number of slices of every lane, which takes its regions from a shared
+    :class:`RegionQueue` until the volume is done. If *volume_writer* is given, every executor
+    writes its slices to their position in the volume given by *z_region*, otherwise single-file
+    output is written in order by a :class:`ReorderWriter` or, if args.output_mmap is True, directly
+    to its position by a :class:`MappedTiffWriter`. If *projections* are given, they are used
+    instead of reading and preprocessing the input. Otherwise, if args.shared_reader is True and
+    regions are scheduled statically, the rows needed by all regions of a pass are read and
+    preprocessed only once (see :class:`SharedProjections`). If *journal* (a :class:`RegionJournal`)
+    is given, regions which it contains are skipped and finished regions written to separate files
+    are added to it (slices written by *volume_writer* are added by the writer itself). If
+    *executor_stats* is a list, statistics of every finished executor (see :attr:`Executor.stats`)
+    are appended to it.
+    """
+    writer = None
+    input_nbytes = None
+    if executor_stats is not None and not args.dry_run:
+        input_nbytes = get_input_nbytes(args.projections)
+    region_queue = None
+    done = journal.get_done_slices() if journal and volume_writer else set()
+    if args.region_scheduling == 'dynamic':
+        if journal and journal.resumed and not volume_writer:
+            LOG.warning('Resuming per-region output works only with static region scheduling, '
+                        'reconstructing the regions again')
+            journal.discard()
+        region_queue = RegionQueue(z_region, len(lanes), done=done)
+
+    def get_slice_range(region):
+        start = int(round((region[0] - z_region[0]) / z_region[2]))
+
+        return (start, start + len(np.arange(*region)))
+
+    def is_done(region_index, region):
+        if not journal:
+            return False
+        start, stop = get_slice_range(region)
+        if volume_writer:
+            return all(index in done for index in range(start, stop))
+
+        return journal.is_region_done(region_index, start, stop)
+    num_slices = len(np.arange(*z_region))
+    running = []
+
+    if volume_writer:
+        writer = volume_writer
+    elif is_output_single_file(args):
         import tifffile
         bigtiff = vol_nbytes > 2 ** 32 - 2 ** 25
         LOG.debug('Writing BigTiff: %s', bigtiff)
         dirname = os.path.dirname(args.output)
         if dirname and not os.path.exists(dirname):
             os.makedirs(dirname)
-        writer = tifffile.TiffWriter(args.output, append=run_number != 0, bigtiff=bigtiff)
-
-    for index in range(len(regions)):
-        gpu_index, region = regions[index]
-        region_index = run_number * len(resources) + index
-        executors.append(
-            Executor(
-                resources[index],
-                args,
-                region,
-                x_region,
-                y_region,
-                gpu_index,
-                region_index,
-                writer=writer
-            )
+        if args.output_mmap:
+            shape = get_reconstructed_cube_shape(x_region, y_region, z_region)[::-1]
+            writer = MappedTiffWriter(args.output, shape, DTYPE_CL_NUMPY[args.store_type],
+                                      bigtiff=bigtiff)
+        else:
+            pass_size = max(sum(len(np.arange(*region)) for gpu_index, region in regions)
+                            for regions in runs)
+            depth = get_output_buffer_depth(args.output_buffer_depth or pass_size,
+                                            vol_nbytes // num_slices)
+            writer = ReorderWriter(tifffile.TiffWriter(args.output, bigtiff=bigtiff), num_slices,
+                                   depth)
+
+    shared = {}
+    if args.shared_reader and projections is None and not args.dry_run and len(lanes) > 1:
+        if region_queue is None:
+            pass_regions = {}
+            for lane in lanes:
+                for run_number, index, gpu_index, region in lane:
+                    if not is_done(run_number * len(runs[0]) + index, region):
+                        pass_regions.setdefault(run_number, []).append(region)
+            for run_number, regions in pass_regions.items():
+                shared[run_number] = SharedProjections(args, regions)
+        else:
+            LOG.warning('Shared reader works only with static region scheduling')
+
+    def get_lane_regions(lane_index):
+        """Yield (region index, GPU index, region) processed by lane *lane_index*."""
+        if region_queue is None:
+            for run_number, index, gpu_index, region in lanes[lane_index]:
+                region_index = run_number * len(runs[0]) + index
+                if is_done(region_index, region):
+                    LOG.debug('Region %d: %s already done', region_index, region)
+                    continue
+                yield (region_index, gpu_index, region)
+        else:
+            gpu_index = lanes[lane_index][0][2]
+            max_slices = max(len(np.arange(*item[3])) for item in lanes[lane_index])
+            while True:
+                item = region_queue.get(max_slices)
+                if item is None:
+                    return
+                yield (item[0], gpu_index, item[1])
+
+    def make_executor(lane_index, position, item):
+        region_index, gpu_index, region = item
+        return Executor(
+            resources[2 * lane_index + position % 2],
+            args,
+            region,
+            x_region,
+            y_region,
+            gpu_index,
+            region_index,
+            writer=writer,
+            z_offset=get_slice_range(region)[0],
+            projections=projections,
+            input_nbytes=input_nbytes,
+            shared_projections=shared.get(region_index // len(runs[0]))
         )
-        if last:
-            # Chain up waiting events of subsequent executors
-            executors[-1].wait_event = last.finished
-        last = executors[-1]
 
-    def start_one(index):
-        return executors[index].process()
+    def process_lane(lane_index):
+        regions = get_lane_regions(lane_index)
+        item = next(regions, None)
+        if item is None:
+            return
+        executor = make_executor(lane_index, 0, item)
+        executor.setup()
+        position = 0
+        while executor:
+            setup_thread = None
+            next_executor = None
+            item = next(regions, None)
+            if item is not None:
+                next_executor = make_executor(lane_index, position + 1, item)
+                # Set up the graph and read the input of the next region while this one runs
+                setup_thread = Thread(target=next_executor.setup, kwargs={'prefetch': True})
+                setup_thread.daemon = True
+                setup_thread.start()
+            if journal and not writer:
+                # Files of a region with the same index from a previous run are replaced
+                journal.discard(executor.region_index)
+            running.append(executor)
+            try:
+                executor.process()
+            finally:
+                running.remove(executor)
+                if executor.shared_projections:
+                    executor.shared_projections.release()
+                if setup_thread:
+                    if executor.abort_requested:
+                        # Stop prefetching
+                        next_executor.abort_requested = True
+                    setup_thread.join()
+            if executor.abort_requested:
+                break
+            if executor_stats is not None:
+                stats = dict(executor.stats)
+                if region_queue is None:
+                    stats['pass'] = executor.region_index // len(runs[0])
+                executor_stats.append(stats)
+            if journal and not writer:
+                start, stop = get_slice_range(executor.region)
+                pattern = '{}-{:>03}-*'.format(glob.escape(args.output), executor.region_index)
+                journal.add(start, stop, index=executor.region_index,
+                            files=sorted(glob.glob(pattern)))
+            executor = next_executor
+            position += 1
 
     st = time.time()
+    finished = False
 
     try:
-        with ThreadPool(processes=len(regions)) as pool:
+        with ThreadPool(processes=len(lanes)) as pool:
             try:
-                pool.map(start_one, list(range(len(regions))))
+                pool.map(process_lane, list(range(len(lanes))))
+                finished = True
             except KeyboardInterrupt:
                 LOG.info('Processing interrupted')
-                for executor in executors:
+                if region_queue:
+                    region_queue.close()
+                for executor in list(running):
                     executor.abort()
     finally:
-        if writer:
-            writer.close()
+        if writer and not volume_writer:
+            writer.close(abort=not finished)
             LOG.debug('Writer closed')
 
     return time.time() - st
 
 
+def get_input_nbytes(path):
+    """Get the number of bytes of the input files given by *path*, None if there are none."""
+    hdf5_path = split_hdf5_path(path) if path else None
+    filenames = [hdf5_path[0]] if hdf5_path else get_filenames(path)
+    if not filenames:
+        return None
+
+    return sum(os.path.getsize(filename) for filename in filenames)
+
+
+def get_pass_stats(executor_stats):
+    """Summarize *executor_stats* of every pass, executors without a pass (dynamic region
+    scheduling) are summarized as one pass with number None.
+    """
+    passes = {}
+    for stats in executor_stats:
+        passes.setdefault(stats.get('pass'), []).append(stats)
+
+    result = []
+    for number, pass_stats in sorted(passes.items(), key=lambda item: (item[0] is None, item[0])):
+        wall_time = (max(stats['end'] for stats in pass_stats) -
+                     min(stats['start'] for stats in pass_stats))
+        result.append({
+            'number': number,
+            'num_regions': len(pass_stats),
+            'num_slices': sum(stats['num_slices'] for stats in pass_stats),
+            'wall_time': wall_time,
+            'gups': sum(stats['gupdates'] for stats in pass_stats) / wall_time if wall_time else 0,
+        })
+
+    return result
+
+
+def parse_ufo_trace(filenames):
+    """Sum the durations of UFO trace events (Chrome trace event format) from *filenames* per
+    event name. Return a dictionary {name: {'time': seconds, 'count': number of events}}.
+    """
+    totals = {}
+
+    def add(name, duration):
+        total = totals.setdefault(name, {'time': 0., 'count': 0})
+        total['time'] += duration * 1e-6
+        total['count'] += 1
+
+    for filename in filenames:
+        try:
+            with open(filename) as f:
+                trace = json.load(f)
+        except (OSError, ValueError) as exc:
+            LOG.warning("Could not parse trace `%s': %s", filename, exc)
+            continue
+        events = trace.get('traceEvents', []) if isinstance(trace, dict) else trace
+        begins = {}
+        for event in events:
+            phase = event.get('ph')
+            key = (event.get('pid'), event.get('tid'), event.get('name'))
+            if phase == 'X':
+                add(event.get('name'), event.get('dur', 0))
+            elif phase == 'B':
+                begins.setdefault(key, []).append(event['ts'])
+            elif phase == 'E' and begins.get(key):
+                add(event.get('name'), event['ts'] - begins[key].pop())
+
+    return totals
+
+
+def write_perf_report(filename, report):
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=4, default=str)
+    LOG.info("Performance report written to `%s'", filename)
+
+
+def get_output_buffer_depth(depth, slice_nbytes, memory_coeff=0.5):
+    """Limit reorder buffer *depth* (number of slices) so that the buffered slices of size
+    *slice_nbytes* take at most *memory_coeff* of the available host memory.
+    """
+    available = get_available_memory()
+    if available is not None:
+        max_depth = max(1, int(available * memory_coeff // slice_nbytes))
+        if depth > max_depth:
+            LOG.debug('Limiting output buffer depth from %d to %d slices by host memory',
+                      depth, max_depth)
+            depth = max_depth
+    LOG.debug('Output buffer depth: %d slices', depth)
+
+    return depth
+
+
 def setup_graph(args, graph, x_region, y_region, region, source=None, gpu=None, do_output=True,
-                index=0, make_reader=True):
+                index=0, make_reader=True, preprocess=True):
+    """If *preprocess* is False, *source* must provide already preprocessed projections."""
     backproject = get_task('general-backproject', processing_node=gpu)
 
     if do_output:
@@ -244,12 +877,7 @@ def setup_graph(args, graph, x_region, y_region, region, source=None, gpu=None,
         height = tmp
     if args.projection_filter != 'none' and args.projection_crop_after == 'backprojection':
         # Take projection padding into account
-        if fbp_filtering_in_phase_retrieval(args):
-            padding = args.retrieval_padded_width - width
-            padding_from = 'phase retrieval'
-        else:
-            padding = get_filtering_padding(width)
-            padding_from = 'default backproject'
+        padding, padding_from = get_projection_padding(args, width)
         args.center_position_x = [pos + padding / 2 for pos in args.center_position_x]
         if args.z_parameter == 'center-position-x':
             region = [region[0] + padding / 2, region[1] + padding / 2, region[2]]
@@ -289,10 +917,11 @@ def setup_graph(args, graph, x_region, y_region, region, source=None, gpu=None,
     backproject.props.gray_map_min = args.slice_gray_map[0]
     backproject.props.gray_map_max = args.slice_gray_map[1]
 
-    source = create_preprocessing_pipeline(args, graph, source=source,
-                                           processing_node=gpu,
-                                           cone_beam_weight=not args.disable_cone_beam_weight,
-                                           make_reader=make_reader)
+    if preprocess:
+        source = create_preprocessing_pipeline(args, graph, source=source,
+                                               processing_node=gpu,
+                                               cone_beam_weight=not args.disable_cone_beam_weight,
+                                               make_reader=make_reader)
     if source:
         graph.connect_nodes(source, backproject)
     else:
@@ -307,10 +936,40 @@ def setup_graph(args, graph, x_region, y_region, region, source=None, gpu=None,
     return (source, last)
 
 
+def get_projection_padding(args, width):
+    """Get the horizontal padding of filtered projections of *width* which are cropped after
+    backprojection and where it comes from.
+    """
+    if fbp_filtering_in_phase_retrieval(args):
+        return (args.retrieval_padded_width - width, 'phase retrieval')
+
+    return (get_filtering_padding(width), 'default backproject')
+
+
 def is_output_single_file(args):
     filename = args.output.lower()
 
-    return not args.dry_run and (filename.endswith('.tif') or filename.endswith('.tiff'))
+    return not args.dry_run and (filename.endswith('.tif') or filename.endswith('.tiff') or
+                                 is_output_hdf5(args))
+
+
+def is_output_hdf5(args):
+    filename = args.output.lower()
+
+    return not args.dry_run and (filename.endswith('.h5') or filename.endswith('.hdf5'))
+
+
+def get_geometry_attributes(args, x_region, y_region, z_region):
+    """Get volume geometry from *args* and the reconstructed regions as a dictionary suitable for
+    HDF5 attributes. Angles are in radians.
+    """
+    attrs = {}
+    regions = {'x_region': x_region, 'y_region': y_region, 'z_region': z_region}
+    for name in HDF5_GEOMETRY_ATTRS:
+        value = regions[name] if name in regions else getattr(args, name)
+        attrs[name] = value if isinstance(value, str) else np.array(value, dtype=float)
+
+    return attrs
 
 
 def set_projection_filter_scale(args):
@@ -350,7 +1009,7 @@ def _fill_missing_args(args):
                       len(args.axis_angle_z))
             args.number = len(args.axis_angle_z)
         else:
-            num_files = len(get_filenames(args.projections))
+            num_files = get_num_images(args.projections)
             if not num_files:
                 raise RuntimeError("No files found in `{}'".format(args.projections))
             LOG.debug("--number not specified, using number of files matching "
@@ -393,14 +1052,99 @@ def _are_values_equal(values):
     return np.all(np.array(values) == values[0])
 
 
+def get_optimized_args(args, region):
+    """Get a copy of *args* with the projection rows optimized for *region* and True if they were
+    optimized, False if the projections must not be cropped.
+    """
+    geometry = CTGeometry(args)
+    optimized = False
+    if (len(args.center_position_z) == 1 and np.modf(args.center_position_z[0])[0] == 0 and
+            geometry.is_simple_parallel_tomo):
+        LOG.info('Simple tomography with integer z center, changing to center_position_z + 0.5 '
+                 'to avoid interpolation')
+        geometry.args.center_position_z = (geometry.args.center_position_z[0] + 0.5,)
+    if not args.disable_projection_crop:
+        if not args.dry_run and (args.y or args.height or args.transpose_input):
+            LOG.debug('--y or --height or --transpose-input specified, '
+                      'not optimizing projection region')
+        else:
+            geometry.optimize_args(region=region)
+            optimized = True
+
+    return (geometry.args, optimized)
+
+
+class SharedProjections(object):
+    """Projection rows needed by all *regions* of one pass given by *args*. They are read and
+    preprocessed only once by the first executor which needs them and kept until all executors of
+    the pass are done, in host memory if they fit, otherwise in a temporary file in
+    args.projection_cache_directory (see :func:`make_projection_cache`). Only if they do not fit
+    there either, the executors read the input themselves.
+    """
+    def __init__(self, args, regions):
+        self.args = args
+        self.y = None
+        self.height = None
+        self.projections = None
+        self._loaded = False
+        self._users = len(regions)
+        self._lock = Lock()
+        starts = []
+        stops = []
+        for region in regions:
+            opt_args, optimized = get_optimized_args(args, region)
+            if optimized:
+                starts.append(opt_args.y)
+                stops.append(opt_args.y + opt_args.height)
+        if starts:
+            self.y = min(starts)
+            self.height = max(stops) - self.y
+
+    def get(self, resources, gpu_index):
+        """Get the preprocessed projections, read them on GPU *gpu_index* from *resources* if this
+        is the first call. Return a tuple (projections, True if they were read by this call).
+        """
+        with self._lock:
+            if self._loaded or self.height is None:
+                return (self.projections, False)
+            LOG.debug('Reading projection rows %d - %d for %d regions', self.y,
+                      self.y + self.height, self._users)
+            self.projections = make_projection_cache(self.args, resources, gpu_index, mode='ram',
+                                                     y=self.y, height=self.height)
+            self._loaded = True
+            if self.projections is None:
+                LOG.info('Shared projection rows do not fit into host memory nor on disk, '
+                         'every region reads its input')
+            elif isinstance(self.projections, np.memmap):
+                LOG.info('Shared projection rows do not fit into host memory, sharing them '
+                         'from a temporary file')
+
+            return (self.projections, True)
+
+    def release(self):
+        """Release the projections after the last executor is done with them."""
+        with self._lock:
+            self._users -= 1
+            if self._users <= 0:
+                self.projections = None
+
+
 class Executor(object):
     """Reconstructs one region.
 
-    :param writer: if not None, we'll be writing to a file shared with other executors and need to
-    use *wait_event* to make sure we write our region when the previous executors are finished.
+    :param writer: if not None, we'll be writing to a file shared with other executors, either a
+    :class:`ReorderWriter` or a :class:`HDF5VolumeWriter`, which accept slices in any order.
+    :param z_offset: index of our first slice in *writer*.
+    :param projections: if not None, stack of preprocessed projections which are used instead of
+    reading and preprocessing the input.
+    :param input_nbytes: size of the whole input in bytes for estimating the read bytes in
+    :attr:`.stats`.
+    :param shared_projections: if not None, :class:`SharedProjections` of the pass, from which the
+    projection rows are taken instead of reading and preprocessing the input.
     """
     def __init__(self, resources, args, region, x_region, y_region, gpu_index, region_index,
-                 writer=None):
+                 writer=None, z_offset=None, projections=None, input_nbytes=None,
+                 shared_projections=None):
         self.resources = resources
         self.args = args
         self.region = region
@@ -409,48 +1153,135 @@ class Executor(object):
         self.y_region = y_region
         self.region_index = region_index
         self.writer = writer
+        self.z_offset = z_offset
+        self.projections = projections
+        self.input_nbytes = input_nbytes
+        self.shared_projections = shared_projections
+        # Performance statistics, times in seconds
+        self.stats = {'region_index': region_index, 'gpu_index': int(gpu_index),
+                      'region': [float(value) for value in region],
+                      'num_slices': len(np.arange(*region)),
+                      'setup_time': 0., 'output_wait_time': 0., 'write_time': 0.}
         self.output = Ufo.OutputTask() if self.writer else None
         self.scheduler = None
-        self.wait_event = None
-        self.finished = Event()
+        self.graph = None
         self.abort_requested = False
 
-    def process(self):
+    def setup(self, prefetch=False):
+        """Create the scheduler and the graph, can be called before :meth:`.process` in order to
+        set up the region while the previous one is still being processed. If *prefetch* is True,
+        the input of the region is read in advance as well (see :meth:`.prefetch`).
+        """
+        st = time.time()
         self.scheduler = Ufo.FixedScheduler()
         if hasattr(self.scheduler.props, 'enable_tracing'):
             LOG.debug("Use tracing: {}".format(self.args.enable_tracing))
             self.scheduler.props.enable_tracing = self.args.enable_tracing
         self.scheduler.set_resources(self.resources)
-        graph = Ufo.TaskGraph()
+        self.graph = Ufo.TaskGraph()
         gpu = self.scheduler.get_resources().get_gpu_nodes()[self.gpu_index]
-        geometry = CTGeometry(self.args)
-        if (len(self.args.center_position_z) == 1 and
-                np.modf(self.args.center_position_z[0])[0] == 0 and
-                geometry.is_simple_parallel_tomo):
-            LOG.info('Simple tomography with integer z center, changing to center_position_z + 0.5 '
-                     'to avoid interpolation')
-            geometry.args.center_position_z = (geometry.args.center_position_z[0] + 0.5,)
-        if not self.args.disable_projection_crop:
-            if not self.args.dry_run and (self.args.y or self.args.height or
-                                          self.args.transpose_input):
-                LOG.debug('--y or --height or --transpose-input specified, '
-                          'not optimizing projection region')
-            else:
-                geometry.optimize_args(region=self.region)
-        opt_args = geometry.args
+        opt_args, optimized = get_optimized_args(self.args, self.region)
+        projections = self.projections
+        # First row of *projections* in the input
+        y_offset = 0
+        read_height = None
+        if projections is None and self.shared_projections and optimized:
+            projections, loaded = self.shared_projections.get(self.resources, self.gpu_index)
+            # The padded width may have been computed only by reading the shared projections
+            opt_args.retrieval_padded_width = self.args.retrieval_padded_width
+            y_offset = self.shared_projections.y
+            if projections is not None:
+                read_height = self.shared_projections.height if loaded else 0
         if self.args.dry_run:
             source = get_task('dummy-data', number=self.args.number, width=self.args.width,
                               height=self.args.height)
+        elif projections is not None:
+            source = get_memory_in(projections)
+            if optimized:
+                # Preprocessed projections are not cropped to our region
+                crop = get_task('crop', processing_node=gpu, y=opt_args.y - y_offset,
+                                height=opt_args.height)
+                self.graph.connect_nodes(source, crop)
+                source = crop
         else:
             source = None
-        last = setup_graph(opt_args, graph, self.x_region, self.y_region, self.region,
+        last = setup_graph(opt_args, self.graph, self.x_region, self.y_region, self.region,
                            source=source, gpu=gpu, index=self.region_index, make_reader=True,
-                           do_output=self.writer is None)[-1]
+                           do_output=self.writer is None,
+                           preprocess=projections is None)[-1]
         if self.writer:
-            graph.connect_nodes(last, self.output)
+            self.graph.connect_nodes(last, self.output)
+        self._update_stats(opt_args, projections=projections, read_height=read_height)
+        self.stats['setup_time'] = time.time() - st
+        if prefetch and projections is None and not self.args.dry_run:
+            self.prefetch(opt_args)
+
+    def prefetch(self, opt_args):
+        """Read the input rows given by *opt_args* into the operating system's cache without
+        decoding them (see :func:`.util.prefetch_rows`), so that the read task does not wait for
+        the storage once the region is processed. Only tif input which fits into half of the
+        available host memory is prefetched.
+        """
+        path = self.args.projections
+        if is_hdf5_path(path) or not is_tiff_input(path):
+            return
+        st = time.time()
+        available = get_available_memory()
+        indices = range(self.args.start, self.args.start + self.args.number * self.args.step,
+                        self.args.step)
+        try:
+            self.stats['prefetch_bytes'] = prefetch_rows(
+                path, y=opt_args.y, height=opt_args.height, indices=indices,
+                max_bytes=available // 2 if available else None,
+                abort=lambda: self.abort_requested)
+        except Exception as exc:
+            LOG.debug('Prefetching input of region %s failed: %s', self.region, exc)
+            return
+        self.stats['prefetch_time'] = time.time() - st
+        LOG.debug('Prefetched %.2f MB of region %s in %.2f s',
+                  self.stats['prefetch_bytes'] / 2. ** 20, self.region,
+                  self.stats['prefetch_time'])
+
+    def _update_stats(self, opt_args, projections=None, read_height=None):
+        """Compute the data sizes of the region from the optimized *opt_args*. *projections* are
+        the preprocessed ones used instead of the input, if *read_height* is not None, it is the
+        number of input rows read by this executor.
+        """
+        slice_width, slice_height = get_reconstructed_cube_shape(self.x_region, self.y_region,
+                                                                 [0, 1, 1])[:2]
+        num_voxels = self.stats['num_slices'] * slice_width * slice_height
+        self.stats['write_bytes'] = num_voxels * DTYPE_CL_SIZE[self.args.store_type]
+        self.stats['gupdates'] = num_voxels * self.args.number * 1e-9
+        self.stats['read_bytes'] = 0
+        if read_height is not None:
+            if self.input_nbytes:
+                full_height = determine_shape(self.args, self.args.projections)[1]
+                self.stats['read_bytes'] = self.input_nbytes * read_height // full_height
+        elif projections is not None:
+            self.stats['read_bytes'] = (projections.nbytes * opt_args.height //
+                                        projections.shape[1])
+        elif self.input_nbytes:
+            full_height = determine_shape(self.args, self.args.projections)[1]
+            self.stats['read_bytes'] = self.input_nbytes * opt_args.height // full_height
+
+    def process(self):
+        if not self.graph:
+            self.setup()
+        if self.abort_requested:
+            return 0
 
         LOG.debug('Device: %d, region: %s', self.gpu_index, self.region)
-        thread = Thread(target=self.scheduler.run, args=(graph,))
+        self.stats['start'] = time.time()
+        # Exceptions of the scheduler thread are re-raised here, e.g. for the memory probe
+        errors = []
+
+        def run(graph):
+            try:
+                self.scheduler.run(graph)
+            except Exception as exc:
+                errors.append(exc)
+
+        thread = Thread(target=run, args=(self.graph,))
         thread.setDaemon(True)
         thread.start()
 
@@ -458,25 +1289,37 @@ class Executor(object):
             self.consume()
 
         thread.join()
+        # Release the graph and its buffers before the next region on this device starts
+        self.graph = None
+        if errors:
+            raise errors[0]
+        check_read_errors()
+        self.stats['end'] = time.time()
+        wall_time = self.stats['end'] - self.stats['start']
+        write_time = self.stats['write_time'] if self.writer else wall_time
+        self.stats['wall_time'] = wall_time
+        self.stats['ufo_time'] = self.scheduler.props.time
+        self.stats['gups'] = self.stats['gupdates'] / wall_time if wall_time else 0
+        self.stats['read_rate'] = self.stats['read_bytes'] / wall_time if wall_time else 0
+        self.stats['write_rate'] = self.stats['write_bytes'] / write_time if write_time else 0
 
         return self.scheduler.props.time
 
     def consume(self):
         import ufo.numpy
 
-        if self.wait_event:
-            LOG.debug('Executor of region %s waiting for writing', self.region)
-            self.wait_event.wait()
-
-        for i in np.arange(*self.region):
+        for i in range(len(np.arange(*self.region))):
             if self.abort_requested:
                 LOG.debug('Abort requested in writing of region %s', self.region)
                 return
+            st = time.time()
             buf = self.output.get_output_buffer()
-            self.writer.save(ufo.numpy.asarray(buf))
+            self.stats['output_wait_time'] += time.time() - st
+            st = time.time()
+            self.writer.save(ufo.numpy.asarray(buf), self.z_offset + i)
+            self.stats['write_time'] += time.time() - st
             self.output.release_output_buffer(buf)
 
-        self.finished.set()
         LOG.debug('Executor of region %s finished writing', self.region)
 
     def abort(self):
@@ -485,6 +1328,400 @@ class Executor(object):
             self.scheduler.abort()
 
 
+class RegionJournal(object):
+    """Journal of finished parts of the volume stored as JSON in *filename*, which allows a rerun
+    with the same *parameters* to skip them. An entry is either a region with its index and the
+    files written for it or a range of slices written to a shared volume file. Regions are valid
+    only for the same *layout* (see :func:`get_journal_layout`). If *resume* is True, entries of
+    a previous run with the same parameters (and layout for regions) whose files are intact are
+    kept and the files of the regions which are not kept are removed, so that no stale regions
+    remain next to the new ones. Otherwise, the journal starts empty and no files are removed.
+    """
+    def __init__(self, filename, parameters, layout=None, resume=False):
+        self.filename = filename
+        self.parameters = parameters
+        self.layout = layout
+        self.resume = resume
+        self.entries = self._load(resume)
+        self._lock = Lock()
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self._write()
+
+    @property
+    def resumed(self):
+        return bool(self.entries)
+
+    def _load(self, resume):
+        if not os.path.exists(self.filename):
+            if resume:
+                LOG.info("Journal `%s' does not exist, reconstructing everything", self.filename)
+            return []
+        try:
+            with open(self.filename) as f:
+                journal = json.load(f)
+        except (OSError, ValueError) as exc:
+            LOG.warning("Could not load journal `%s': %s", self.filename, exc)
+            return []
+        previous = journal.get('entries', [])
+        if not resume:
+            entries = []
+        elif journal.get('parameters') != self.parameters:
+            LOG.warning("Journal `%s' belongs to a run with different parameters, "
+                        "reconstructing everything", self.filename)
+            entries = []
+        else:
+            entries = [entry for entry in previous if _are_files_intact(entry.get('files', {}))]
+            if journal.get('layout') != self.layout:
+                regions = [entry for entry in entries if 'index' in entry]
+                if regions:
+                    LOG.warning("Regions in journal `%s' have a different layout, "
+                                "reconstructing them again", self.filename)
+                    entries = [entry for entry in entries if 'index' not in entry]
+            LOG.info('Resuming, %d of %d journal entries are valid', len(entries), len(previous))
+        if resume:
+            for entry in previous:
+                if 'index' in entry and entry not in entries:
+                    _remove_files(entry.get('files', {}))
+
+        return entries
+
+    def _write(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump({'parameters': self.parameters, 'layout': self.layout,
+                       'entries': self.entries}, f)
+        os.replace(tmp_filename, self.filename)
+
+    def add(self, start, stop, index=None, files=None):
+        """Add finished slices from *start* to *stop*, belonging to region *index* which was
+        written to *files* if given.
+        """
+        entry = {'start': int(start), 'stop': int(stop)}
+        if index is not None:
+            entry['index'] = index
+        if files is not None:
+            entry['files'] = {name: os.path.getsize(name) for name in files}
+        with self._lock:
+            self.entries.append(entry)
+            self._write()
+
+    def discard(self, index=None):
+        """Remove region *index* (all regions if None) and, when resuming, its files."""
+        with self._lock:
+            entries = []
+            for entry in self.entries:
+                if 'index' in entry and index in (None, entry['index']):
+                    if self.resume:
+                        _remove_files(entry.get('files', {}))
+                else:
+                    entries.append(entry)
+            if len(entries) != len(self.entries):
+                self.entries = entries
+                self._write()
+
+    def clear(self):
+        with self._lock:
+            self.entries = []
+            self._write()
+
+    def get_done_slices(self):
+        return set(itertools.chain.from_iterable(range(entry['start'], entry['stop'])
+                                                 for entry in self.entries))
+
+    def is_region_done(self, index, start, stop):
+        return any(entry.get('index') == index and entry['start'] == start and
+                   entry['stop'] == stop for entry in self.entries)
+
+
+def _are_files_intact(files):
+    """Check if all *files* (a dictionary of file names and sizes) exist and have their sizes."""
+    return all(os.path.exists(name) and os.path.getsize(name) == size
+               for (name, size) in files.items())
+
+
+def _remove_files(files):
+    """Remove *files* (a dictionary of file names and sizes) which exist and have their sizes."""
+    for name in files:
+        if _are_files_intact({name: files[name]}):
+            LOG.debug("Removing stale region file `%s'", name)
+            os.remove(name)
+
+
+def get_journal_parameters(args):
+    """Get the arguments from *args* which determine the reconstructed volume as a dictionary
+    which survives a JSON round trip.
+    """
+    parameters = {key: value for (key, value) in vars(args).items()
+                  if not key.startswith('_') and key not in JOURNAL_IGNORED_ARGS}
+
+    return json.loads(json.dumps(parameters, sort_keys=True, default=str))
+
+
+def get_journal_layout(args, runs):
+    """Get the arguments from *args* which determine how the volume is split into regions and
+    the resulting *runs* (see :func:`make_runs`) as a dictionary which survives a JSON round trip.
+    """
+    layout = {key: getattr(args, key, None) for key in JOURNAL_LAYOUT_ARGS}
+    layout['runs'] = [[[gpu_index, region] for (gpu_index, region) in regions]
+                      for regions in runs]
+
+    return json.loads(json.dumps(layout, sort_keys=True, default=str))
+
+
+class DeviceMemoryModel(object):
+    """Analytic model of the device memory needed by the reconstruction graph of one region.
+    *fixed* is the number of bytes which do not depend on the number of slices (projection
+    buffers of the preprocessing and the backprojection), *per_slice* is the number of bytes
+    needed by one slice. *scales* maps device keys (see :func:`get_device_key`) to calibration
+    factors of the estimate, devices without one use 1.
+    """
+    def __init__(self, fixed, per_slice, scales=None):
+        self.fixed = fixed
+        self.per_slice = per_slice
+        self.scales = scales or {}
+
+    def get_num_slices(self, gpu, memory_coeff=0.8, num_threads=1, scale=None):
+        """Get the number of slices *num_threads* graphs can reconstruct on *gpu* together if
+        they may use *memory_coeff* of its memory. If *scale* is None, use the device's one.
+        """
+        if scale is None:
+            scale = self.scales.get(get_device_key(gpu), 1.)
+        max_mem = gpu.get_info(Ufo.GpuNodeInfo.GLOBAL_MEM_SIZE)
+        available = max_mem * memory_coeff / scale - num_threads * self.fixed
+
+        return max(0, int(available // self.per_slice))
+
+
+class RegionQueue(object):
+    """Hand out consecutive regions of *z_region* to *num_consumers* threads in z order. A region
+    has at most 1 / *num_consumers* of the remaining slices (guided self-scheduling), so the
+    regions get smaller towards the end and all threads finish at about the same time, but not
+    smaller than *min_fraction* of the maximum region size of a thread because every region needs
+    its own graph. Slice indices from *done* are skipped.
+    """
+    def __init__(self, z_region, num_consumers, done=None, min_fraction=0.25):
+        self.z_region = z_region
+        self.num_slices = len(np.arange(*z_region))
+        self.num_consumers = num_consumers
+        self.done = done or set()
+        self.min_fraction = min_fraction
+        self._next = 0
+        self._index = 0
+        self._closed = False
+        self._lock = Lock()
+
+    def get(self, max_slices):
+        """Get the next (region index, region) with at most *max_slices* slices or None if the
+        volume is done.
+        """
+        with self._lock:
+            while self._next < self.num_slices and self._next in self.done:
+                self._next += 1
+            remaining = self.num_slices - self._next - len([i for i in self.done
+                                                            if i >= self._next])
+            if self._closed or not remaining or max_slices < 1:
+                return None
+            current = max((remaining - 1) // self.num_consumers + 1,
+                          int(np.ceil(max_slices * self.min_fraction)))
+            current = min(max_slices, current, self.num_slices - self._next)
+            for i in range(1, current):
+                if self._next + i in self.done:
+                    # Stop in front of finished slices
+                    current = i
+                    break
+            start, stop, step = self.z_region
+            region = [start + self._next * step, start + (self._next + current) * step, step]
+            index = self._index
+            self._next += current
+            self._index += 1
+
+        return (index, region)
+
+    def close(self):
+        """Do not hand out any more regions."""
+        with self._lock:
+            self._closed = True
+
+
+class ReorderWriter(object):
+    """Write slices which are saved by multiple executors in any order to *writer* (e.g. a
+    tifffile.TiffWriter) in their order by a dedicated thread. *num_slices* will be saved in total
+    and at most *depth* of them are buffered, saving a slice blocks while the buffer is full unless
+    the slice is the one which is written next. Saved images are copied, so their memory may be
+    reused afterwards.
+    """
+    def __init__(self, writer, num_slices, depth):
+        self.writer = writer
+        self.num_slices = num_slices
+        self.depth = max(1, depth)
+        self._buffer = {}
+        self._next = 0
+        self._aborted = False
+        self._error = None
+        self._condition = Condition()
+        self._thread = Thread(target=self._write)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, image, index):
+        """Save *image* as slice *index*."""
+        with self._condition:
+            while (not self._aborted and index != self._next and
+                   len(self._buffer) >= self.depth):
+                self._condition.wait()
+            if self._aborted:
+                return
+            # Reserve the place and copy outside of the lock
+            self._buffer[index] = None
+        image = np.array(image)
+        with self._condition:
+            self._buffer[index] = image
+            self._condition.notify_all()
+
+    def _write(self):
+        while True:
+            with self._condition:
+                while (not self._aborted and self._next < self.num_slices and
+                       self._buffer.get(self._next) is None):
+                    self._condition.wait()
+                if self._aborted or self._next == self.num_slices:
+                    return
+                image = self._buffer.pop(self._next)
+                self._next += 1
+                self._condition.notify_all()
+            try:
+                self.writer.write(image)
+            except Exception as exc:
+                LOG.error('Writing slice %d failed: %s', self._next - 1, exc)
+                with self._condition:
+                    self._error = exc
+                    self._aborted = True
+                    self._condition.notify_all()
+                return
+
+    def abort(self):
+        """Stop writing and release blocked executors."""
+        with self._condition:
+            self._aborted = True
+            self._condition.notify_all()
+
+    def close(self, abort=False):
+        """Wait until all slices are written (unless *abort* is True) and close the writer."""
+        if abort:
+            self.abort()
+        self._thread.join()
+        self.writer.close()
+        if self._error:
+            raise self._error
+
+
+class MappedTiffWriter(object):
+    """Write slices into an uncompressed TIFF file *filename* which is preallocated for the whole
+    volume of *shape* (slices, height, width) and *dtype* and memory-mapped. Slices can be saved in
+    any order from multiple threads, every slice is copied directly to its page, so executors do not
+    wait for each other. *bigtiff* determines if a BigTIFF file is written.
+    """
+    def __init__(self, filename, shape, dtype, bigtiff=False):
+        import tifffile
+
+        # Without photometric, volumes with 3 or 4 slices would be stored as one RGB(A) page
+        self.volume = tifffile.memmap(filename, shape=tuple(shape), dtype=dtype, bigtiff=bigtiff,
+                                      photometric='minisblack')
+        LOG.debug('Memory-mapped TIFF shape: %s, offset: %d', self.volume.shape,
+                  self.volume.offset)
+
+    def save(self, image, index):
+        """Save *image* as slice *index*."""
+        self.volume[index] = image
+
+    def close(self, abort=False):
+        """Flush the written slices to the file and close it, unwritten slices stay zero."""
+        self.volume.flush()
+        # The file is unmapped when the array is garbage collected
+        self.volume = None
+
+
+class HDF5VolumeWriter(object):
+    """Write reconstructed slices into a chunked HDF5 dataset of *shape* (slices, height, width)
+    which is stored as :data:`HDF5_DATASET` in *filename*. Slices can be saved in any order from
+    multiple threads, they are collected until a whole z-layer of chunks is complete and then
+    written at once, so that every chunk is compressed only once. *chunks* is the chunk shape
+    (automatic if None), *compression* is 'none', 'gzip' or 'lzf' and *attrs* is a dictionary of
+    attributes stored with the dataset. If *resume* is True and *filename* contains a matching
+    dataset, it is reused (see :attr:`.resumed`) and slice indices from :attr:`.done` are not
+    written again. *on_write* is called with the start and stop slice index of every chunk layer
+    once it is written to the file.
+    """
+    def __init__(self, filename, shape, dtype, chunks=None, compression=None, attrs=None,
+                 resume=False, on_write=None):
+        import h5py
+
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if compression == 'none':
+            compression = None
+        self.resumed = False
+        if resume and os.path.exists(filename):
+            self._file = h5py.File(filename, 'r+')
+            dataset = self._file.get(HDF5_DATASET)
+            if (dataset is not None and dataset.shape == tuple(shape) and
+                    dataset.dtype == np.dtype(dtype)):
+                self.dataset = dataset
+                self.resumed = True
+            else:
+                self._file.close()
+        if not self.resumed:
+            self._file = h5py.File(filename, 'w')
+            self.dataset = self._file.create_dataset(HDF5_DATASET, shape=tuple(shape),
+                                                     dtype=dtype,
+                                                     chunks=tuple(chunks) if chunks else True,
+                                                     compression=compression)
+            for key, value in (attrs or {}).items():
+                self.dataset.attrs[key] = value
+        self.on_write = on_write
+        self.done = set()
+        self._pending = {}
+        self._lock = Lock()
+        LOG.debug('HDF5 dataset shape: %s, chunks: %s, compression: %s',
+                  self.dataset.shape, self.dataset.chunks, compression)
+
+    def save(self, image, index):
+        """Save *image* as slice *index*."""
+        if index in self.done:
+            return
+        depth = self.dataset.chunks[0]
+        start = index // depth * depth
+        stop = min(start + depth, self.dataset.shape[0])
+        with self._lock:
+            if start not in self._pending:
+                self._pending[start] = [np.empty((stop - start,) + self.dataset.shape[1:],
+                                                 dtype=self.dataset.dtype), set()]
+            layer, indices = self._pending[start]
+            layer[index - start] = image
+            indices.add(index)
+            if len(indices) < stop - start:
+                return
+            del self._pending[start]
+
+        self.dataset[start:stop] = layer
+        if self.on_write:
+            self._file.flush()
+            self.on_write(start, stop)
+
+    def close(self):
+        """Write incomplete chunk layers (e.g. after an abort) and close the file."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        for start, (layer, indices) in pending.items():
+            for index in sorted(indices):
+                self.dataset[index] = layer[index - start]
+        self._file.close()
+
+
 class CTGeometry(object):
     def __init__(self, args):
         self.args = copy.deepcopy(args)
@@ -564,11 +1801,9 @@ class CTGeometry(object):
             LOG.debug('Computing optimal projection region from all angles')
             indices = list(range(self.args.number))
 
-        for i in indices:
-            extrema_0 = self._compute_one_parameter(region[0], i)
-            extrema_1 = self._compute_one_parameter(region[1], i)
-            extrema.append(extrema_0)
-            extrema.append(extrema_1)
+        indices = np.array(indices, dtype=int)
+        extrema = np.concatenate((self._compute_parameter(region[0], indices),
+                                  self._compute_parameter(region[1], indices)))
 
         minima = np.min(extrema, axis=0)
         maxima = np.max(extrema, axis=0)
@@ -579,169 +1814,149 @@ class CTGeometry(object):
 
         return result
 
-    def _compute_one_parameter(self, param_value, index):
-        source_position = np.array([get_scarray_value(self.args.source_position_x, index),
-                                    get_scarray_value(self.args.source_position_y, index),
-                                    get_scarray_value(self.args.source_position_z, index)])
-        axis = Vector(x_angle=get_scarray_value(self.args.axis_angle_x, index),
-                      y_angle=get_scarray_value(self.args.axis_angle_y, index),
-                      z_angle=get_scarray_value(self.args.axis_angle_z, index),
-                      position=[get_scarray_value(self.args.center_position_x, index),
-                                0,
-                                get_scarray_value(self.args.center_position_z, index)])
-        detector = Vector(x_angle=get_scarray_value(self.args.detector_angle_x, index),
-                          y_angle=get_scarray_value(self.args.detector_angle_y, index),
-                          z_angle=get_scarray_value(self.args.detector_angle_z, index),
-                          position=[get_scarray_value(self.args.detector_position_x, index),
-                                    get_scarray_value(self.args.detector_position_y, index),
-                                    get_scarray_value(self.args.detector_position_z, index)])
-        volume_angle = Vector(x_angle=get_scarray_value(self.args.volume_angle_x, index),
-                              y_angle=get_scarray_value(self.args.volume_angle_y, index),
-                              z_angle=get_scarray_value(self.args.volume_angle_z, index))
+    def _get_values(self, name, indices):
+        """Get values of parameter *name* for projection *indices* as an array."""
+        values = getattr(self.args, name)
+        if len(values) == 1:
+            return np.full(len(indices), values[0], dtype=float)
+
+        return np.array(values, dtype=float)[indices]
+
+    def _compute_parameter(self, param_value, indices):
+        """Compute detector regions (x_min, x_max, y_min, y_max) for all projection *indices* at
+        once for z parameter value *param_value*, return them as an array of shape (number of
+        indices, 4).
+        """
+        names = {
+            'source_position': ('source_position_x', 'source_position_y', 'source_position_z'),
+            'axis_angle': ('axis_angle_x', 'axis_angle_y', 'axis_angle_z'),
+            'axis_position': ('center_position_x', None, 'center_position_z'),
+            'detector_angle': ('detector_angle_x', 'detector_angle_y', 'detector_angle_z'),
+            'detector_position': ('detector_position_x', 'detector_position_y',
+                                  'detector_position_z'),
+            'volume_angle': ('volume_angle_x', 'volume_angle_y', 'volume_angle_z')
+        }
+        params = {}
+        for key, coords in names.items():
+            params[key] = np.array([self._get_values(name, indices) if name else
+                                    np.zeros(len(indices)) for name in coords]).T
 
         z = self.args.z
         if self.args.z_parameter == 'z':
             z = param_value
-        elif self.args.z_parameter == 'axis-angle-x':
-            axis.x_angle = param_value
-        elif self.args.z_parameter == 'axis-angle-y':
-            axis.y_angle = param_value
-        elif self.args.z_parameter == 'axis-angle-z':
-            axis.z_angle = param_value
-        elif self.args.z_parameter == 'volume-angle-x':
-            volume_angle.x_angle = param_value
-        elif self.args.z_parameter == 'volume-angle-y':
-            volume_angle.y_angle = param_value
-        elif self.args.z_parameter == 'volume-angle-z':
-            volume_angle.z_angle = param_value
-        elif self.args.z_parameter == 'detector-angle-x':
-            detector.x_angle = param_value
-        elif self.args.z_parameter == 'detector-angle-y':
-            detector.y_angle = param_value
-        elif self.args.z_parameter == 'detector-angle-z':
-            detector.z_angle = param_value
-        elif self.args.z_parameter == 'detector-position-x':
-            detector.position[0] = param_value
-        elif self.args.z_parameter == 'detector-position-y':
-            detector.position[1] = param_value
-        elif self.args.z_parameter == 'detector-position-z':
-            detector.position[2] = param_value
-        elif self.args.z_parameter == 'source-position-x':
-            source_position[0] = param_value
-        elif self.args.z_parameter == 'source-position-y':
-            source_position[1] = param_value
-        elif self.args.z_parameter == 'source-position-z':
-            source_position[2] = param_value
-        elif self.args.z_parameter == 'center-position-x':
-            axis.position[0] = param_value
-        elif self.args.z_parameter == 'center-position-z':
-            axis.position[2] = param_value
         else:
-            raise RuntimeError("Unknown z parameter '{}'".format(self.args.z_parameter))
+            # e.g. axis-angle-x -> params['axis_angle'][:, 0]
+            parameter = self.args.z_parameter.replace('-', '_')
+            if parameter.startswith('center_position'):
+                parameter = parameter.replace('center_position', 'axis_position')
+            key, coord = parameter[:-2], parameter[-1]
+            if key not in params or coord not in 'xyz':
+                raise RuntimeError("Unknown z parameter '{}'".format(self.args.z_parameter))
+            params[key][:, 'xyz'.index(coord)] = param_value
 
         points = get_extrema(self.args.x_region, self.args.y_region, z)
         if self.args.z_parameter != 'z':
             points_upper = get_extrema(self.args.x_region, self.args.y_region, z + 1)
             points = np.hstack((points, points_upper))
-        tomo_angle = float(index) / self.args.number * self.args.overall_angle
-        xe, ye = compute_detector_pixels(points, source_position, axis, volume_angle, detector,
-                                         tomo_angle)
-        return compute_detector_region(xe, ye, (self.args.height, self.args.width),
-                                       overhead=self.args.projection_margin)
-
-
-def project(points, source, detector_normal, detector_offset):
-    """Project *points* onto a detector."""
-    x, y, z = points
-    source_extended = np.tile(source[:, np.newaxis], [1, points.shape[1]])
-    detector_normal_extended = np.tile(detector_normal[:, np.newaxis], [1, points.shape[1]])
-    denom = np.sum((points - source_extended) * detector_normal_extended, axis=0)
-    if np.isinf(source[1]):
-        # Parallel beam
-        if np.any(detector_normal != np.array([0., -1, 0])):
-            # Detector is not perpendicular, compute translation along the beam direction,
-            # otherwise don't compute anything because voxels are mapped directly
-            # to detector coordinates
-            points[1, :] = - (detector_offset +
-                              detector_normal[0] * points[0, :] +
-                              detector_normal[2] * points[2, :]) / detector_normal[1]
-        projected = points
-    else:
-        # Cone beam
-        u = -(detector_offset + np.dot(source, detector_normal)) / denom
-        u = np.tile(u, [3, 1])
-        projected = source_extended + (points - source_extended) * u
-
-    return projected
-
-
-def compute_detector_pixels(points, source_position, axis, volume_rotation, detector, tomo_angle):
-    """*points* are a list of points along x-direcion, thus the array has height 3.
-    *source_position* is a 3-vector, *axis*, *volume_rotation* and *detector* are util.Vector
-    instances.
+        tomo_angles = indices.astype(float) / self.args.number * self.args.overall_angle
+        xe, ye = compute_all_detector_pixels(points, params['source_position'],
+                                             params['axis_angle'], params['axis_position'],
+                                             params['volume_angle'], params['detector_angle'],
+                                             params['detector_position'], tomo_angles)
+
+        return compute_all_detector_regions(xe, ye, (self.args.height, self.args.width),
+                                            overhead=self.args.projection_margin)
+
+
+def compute_all_detector_pixels(points, source_positions, axis_angles, axis_positions,
+                                volume_angles, detector_angles, detector_positions, tomo_angles):
+    """Project *points* onto the detector for N projections at once. *points* have shape (3, number
+    of points), the other arguments except for *tomo_angles* (N values) have shape (N, 3), angles
+    are ordered as (x, y, z). Return x and y detector coordinates, each with shape (N, number of
+    points).
     """
+    num_points = points.shape[1]
     # Rotate the axis
-    detector_normal = np.array((0, -1, 0), dtype=float)
-    detector_normal = rotate_z(detector.z_angle, detector_normal)
-    detector_normal = rotate_y(detector.y_angle, detector_normal)
-    detector_normal = rotate_x(detector.x_angle, detector_normal)
+    detector_normals = np.tile(np.array((0, -1, 0), dtype=float), (len(tomo_angles), 1))
+    detector_normals = rotate_all('z', detector_angles[:, 2], detector_normals)
+    detector_normals = rotate_all('y', detector_angles[:, 1], detector_normals)
+    detector_normals = rotate_all('x', detector_angles[:, 0], detector_normals)
     # Compute d from ax + by + cz + d = 0
-    detector_offset = -np.dot(detector.position, detector_normal)
+    detector_offsets = -np.sum(detector_positions * detector_normals, axis=1)
 
-    if np.isinf(source_position[1]):
-        # Parallel beam
-        voxels = points
-    else:
+    is_parallel = np.isinf(source_positions[:, 1])
+    is_perpendicular = np.all(detector_normals == np.array([0., -1, 0]), axis=1)
+    voxels = np.tile(points, (len(tomo_angles), 1, 1))
+    cone = ~is_parallel
+    if np.any(cone):
         # Apply magnification
-        voxels = -points * source_position[1] / (detector.position[1] - source_position[1])
+        source_y = source_positions[cone, 1][:, np.newaxis, np.newaxis]
+        detector_y = detector_positions[cone, 1][:, np.newaxis, np.newaxis]
+        voxels[cone] = -voxels[cone] * source_y / (detector_y - source_y)
     # Rotate the volume
-    voxels = rotate_z(volume_rotation.z_angle, voxels)
-    voxels = rotate_y(volume_rotation.y_angle, voxels)
-    voxels = rotate_x(volume_rotation.x_angle, voxels)
+    voxels = rotate_all('z', volume_angles[:, 2], voxels)
+    voxels = rotate_all('y', volume_angles[:, 1], voxels)
+    voxels = rotate_all('x', volume_angles[:, 0], voxels)
 
     # Rotate around the axis
-    voxels = rotate_z(tomo_angle, voxels)
+    voxels = rotate_all('z', tomo_angles, voxels)
 
     # Rotate the volume
-    voxels = rotate_z(axis.z_angle, voxels)
-    voxels = rotate_y(axis.y_angle, voxels)
-    voxels = rotate_x(axis.x_angle, voxels)
-
-    # Get the projected pixel
-    projected = project(voxels, source_position, detector_normal, detector_offset)
-
-    if np.any(detector_normal != np.array([0., -1, 0])):
+    voxels = rotate_all('z', axis_angles[:, 2], voxels)
+    voxels = rotate_all('y', axis_angles[:, 1], voxels)
+    voxels = rotate_all('x', axis_angles[:, 0], voxels)
+
+    # Get the projected pixels
+    projected = voxels
+    tilted = is_parallel & ~is_perpendicular
+    if np.any(tilted):
+        # Parallel beam and detector is not perpendicular, compute translation along the beam
+        # direction, otherwise voxels are mapped directly to detector coordinates
+        normals = detector_normals[tilted][:, :, np.newaxis]
+        offsets = detector_offsets[tilted][:, np.newaxis]
+        current = projected[tilted]
+        current[:, 1, :] = - (offsets +
+                              normals[:, 0] * current[:, 0, :] +
+                              normals[:, 2] * current[:, 2, :]) / normals[:, 1]
+        projected[tilted] = current
+    if np.any(cone):
+        sources = np.tile(source_positions[cone][:, :, np.newaxis], [1, 1, num_points])
+        normals = np.tile(detector_normals[cone][:, :, np.newaxis], [1, 1, num_points])
+        denom = np.sum((projected[cone] - sources) * normals, axis=1)
+        u = -(detector_offsets[cone][:, np.newaxis] +
+              np.sum(source_positions[cone] * detector_normals[cone],
+                     axis=1)[:, np.newaxis]) / denom
+        u = np.tile(u[:, np.newaxis, :], [1, 3, 1])
+        projected[cone] = sources + (projected[cone] - sources) * u
+
+    rotated = ~is_perpendicular
+    if np.any(rotated):
         # Detector is not perpendicular
-        projected -= np.array([detector.position]).T
+        current = projected[rotated] - detector_positions[rotated][:, :, np.newaxis]
         # Reverse rotation => reverse order of transformation matrices and negative angles
-        projected = rotate_x(-detector.x_angle, projected)
-        projected = rotate_y(-detector.y_angle, projected)
-        projected = rotate_z(-detector.z_angle, projected)
+        current = rotate_all('x', -detector_angles[rotated, 0], current)
+        current = rotate_all('y', -detector_angles[rotated, 1], current)
+        current = rotate_all('z', -detector_angles[rotated, 2], current)
+        projected[rotated] = current
 
-    x = projected[0, :] + axis.position[0] - 0.5
-    y = projected[2, :] + axis.position[2] - 0.5
+    x = projected[:, 0, :] + axis_positions[:, 0][:, np.newaxis] - 0.5
+    y = projected[:, 2, :] + axis_positions[:, 2][:, np.newaxis] - 0.5
 
     return x, y
 
 
-def compute_detector_region(x, y, shape, overhead=2):
-    """*overhead* specifies how much margin is taken into account around the computed area."""
-    def _compute_outlier(extremum_func, values):
-        if extremum_func == min:
-            round_func = np.floor
-            sgn = -1
-        else:
-            round_func = np.ceil
-            sgn = +1
-
-        return int(round_func(extremum_func(values)) + sgn * overhead)
-
-    x_min = min(shape[1], max(0, _compute_outlier(min, x)))
-    y_min = min(shape[0], max(0, _compute_outlier(min, y)))
-    x_max = max(0, min(shape[1], _compute_outlier(max, x)))
-    y_max = max(0, min(shape[0], _compute_outlier(max, y)))
+def compute_all_detector_regions(x, y, shape, overhead=2):
+    """Compute detector regions of *x* and *y* of shape (N, number of points) with *overhead*
+    pixels of margin clipped to detector *shape*, return an array with rows (x_min, x_max, y_min,
+    y_max) of shape (N, 4).
+    """
+    x_min = np.floor(np.min(x, axis=1)).astype(int) - overhead
+    x_max = np.ceil(np.max(x, axis=1)).astype(int) + overhead
+    y_min = np.floor(np.min(y, axis=1)).astype(int) - overhead
+    y_max = np.ceil(np.max(y, axis=1)).astype(int) + overhead
 
-    return (x_min, x_max, y_min, y_max)
+    return np.array([np.clip(x_min, 0, shape[1]), np.clip(x_max, 0, shape[1]),
+                     np.clip(y_min, 0, shape[0]), np.clip(y_max, 0, shape[0])]).T
 
 
 def get_extrema(x_region, y_region, z):
@@ -753,40 +1968,29 @@ def get_extrema(x_region, y_region, z):
     return np.array(list(product), dtype=float).T.copy()
 
 
-def rotate_x(angle, point):
-    cos = np.cos(angle)
-    sin = np.sin(angle)
-
-    matrix = np.identity(3)
-    matrix[1, 1] = cos
-    matrix[1, 2] = -sin
-    matrix[2, 1] = sin
-    matrix[2, 2] = cos
-
-    return np.dot(matrix, point)
-
-
-def rotate_y(angle, point):
-    cos = np.cos(angle)
-    sin = np.sin(angle)
-
-    matrix = np.identity(3)
-    matrix[0, 0] = cos
-    matrix[0, 2] = sin
-    matrix[2, 0] = -sin
-    matrix[2, 2] = cos
+def get_rotation_matrices(axis, angles):
+    """Get stacked matrices of rotations around *axis* ('x', 'y' or 'z') by *angles*, the result
+    has shape (len(angles), 3, 3).
+    """
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    first, second = {'x': (1, 2), 'y': (2, 0), 'z': (0, 1)}[axis]
 
-    return np.dot(matrix, point)
+    matrices = np.tile(np.identity(3), (len(angles), 1, 1))
+    matrices[:, first, first] = cos
+    matrices[:, first, second] = -sin
+    matrices[:, second, first] = sin
+    matrices[:, second, second] = cos
 
+    return matrices
 
-def rotate_z(angle, point):
-    cos = np.cos(angle)
-    sin = np.sin(angle)
 
-    matrix = np.identity(3)
-    matrix[0, 0] = cos
-    matrix[0, 1] = -sin
-    matrix[1, 0] = sin
-    matrix[1, 1] = cos
+def rotate_all(axis, angles, points):
+    """Rotate *points* around *axis* by *angles*, one angle per stack item. *points* have shape (N,
+    3) or (N, 3, number of points).
+    """
+    matrices = get_rotation_matrices(axis, np.asarray(angles, dtype=float))
+    if points.ndim == 2:
+        return np.matmul(matrices, points[:, :, np.newaxis])[:, :, 0]
 
-    return np.dot(matrix, point)
+    return np.matmul(matrices, points)
@@ -0,0 +1,145 @@
+"""Dataset manifests. A manifest is a sidecar file stored in a directory with tif images, it records
+the file list, number of pages, image shape, data type, data offsets and modification times, so that
+the metadata can be obtained without opening every file in the directory. Manifests are written by
+``tofu index`` and used automatically when they are present and up to date.
+"""
+import json
+import logging
+import os
+from tofu.util import get_cached_metadata, get_filenames
+
+
+LOG = logging.getLogger(__name__)
+MANIFEST_NAME = '.tofu-manifest.json'
+MANIFEST_VERSION = 2
+TIFF_EXTS = ('.tif', '.tiff')
+
+
+def get_manifest_filename(directory):
+    """Return the manifest file name of *directory*."""
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def get_tiff_filenames(directory):
+    """Return sorted tif file names in *directory*."""
+    return [name for name in get_filenames(os.path.join(directory, '*'))
+            if os.path.splitext(name)[1].lower() in TIFF_EXTS]
+
+
+def create_manifest(directory):
+    """Create manifest of tif files in *directory* and return it as a dictionary. The shape and data
+    type of a file are the ones of its first page. Data offsets of pages which cannot be
+    memory-mapped or which differ from the first page in shape or data type (e.g. RGB pages) are
+    None, so that they are always decoded.
+    """
+    import numpy as np
+    import tifffile
+
+    filenames = get_tiff_filenames(directory)
+    if not filenames:
+        raise RuntimeError("No tif files found in `{}'".format(directory))
+
+    def get_dtype(tif, page):
+        return None if page.dtype is None else np.dtype(tif.byteorder + page.dtype.char).str
+
+    files = []
+    for filename in filenames:
+        stat = os.stat(filename)
+        with tifffile.TiffFile(filename) as tif:
+            page = tif.pages[0]
+            shape = (page.imagelength, page.imagewidth)
+            dtype = get_dtype(tif, page)
+            offsets = []
+            for current in tif.pages:
+                uniform = (current.shape == shape and dtype is not None and
+                           get_dtype(tif, current) == dtype)
+                offsets.append(current.dataoffsets[0] if uniform and current.is_memmappable
+                               else None)
+            files.append({'name': os.path.basename(filename),
+                          'mtime_ns': stat.st_mtime_ns,
+                          'size': stat.st_size,
+                          'pages': len(offsets),
+                          'shape': list(shape),
+                          'dtype': dtype,
+                          'offsets': offsets})
+
+    return {'version': MANIFEST_VERSION, 'files': files}
+
+
+def write_manifest(directory):
+    """Create manifest of *directory*, write it to the directory and return its file name."""
+    manifest = create_manifest(directory)
+    filename = get_manifest_filename(directory)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_filename, filename)
+    LOG.debug("Wrote manifest of %d files to `%s'", len(manifest['files']), filename)
+
+    return filename
+
+
+def index_directory(path, recursive=False):
+    """Write manifest for *path* and if *recursive* is True also for all its subdirectories which
+    contain tif files. Return the list of written manifest file names.
+    """
+    if recursive:
+        directories = sorted(root for root, dirs, files in os.walk(path)
+                             if any(os.path.splitext(name)[1].lower() in TIFF_EXTS
+                                    for name in files))
+    else:
+        directories = [path]
+
+    written = []
+    for directory in directories:
+        written.append(write_manifest(directory))
+        LOG.info("Indexed `%s'", directory)
+
+    return written
+
+
+def read_manifest(directory):
+    """Return the manifest of *directory* or None if it does not exist or if the tif files in the
+    directory do not match the ones in the manifest anymore. The manifest is validated only once
+    and reused until the directory changes.
+    """
+    filename = get_manifest_filename(directory)
+
+    def load():
+        try:
+            with open(filename) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != MANIFEST_VERSION:
+            LOG.debug("Ignoring manifest `%s' with unsupported version", filename)
+            return None
+        names = [os.path.basename(name) for name in get_tiff_filenames(directory)]
+        if names != [entry['name'] for entry in manifest['files']]:
+            LOG.debug("Manifest `%s' is outdated, files have been added or removed", filename)
+            return None
+        manifest['entries'] = {entry['name']: entry for entry in manifest['files']}
+
+        return manifest
+
+    # Adding, removing or renaming files (including the manifest) changes the directory
+    return get_cached_metadata('manifest', os.path.abspath(directory), directory, load)
+
+
+def get_manifest_entry(filename):
+    """Return the manifest entry of *filename* or None if there is no valid manifest or if the file
+    has been modified since the manifest was written.
+    """
+    manifest = read_manifest(os.path.dirname(filename) or '.')
+    if manifest is None:
+        return None
+
+    entry = manifest['entries'].get(os.path.basename(filename))
+    if entry is None:
+        return None
+    stat = os.stat(filename)
+    if entry['mtime_ns'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+        LOG.debug("Manifest entry of `%s' is outdated", filename)
+        return None
+
+    return entry
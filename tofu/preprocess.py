@@ -2,10 +2,11 @@
 import sys
 import logging
 from gi.repository import Ufo
-from tofu.util import (fbp_filtering_in_phase_retrieval, get_filenames,
+from tofu.util import (fbp_filtering_in_phase_retrieval, get_num_images,
                        set_node_props, make_subargs, determine_shape, setup_read_task,
-                       setup_padding, next_power_of_two, run_scheduler)
-from tofu.tasks import get_task, get_writer
+                       setup_padding, next_power_of_two, run_scheduler, allocate_projection_cache,
+                       is_module_available)
+from tofu.tasks import get_memory_in, get_reader, get_task, get_writer
 
 
 LOG = logging.getLogger(__name__)
@@ -46,10 +47,6 @@ def create_flat_correct_pipeline(args, graph, processing_node=None):
     if args.projections is None or not args.flats or not args.darks:
         raise RuntimeError("You must specify --projections, --flats and --darks.")
 
-    reader = get_task('read')
-    dark_reader = get_task('read')
-    flat_before_reader = get_task('read')
-
     ffc = get_task('flat-field-correct', processing_node=processing_node,
                    dark_scale=args.dark_scale,
                    flat_scale=args.flat_scale,
@@ -57,20 +54,12 @@ def create_flat_correct_pipeline(args, graph, processing_node=None):
                    fix_nan_and_inf=args.fix_nan_and_inf)
     mode = args.reduction_mode.lower()
     roi_args = make_subargs(args, ['y', 'height', 'y_step'])
-    set_node_props(reader, args)
-    set_node_props(dark_reader, roi_args)
-    set_node_props(flat_before_reader, roi_args)
-
-    for r, path in ((reader, args.projections), (dark_reader, args.darks), (flat_before_reader, args.flats)):
-        setup_read_task(r, path, args)
+    reader = get_reader(args.projections, args)
 
     LOG.debug("Doing flat field correction using reduction mode `{}'".format(mode))
 
     if args.flats2:
-        flat_after_reader = get_task('read')
-        setup_read_task(flat_after_reader, args.flats2, args)
-        set_node_props(flat_after_reader, roi_args)
-        num_files = len(get_filenames(args.projections))
+        num_files = get_num_images(args.projections)
         can_read = len(list(range(args.start, num_files, args.step)))
         number = args.number if args.number else num_files
         num_read = min(can_read, number)
@@ -79,50 +68,79 @@ def create_flat_correct_pipeline(args, graph, processing_node=None):
     if args.resize:
         LOG.debug("Resize input data by factor of {}".format(args.resize))
         proj_bin = get_task('bin', processing_node=processing_node, size=args.resize)
-        dark_bin = get_task('bin', processing_node=processing_node, size=args.resize)
-        flat_bin = get_task('bin', processing_node=processing_node, size=args.resize)
         graph.connect_nodes(reader, proj_bin)
-        graph.connect_nodes(dark_reader, dark_bin)
-        graph.connect_nodes(flat_before_reader, flat_bin)
-
-        reader, dark_reader, flat_before_reader = proj_bin, dark_bin, flat_bin
-
+        reader = proj_bin
+
+    use_cache = not getattr(args, 'disable_flat_cache', False)
+    if use_cache and args.resize and mode == 'median':
+        # Median of binned images is not the binned median
+        LOG.debug('Binning with median reduction, not using the flat cache')
+        use_cache = False
+    if use_cache:
+        from tofu.flatcache import is_supported
+
+        if not all(is_supported(path) for path in (args.darks, args.flats, args.flats2) if path):
+            LOG.debug('Format of darks or flats not supported by the flat cache, not using it')
+            use_cache = False
+
+    if use_cache:
+        dark_reduced = create_reduced_source(args, args.darks, mode, graph,
+                                             processing_node=processing_node)
+        flat_before_reduced = create_reduced_source(args, args.flats, mode, graph,
+                                                    processing_node=processing_node)
         if args.flats2:
-            flat_bin = get_task('bin', processing_node=processing_node, size=args.resize)
-            graph.connect_nodes(flat_after_reader, flat_bin)
-            flat_after_reader = flat_bin
-
-    if mode == 'median':
-        dark_stack = get_task('stack', processing_node=processing_node,
-                              number=len(get_filenames(args.darks)))
-        dark_reduced = get_task('flatten', processing_node=processing_node, mode='median')
-        flat_before_stack = get_task('stack', processing_node=processing_node,
-                                     number=len(get_filenames(args.flats)))
-        flat_before_reduced = get_task('flatten', processing_node=processing_node, mode='median')
-
-        graph.connect_nodes(dark_reader, dark_stack)
-        graph.connect_nodes(dark_stack, dark_reduced)
-        graph.connect_nodes(flat_before_reader, flat_before_stack)
-        graph.connect_nodes(flat_before_stack, flat_before_reduced)
-
+            flat_after_reduced = create_reduced_source(args, args.flats2, mode, graph,
+                                                       processing_node=processing_node)
+    else:
+        dark_reader = get_reader(args.darks, roi_args)
+        flat_before_reader = get_reader(args.flats, roi_args)
         if args.flats2:
-            flat_after_stack = get_task('stack', processing_node=processing_node,
-                                        number=len(get_filenames(args.flats2)))
-            flat_after_reduced = get_task('flatten', processing_node=processing_node,
-                                          mode='median')
-            graph.connect_nodes(flat_after_reader, flat_after_stack)
-            graph.connect_nodes(flat_after_stack, flat_after_reduced)
-    elif mode == 'average':
-        dark_reduced = get_task('average', processing_node=processing_node)
-        flat_before_reduced = get_task('average', processing_node=processing_node)
-        graph.connect_nodes(dark_reader, dark_reduced)
-        graph.connect_nodes(flat_before_reader, flat_before_reduced)
+            flat_after_reader = get_reader(args.flats2, roi_args)
 
-        if args.flats2:
-            flat_after_reduced = get_task('average', processing_node=processing_node)
-            graph.connect_nodes(flat_after_reader, flat_after_reduced)
-    else:
-        raise ValueError('Invalid reduction mode')
+        if args.resize:
+            dark_bin = get_task('bin', processing_node=processing_node, size=args.resize)
+            flat_bin = get_task('bin', processing_node=processing_node, size=args.resize)
+            graph.connect_nodes(dark_reader, dark_bin)
+            graph.connect_nodes(flat_before_reader, flat_bin)
+            dark_reader, flat_before_reader = dark_bin, flat_bin
+
+            if args.flats2:
+                flat_bin = get_task('bin', processing_node=processing_node, size=args.resize)
+                graph.connect_nodes(flat_after_reader, flat_bin)
+                flat_after_reader = flat_bin
+
+        if mode == 'median':
+            dark_stack = get_task('stack', processing_node=processing_node,
+                                  number=get_num_images(args.darks))
+            dark_reduced = get_task('flatten', processing_node=processing_node, mode='median')
+            flat_before_stack = get_task('stack', processing_node=processing_node,
+                                         number=get_num_images(args.flats))
+            flat_before_reduced = get_task('flatten', processing_node=processing_node,
+                                           mode='median')
+
+            graph.connect_nodes(dark_reader, dark_stack)
+            graph.connect_nodes(dark_stack, dark_reduced)
+            graph.connect_nodes(flat_before_reader, flat_before_stack)
+            graph.connect_nodes(flat_before_stack, flat_before_reduced)
+
+            if args.flats2:
+                flat_after_stack = get_task('stack', processing_node=processing_node,
+                                            number=get_num_images(args.flats2))
+                flat_after_reduced = get_task('flatten', processing_node=processing_node,
+                                              mode='median')
+                graph.connect_nodes(flat_after_reader, flat_after_stack)
+                graph.connect_nodes(flat_after_stack, flat_after_reduced)
+        elif mode == 'average':
+            dark_reduced = get_task('average', processing_node=processing_node)
+            flat_before_reduced = get_task('average', processing_node=processing_node)
+            graph.connect_nodes(dark_reader, dark_reduced)
+            graph.connect_nodes(flat_before_reader, flat_before_reduced)
+
+            if args.flats2:
+                flat_after_reduced = get_task('average', processing_node=processing_node)
+                graph.connect_nodes(flat_after_reader, flat_after_reduced)
+        else:
+            raise ValueError('Invalid reduction mode')
 
     graph.connect_nodes_full(reader, ffc, 0)
     graph.connect_nodes_full(dark_reduced, ffc, 1)
@@ -137,6 +155,23 @@ def create_flat_correct_pipeline(args, graph, processing_node=None):
     return ffc
 
 
+def create_reduced_source(args, path, mode, graph, processing_node=None):
+    """Create a task which provides images in *path* reduced by *mode* in the region of interest
+    given by *args* from the flat cache (see :mod:`tofu.flatcache`), binned by args.resize.
+    """
+    from tofu.flatcache import get_reduced
+
+    reduced = get_reduced(path, mode, y=args.y, height=args.height, y_step=args.y_step,
+                          directory=getattr(args, 'flat_cache_directory', None))
+    source = get_memory_in(reduced)
+    if args.resize:
+        binning = get_task('bin', processing_node=processing_node, size=args.resize)
+        graph.connect_nodes(source, binning)
+        source = binning
+
+    return source
+
+
 def create_phase_retrieval_pipeline(args, graph, processing_node=None):
     LOG.debug('Creating phase retrieval pipeline')
     pm = Ufo.PluginManager()
@@ -292,30 +327,122 @@ def create_sinogram_pipeline(args, graph):
         region = (args.start, args.start + args.number, args.step)
         num_projections = len(list(range(*region)))
     else:
-        num_projections = len(get_filenames(args.projections))
+        num_projections = get_num_images(args.projections)
 
     sinos.props.number = num_projections
 
     if args.darks and args.flats:
         start = create_flat_correct_pipeline(args, graph)
     else:
-        start = get_task('read')
-        start.props.path = args.projections
-        set_node_props(start, args)
+        start = get_reader(args.projections, args)
 
     graph.connect_nodes(start, sinos)
 
     return sinos
 
 
+def make_sinograms_from_buffer(args, timeout=10):
+    """Read the projections given by *args* (flat corrected if darks and flats are given) only once,
+    scatter their rows to a buffer of sinograms in host memory or in a memory-mapped temporary file
+    (see args.sinos_cache) and write the sinograms from there. Return None if the buffer does not
+    fit anywhere, otherwise True if the sinograms were written and False if the processing was
+    interrupted. Raise a RuntimeError if the graph finished and no projection arrived for *timeout*
+    seconds before all of them were read, e.g. because it failed.
+    """
+    import ufo.numpy
+    from threading import Thread
+
+    num_projections = len(range(args.start, get_num_images(args.projections),
+                                args.step)[:args.number or None])
+    if not num_projections:
+        raise RuntimeError("No projections found in `{}'".format(args.projections))
+
+    graph = Ufo.TaskGraph()
+    scheduler = Ufo.Scheduler()
+    output = Ufo.OutputTask()
+    if args.darks and args.flats:
+        source = create_flat_correct_pipeline(args, graph)
+    else:
+        source = get_reader(args.projections, args)
+    graph.connect_nodes(source, output)
+
+    # The output buffers are read in a separate thread which does not block us if the graph ends
+    # before providing all of them
+    sinograms = []
+    errors = []
+    num_read = [0]
+
+    def read():
+        try:
+            for i in range(num_projections):
+                buf = output.get_output_buffer()
+                projection = ufo.numpy.asarray(buf)
+                if not sinograms:
+                    # Allocate when the shape after flat correction and binning is known
+                    buffer = allocate_projection_cache((projection.shape[0], num_projections,
+                                                        projection.shape[1]),
+                                                       args.sinos_cache,
+                                                       directory=args.sinos_cache_directory,
+                                                       name='sinograms')
+                    if buffer is None:
+                        output.release_output_buffer(buf)
+                        scheduler.abort()
+                        return
+                    sinograms.append(buffer)
+                sinograms[0][:, i, :] = projection
+                output.release_output_buffer(buf)
+                num_read[0] = i + 1
+        except Exception as exc:
+            errors.append(exc)
+            scheduler.abort()
+
+    thread = Thread(target=read)
+    thread.daemon = True
+    thread.start()
+    if not run_scheduler(scheduler, graph):
+        return False
+    # Wait for the buffers which the graph has already provided
+    last = -1
+    while thread.is_alive() and num_read[0] != last:
+        last = num_read[0]
+        thread.join(timeout)
+    if errors:
+        raise errors[0]
+    if thread.is_alive():
+        raise RuntimeError('Only {} of {} projections were processed'.format(num_read[0],
+                                                                             num_projections))
+    if not sinograms:
+        return None
+
+    graph = Ufo.TaskGraph()
+    args.output_append = False
+    writer = get_writer(args)
+    graph.connect_nodes(get_memory_in(sinograms[0]), writer)
+
+    return run_scheduler(Ufo.Scheduler(), graph)
+
+
 def run_sinogram_generation(args):
-    """Make the sinograms with arguments provided by *args*."""
+    """Make the sinograms with arguments provided by *args*. If there are more passes, the
+    projections are read only once by :func:`make_sinograms_from_buffer` if args.sinos_cache is
+    'ram' or 'disk'.
+    """
     if not args.height:
         args.height = determine_shape(args, args.projections)[1] - args.y
 
     step = args.y_step * args.pass_size if args.pass_size else args.height
     starts = list(range(args.y, args.y + args.height, step)) + [args.y + args.height]
 
+    if len(starts) > 2 and args.sinos_cache != 'none':
+        if not is_module_available('ufo.numpy'):
+            LOG.warning('ufo python support (in ufo-core/python) is needed for reading the '
+                        'projections only once, reading them in every pass')
+        elif make_sinograms_from_buffer(args) is not None:
+            # Done or interrupted
+            return
+        else:
+            LOG.info('Reading the projections in every pass')
+
     def generate_partial(append=False):
         graph = Ufo.TaskGraph()
         sched = Ufo.Scheduler()
@@ -391,11 +518,9 @@ def create_preprocessing_pipeline(args, graph, source=None, processing_node=None
         current = create_flat_correct_pipeline(args, graph, processing_node=processing_node)
     else:
         if make_reader:
-            current = get_task('read')
-            set_node_props(current, args)
             if not args.projections:
                 raise RuntimeError('--projections not set')
-            setup_read_task(current, args.projections, args)
+            current = get_reader(args.projections, args)
         if args.absorptivity:
             absorptivity = get_task('calculate', processing_node=processing_node)
             absorptivity.props.expression = 'v <= 0 ? 0.0f : -log(v)'
@@ -1,14 +1,14 @@
 import os
 import logging
 import glob
-import tempfile
 import sys
 import numpy as np
 from gi.repository import Ufo
 from tofu.preprocess import create_flat_correct_pipeline
-from tofu.util import (set_node_props, setup_read_task, get_filenames,
-                       read_image, determine_shape, setup_padding, run_scheduler)
-from tofu.tasks import get_task, get_writer
+from tofu.util import (set_node_props, setup_read_task, get_filenames, make_region,
+                       read_image, determine_shape, setup_padding, run_scheduler,
+                       correlate_rotation_axis, estimate_rotation_axis)
+from tofu.tasks import get_memory_in, get_memory_out, get_task, get_writer
 
 
 LOG = logging.getLogger(__name__)
@@ -224,6 +224,11 @@ def estimate_center(params):
 
 
 def estimate_center_by_reconstruction(params):
+    """Estimate the center of rotation from the middle sinogram in params.sinograms. In every
+    iteration, slices for params.estimate_num_candidates centers are reconstructed at once in
+    memory and the search range is narrowed around the center whose slice has the lowest integral
+    absolute value, until the candidates are closer than params.estimate_precision.
+    """
     if params.projections is not None:
         raise RuntimeError("Cannot estimate axis from projections")
 
@@ -233,84 +238,85 @@ def estimate_center_by_reconstruction(params):
         raise RuntimeError("No sinograms found in {}".format(params.sinograms))
 
     # Use a sinogram that probably has some interesting data
-    filename = sinos[len(sinos) // 2]
-    sinogram = read_image(filename)
-    initial_width = sinogram.shape[1]
+    sinogram = read_image(sinos[len(sinos) // 2]).astype(np.float32)
+    width = sinogram.shape[1]
     m0 = np.mean(np.sum(sinogram, axis=1))
 
-    center = initial_width / 2.0
-    width = initial_width / 2.0
-    new_center = center
-    tmp_dir = tempfile.mkdtemp()
-    tmp_output = os.path.join(tmp_dir, 'slice-0.tif')
-
-    params.sinograms = filename
-    params.output = os.path.join(tmp_dir, 'slice-%i.tif')
-
-    def heaviside(A):
-        return (A >= 0.0) * 1.0
-
-    def get_score(guess, m0):
-        # Run reconstruction with new guess
-        params.axis = guess
-        tomo(params)
-
-        # Analyse reconstructed slice
-        result = read_image(tmp_output)
-        Q_IA = float(np.sum(np.abs(result)) / m0)
-        Q_IN = float(-np.sum(result * heaviside(-result)) / m0)
-        LOG.info("Q_IA={}, Q_IN={}".format(Q_IA, Q_IN))
-        return Q_IA
-
-    def best_center(center, width):
-        trials = [center + (width / 4.0) * x for x in range(-2, 3)]
-        scores = [(guess, get_score(guess, m0)) for guess in trials]
-        LOG.info(scores)
-        best = sorted(scores, cmp=lambda x, y: cmp(x[1], y[1]))
-        return best[0][0]
+    center = width / 2.0
+    extent = width / 4.0
 
     for i in range(params.num_iterations):
-        LOG.info("Estimate iteration: {}".format(i))
-        new_center = best_center(new_center, width)
-        LOG.info("Currently best center: {}".format(new_center))
-        width /= 2.0
-
-    try:
-        os.remove(tmp_output)
-        os.removedirs(tmp_dir)
-    except OSError:
-        LOG.info("Could not remove {} or {}".format(tmp_output, tmp_dir))
-
-    return new_center
+        step = 2 * extent / (params.estimate_num_candidates - 1)
+        candidates = center - extent + step * np.arange(params.estimate_num_candidates)
+        slices = reconstruct_centers(params, sinogram, candidates)
+        # Q_IA, the integral absolute value of the slice, is minimal for the correct center
+        scores = np.sum(np.abs(slices), axis=(1, 2)) / m0
+        center = float(candidates[np.argmin(scores)])
+        LOG.info("Estimate iteration: {}, best center: {} (candidates {} - {}, step {})".format(
+            i, center, candidates[0], candidates[-1], step))
+        extent = step
+        if step <= params.estimate_precision:
+            break
+
+    return center
+
+
+def reconstruct_centers(params, sinogram, centers):
+    """Reconstruct *sinogram* with all *centers* (equally spaced) in one graph and return the
+    slices as a stack with the same order as *centers*.
+    """
+    number, width = sinogram.shape
+    step = centers[1] - centers[0]
+    g = Ufo.TaskGraph()
+    # Every sinogram row is a projection with height 1
+    source = get_memory_in(sinogram.reshape(number, 1, width))
+    pad = get_task('pad')
+    crop = get_task('crop')
+    setup_padding(pad, width, 1, params.projection_padding_mode, crop=crop)
+    fft = get_task('fft', dimensions=1)
+    fltr = get_task('filter', filter=params.projection_filter,
+                    cutoff=params.projection_filter_cutoff)
+    ifft = get_task('ifft', dimensions=1)
+    bp = get_task('general-backproject')
+    bp.props.parameter = 'center-position-x'
+    bp.props.region = [float(centers[0]), float(centers[0] + (len(centers) - 0.5) * step),
+                       float(step)]
+    bp.props.x_region = make_region(width)
+    bp.props.y_region = make_region(width)
+    bp.props.center_position_x = [float(centers[0])]
+    bp.props.center_position_z = [0.5]
+    bp.props.num_projections = number
+    bp.props.overall_angle = params.angle * number if params.angle else np.pi
+    out = get_memory_out(width, width, number=len(centers))
+
+    g.connect_nodes(source, pad)
+    g.connect_nodes(pad, fft)
+    g.connect_nodes(fft, fltr)
+    g.connect_nodes(fltr, ifft)
+    g.connect_nodes(ifft, crop)
+    g.connect_nodes(crop, bp)
+    g.connect_nodes(bp, out)
+
+    if not run_scheduler(Ufo.Scheduler(), g):
+        raise RuntimeError('Reconstruction of the center candidates was interrupted')
+
+    return out.np_array
 
 
 def estimate_center_by_correlation(params):
-    """Use correlation to estimate center of rotation for tomography."""
-    def flat_correct(flat, radio):
-        nonzero = np.where(radio != 0)
-        result = np.zeros_like(radio)
-        result[nonzero] = flat[nonzero] / radio[nonzero]
-        # log(1) = 0
-        result[result <= 0] = 1
-
-        return np.log(result)
-
-    first = read_image(get_filenames(params.projections)[0]).astype(float)
-    last_index = params.start + params.number if params.number else -1
-    last = read_image(get_filenames(params.projections)[last_index]).astype(float)
-
-    if params.darks and params.flats:
-        dark = read_image(get_filenames(params.darks)[0]).astype(float)
-        flat = read_image(get_filenames(params.flats)[0]) - dark
-        first = flat_correct(flat, first - dark)
-        last = flat_correct(flat, last - dark)
-
-    height = params.height if params.height else -1
-    y_region = slice(params.y, min(params.y + height, first.shape[0]), params.y_step)
-    first = first[y_region, :]
-    last = last[y_region, :]
+    """Use correlation of projections 180 degrees apart to estimate center of rotation for
+    tomography (see :func:`tofu.util.estimate_rotation_axis`).
+    """
+    number = params.number or None
+    overall_angle = 180.
+    if params.angle and number:
+        overall_angle = np.rad2deg(params.angle) * number
 
-    return compute_rotation_axis(first, last)
+    return estimate_rotation_axis(params.projections, number=number, overall_angle=overall_angle,
+                                  num_pairs=params.estimate_num_pairs, start=params.start,
+                                  step=params.step, y=params.y, height=params.height,
+                                  y_step=params.y_step, darks=params.darks, flats=params.flats,
+                                  flats2=params.flats2)
 
 
 def compute_rotation_axis(first_projection, last_projection):
@@ -319,16 +325,4 @@ def compute_rotation_axis(first_projection, last_projection):
     *first_projection* is the projection at 0 deg, *last_projection* is the projection
     at 180 deg.
     """
-    from scipy.signal import fftconvolve
-    width = first_projection.shape[1]
-    first_projection = first_projection - first_projection.mean()
-    last_projection = last_projection - last_projection.mean()
-
-    # The rotation by 180 deg flips the image horizontally, in order
-    # to do cross-correlation by convolution we must also flip it
-    # vertically, so the image is transposed and we can apply convolution
-    # which will act as cross-correlation
-    convolved = fftconvolve(first_projection, last_projection[::-1, :], mode='same')
-    center = np.unravel_index(convolved.argmax(), convolved.shape)[1]
-
-    return (width / 2.0 + center) / 2
+    return correlate_rotation_axis([(first_projection, last_projection)])
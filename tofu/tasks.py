@@ -1,9 +1,13 @@
 import logging
+from threading import Lock
 from gi.repository import Ufo
 
 
 LOG = logging.getLogger(__name__)
 PLUGIN_MANAGER = Ufo.PluginManager()
+# (path, exception) of input tasks which failed to read their data while a graph was running
+READ_ERRORS = []
+READ_ERRORS_LOCK = Lock()
 
 
 def get_task(name, processing_node=None, **kwargs):
@@ -45,11 +49,98 @@ def get_writer(params):
     return writer
 
 
+def get_reader(path, args):
+    """Create a task which reads images from *path* with properties like the region of interest
+    taken from *args*. HDF5 datasets (file.h5:/path/to/dataset) are streamed by
+    :func:`get_hdf5_reader`, everything else is read by the read task.
+    """
+    from tofu.util import is_hdf5_path, set_node_props, setup_read_task
+
+    if is_hdf5_path(path):
+        return get_hdf5_reader(path, args)
+
+    reader = get_task('read')
+    set_node_props(reader, args)
+    setup_read_task(reader, path, args)
+
+    return reader
+
+
+def get_hdf5_reader(path, args, depth=4):
+    """Create an input task which provides images from HDF5 dataset *path* with *args*' region of
+    interest. The images are read block by block (see :func:`tofu.util.read_hdf5_blocks`) by a
+    separate thread while the graph is running, so only one block and *depth* images are held in
+    host memory at once. The first block is read right away so that errors are raised here, later
+    errors end the input stream and are raised by :func:`check_read_errors` once the graph has
+    finished.
+    """
+    import itertools
+    from threading import Thread
+    from tofu.util import read_hdf5_blocks
+
+    try:
+        import ufo.numpy
+    except ImportError:
+        raise RuntimeError('You must install ufo python support (in ufo-core/python) to be able '
+                           'to read HDF5 input')
+
+    blocks = read_hdf5_blocks(path,
+                              y=getattr(args, 'y', 0),
+                              height=getattr(args, 'height', None),
+                              y_step=getattr(args, 'y_step', 1),
+                              start=getattr(args, 'start', 0),
+                              number=getattr(args, 'number', None),
+                              step=getattr(args, 'step', 1))
+    blocks = itertools.chain([next(blocks)], blocks)
+    input_task = Ufo.InputTask()
+
+    def feed():
+        num_buffers = 0
+        try:
+            for block in blocks:
+                for image in block:
+                    if num_buffers < depth:
+                        buf = ufo.numpy.fromarray(image)
+                        num_buffers += 1
+                    else:
+                        # Reuse a buffer which has already been processed
+                        buf = input_task.get_input_buffer()
+                        ufo.numpy.fromarray_inplace(buf, image)
+                    input_task.release_input_buffer(buf)
+        except Exception as exc:
+            with READ_ERRORS_LOCK:
+                READ_ERRORS.append((path, exc))
+        finally:
+            input_task.stop()
+
+    thread = Thread(target=feed)
+    thread.daemon = True
+    thread.start()
+
+    return input_task
+
+
+def check_read_errors():
+    """Raise a RuntimeError if an input task created by :func:`get_hdf5_reader` failed to read its
+    data since the last call. Call this after a graph has finished.
+    """
+    with READ_ERRORS_LOCK:
+        errors = list(READ_ERRORS)
+        del READ_ERRORS[:]
+
+    if errors:
+        path, exc = errors[0]
+        raise RuntimeError("Reading `{}' failed: {}".format(path, exc)) from exc
+
+
 def get_memory_in(array):
+    """Create a memory-in task which provides *array*, either a 2D image or a stack of 2D images
+    along the first axis.
+    """
     import numpy as np
 
-    if array.ndim != 2:
-        raise ValueError("Only 2D images are supported")
+    if array.ndim not in (2, 3):
+        raise ValueError("Only 2D images and 3D stacks of 2D images are supported")
 
     if array.dtype != np.float32 and array.dtype != np.complex64:
         raise ValueError("Only images with float32 or complex64 data type are supported")
@@ -59,9 +150,9 @@ def get_memory_in(array):
     in_task = get_task('memory-in')
     in_task.props.complex_layout = is_complex
     in_task.props.pointer = array.__array_interface__['data'][0]
-    in_task.props.width = 2 * array.shape[1] if is_complex else array.shape[1]
-    in_task.props.height = array.shape[0]
-    in_task.props.number = 1
+    in_task.props.width = 2 * array.shape[-1] if is_complex else array.shape[-1]
+    in_task.props.height = array.shape[-2]
+    in_task.props.number = 1 if array.ndim == 2 else array.shape[0]
     in_task.props.bitdepth = 32
     # We need to extend the survival of *array* beyond this function to the point when the graph is
     # executed, otherwise it will be destroyed and UFO will try to get data from freed memory. Thus,
@@ -72,10 +163,14 @@ def get_memory_in(array):
     return in_task
 
 
-def get_memory_out(width, height):
+def get_memory_out(width, height, number=1):
+    """Create a memory-out task which stores *number* images of *width* x *height* in its np_array
+    attribute, a 2D image if *number* is 1, otherwise a stack of 2D images along the first axis.
+    """
     import numpy as np
 
-    array = np.empty((height, width), dtype=np.float32)
+    shape = (height, width) if number == 1 else (number, height, width)
+    array = np.empty(shape, dtype=np.float32)
     out_task = get_task('memory-out')
     out_task.props.pointer = array.__array_interface__['data'][0]
     out_task.props.max_size = array.nbytes
@@ -0,0 +1,60 @@
+import argparse
+import pytest
+from tofu.bench import compare, get_case_name, make_cases, summarize
+
+
+def get_args(**kwargs):
+    args = argparse.Namespace(bench_sizes=[512, 1024], bench_numbers=[1000],
+                              bench_geometries=['parallel', 'cone'],
+                              bench_phase_retrieval=['off'], bench_store_types=['float'],
+                              bench_region_scheduling=['static'])
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+
+    return args
+
+
+def test_make_cases():
+    cases = make_cases(get_args())
+    assert len(cases) == 4
+    assert {(case['size'], case['geometry']) for case in cases} == {(512, 'parallel'),
+                                                                    (512, 'cone'),
+                                                                    (1024, 'parallel'),
+                                                                    (1024, 'cone')}
+    assert all(case['region_scheduling'] == 'static' for case in cases)
+    assert len({get_case_name(case) for case in cases}) == 4
+
+
+@pytest.mark.parametrize('key, value', [('bench_geometries', ['helical']),
+                                        ('bench_phase_retrieval', ['yes']),
+                                        ('bench_region_scheduling', ['static', 'greedy'])])
+def test_make_cases_invalid(key, value):
+    with pytest.raises(ValueError):
+        make_cases(get_args(**{key: value}))
+
+
+def test_compare():
+    baseline = {'results': [{'name': 'a', 'gups': 10.}, {'name': 'b', 'gups': 10.},
+                            {'name': 'c', 'gups': 10.}]}
+    results = [{'name': 'a', 'gups': 8.9}, {'name': 'b', 'gups': 9.}, {'name': 'c', 'gups': 12.},
+               {'name': 'new', 'gups': 1.}]
+    # Exactly at the threshold is not a regression, names missing in the baseline are skipped
+    assert compare(results, baseline, threshold=0.1) == [('a', 8.9, 10.)]
+    assert compare(results, baseline, threshold=0.5) == []
+    assert compare(results, {'results': []}) == []
+
+
+def test_summarize():
+    case = make_cases(get_args(bench_sizes=[512], bench_geometries=['cone']))[0]
+    executors = [{'setup_time': 1., 'wall_time': 4., 'output_wait_time': 0.5, 'write_time': 2.},
+                 {'setup_time': 2., 'wall_time': 6., 'output_wait_time': 1., 'write_time': 3.}]
+    report = {'executors': executors, 'total_gups': 5., 'ufo_gups': 6., 'total_time': 10.,
+              'ufo_time': 8.}
+    result = summarize(case, report)
+    assert result['name'] == get_case_name(case)
+    assert result['geometry'] == 'cone'
+    assert result['gups'] == 5.
+    assert result['stages'] == {'setup': 3., 'process': 10., 'output_wait': 1.5, 'write': 5.}
+    assert 'trace' not in result
+    report['trace'] = {'backproject': {'time': 1., 'count': 2}}
+    assert summarize(case, report)['trace'] == report['trace']
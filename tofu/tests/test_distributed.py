@@ -0,0 +1,160 @@
+import os
+import sys
+import numpy as np
+import pytest
+import tifffile
+from tofu import config
+from tofu.distributed import (make_arguments, merge_hdf5, merge_region_files, merge_tiff,
+                              parse_worker, run, split_region)
+
+
+# Worker which writes slices with the value of their z coordinate instead of reconstructing
+FAKE_WORKER = '''
+import os
+import sys
+import numpy as np
+import tifffile
+
+arguments = dict(argument[2:].split('=', 1) for argument in sys.argv[1:] if '=' in argument)
+region = np.arange(*[float(value) for value in arguments['region'].split(',')])
+output = arguments['output']
+with open(os.path.join(os.path.dirname(sys.argv[0]), 'calls.txt'), 'a') as f:
+    f.write(' '.join(sys.argv[1:]) + '\\n')
+if output.endswith('.tif'):
+    with tifffile.TiffWriter(output) as writer:
+        for z in region:
+            writer.write(np.full((4, 5), z, dtype=np.float32))
+else:
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    for index, z in enumerate(region):
+        tifffile.imwrite('{}-{:>03}-0000.tif'.format(output, index),
+                         np.full((4, 5), z, dtype=np.float32))
+'''
+
+
+def test_parse_worker():
+    assert parse_worker('localhost') == ('localhost', None)
+    assert parse_worker('host:0,2') == ('host', [0, 2])
+    assert parse_worker('host:') == ('host', [])
+
+
+@pytest.mark.parametrize('region, num_parts', [([0, 10, 1], 3), ([-5, 5, 0.5], 4),
+                                               ([0, 3, 1], 5), ([10, 0, -1], 2)])
+def test_split_region(region, num_parts):
+    parts = split_region(region, num_parts)
+    assert len(parts) <= num_parts
+    values = np.concatenate([np.arange(*part) for part in parts])
+    np.testing.assert_allclose(values, np.arange(*region))
+    sizes = [len(np.arange(*part)) for part in parts]
+    assert len(set(sizes[:-1])) <= 1
+    assert sizes[-1] <= sizes[0]
+
+
+def test_make_arguments():
+    args = config.Params(sections=config.GEN_RECO_PARAMS).get_defaults()
+    args.output = 'out.tif'
+    args.gpus = [0, 1]
+    args.workers = ['localhost']
+    args.center_position_x = [10., 20.]
+    args.dry_run = True
+    args.projections = 'projs'
+    arguments = make_arguments(args)
+    assert '--projections=projs' in arguments
+    assert '--center-position-x=10.0,20.0' in arguments
+    assert '--dry-run' in arguments
+    names = [argument.split('=')[0] for argument in arguments]
+    assert not set(names) & {'--output', '--gpus', '--workers', '--region'}
+    # Options which are not set are not passed
+    assert not any(argument.startswith('--darks') for argument in arguments)
+
+
+def test_merge_region_files(tmp_path):
+    outputs = []
+    for worker in range(2):
+        prefix = str(tmp_path / 'worker-{}'.format(worker) / 'slice')
+        os.makedirs(os.path.dirname(prefix))
+        for region_index in range(worker + 2):
+            for file_index in range(2):
+                name = '{}-{:>03}-{:>04}.tif'.format(prefix, region_index, file_index)
+                with open(name, 'w') as f:
+                    f.write('{} {} {}'.format(worker, region_index, file_index))
+        outputs.append(prefix)
+    output = str(tmp_path / 'out' / 'slice')
+    merge_region_files(outputs, output)
+
+    contents = []
+    for index in range(5):
+        for file_index in range(2):
+            with open('{}-{:>03}-{:>04}.tif'.format(output, index, file_index)) as f:
+                contents.append(f.read())
+    assert contents == ['{} {} {}'.format(worker, region_index, file_index)
+                        for (worker, num_regions) in [(0, 2), (1, 3)]
+                        for region_index in range(num_regions)
+                        for file_index in range(2)]
+
+
+@pytest.mark.parametrize('sizes', [[3, 2], [1, 1, 1, 1, 1], [6], [1, 2], [2, 2]])
+def test_merge_tiff(tmp_path, sizes):
+    outputs = []
+    index = 0
+    for worker, size in enumerate(sizes):
+        outputs.append(str(tmp_path / 'worker-{}.tif'.format(worker)))
+        with tifffile.TiffWriter(outputs[-1]) as writer:
+            for i in range(size):
+                writer.write(np.full((4, 5), index, dtype=np.float32))
+                index += 1
+    output = str(tmp_path / 'out' / 'volume.tif')
+    merge_tiff(outputs, output)
+    with tifffile.TiffFile(output) as tif:
+        assert len(tif.pages) == sum(sizes)
+        for index, page in enumerate(tif.pages):
+            np.testing.assert_array_equal(page.asarray(), np.full((4, 5), index))
+
+
+def test_merge_hdf5(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    from tofu.genreco import HDF5_DATASET
+
+    outputs = []
+    volumes = []
+    for worker, size in enumerate([5, 3]):
+        outputs.append(str(tmp_path / 'worker-{}.h5'.format(worker)))
+        volumes.append(np.random.random((size, 4, 5)).astype(np.float32))
+        with h5py.File(outputs[-1], 'w') as f:
+            dataset = f.create_dataset(HDF5_DATASET, data=volumes[-1], chunks=(2, 4, 5),
+                                       compression='gzip')
+            dataset.attrs['z_region'] = [10 + 5 * worker, 10 + 5 * worker + size, 1]
+    output = str(tmp_path / 'volume.h5')
+    # Small blocks to copy every part in more than one
+    merge_hdf5(outputs, output, chunks=(3, 4, 5), block_nbytes=4 * 5 * 4 * 2)
+    with h5py.File(output, 'r') as f:
+        np.testing.assert_array_equal(f[HDF5_DATASET][:], np.concatenate(volumes))
+        np.testing.assert_array_equal(f[HDF5_DATASET].attrs['z_region'], [10, 18, 1])
+
+
+@pytest.mark.parametrize('output', ['volume.tif', 'slices/slice'])
+def test_run(tmp_path, output):
+    worker = tmp_path / 'worker.py'
+    worker.write_text(FAKE_WORKER)
+    args = config.Params(sections=config.GEN_RECO_PARAMS).get_defaults()
+    args.width = args.height = 8
+    args.region = [-3., 4., 1.]
+    args.output = str(tmp_path / output)
+    args.output_bytes_per_file = '1t' if output.endswith('.tif') else '0'
+    args.workers = ['localhost', '127.0.0.1:1', 'localhost:2,3']
+    args.worker_command = '{} {}'.format(sys.executable, worker)
+    run(args)
+
+    calls = (tmp_path / 'calls.txt').read_text().splitlines()
+    assert len(calls) == 3
+    assert all(call.startswith('reco ') for call in calls)
+    assert sum('--gpus 2 3' in call for call in calls) == 1
+    if output.endswith('.tif'):
+        images = tifffile.imread(args.output)
+    else:
+        images = [tifffile.imread('{}-{:>03}-0000.tif'.format(args.output, index))
+                  for index in range(7)]
+        assert not os.path.exists('{}-007-0000.tif'.format(args.output))
+    np.testing.assert_array_equal([image[0, 0] for image in images], np.arange(-3, 4))
+    # The parts are removed
+    assert not [name for name in os.listdir(str(tmp_path)) if name.startswith('.tofu-workers')]
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import tifffile
+from tofu import find_large_spots
+from tofu.find_large_spots import average_images
+
+
+@pytest.fixture(scope='function')
+def images(tmp_path):
+    data = np.random.randint(0, 1000, size=(5, 12, 7)).astype(np.uint16)
+    with tifffile.TiffWriter(str(tmp_path / 'flats.tif')) as writer:
+        for image in data:
+            writer.write(image)
+
+    return (str(tmp_path / 'flats.tif'), data)
+
+
+def test_mean(images):
+    filename, data = images
+    np.testing.assert_allclose(average_images(filename, 'mean'), data.mean(axis=0))
+
+
+@pytest.mark.parametrize('max_bytes', [1, 2 ** 30])
+def test_median(images, max_bytes):
+    filename, data = images
+    np.testing.assert_array_equal(average_images(filename, 'median', max_bytes=max_bytes),
+                                  np.median(data, axis=0))
+
+
+def test_invalid(images, monkeypatch):
+    with pytest.raises(ValueError):
+        average_images(images[0], 'max')
+    monkeypatch.setattr(find_large_spots, 'read_images', lambda *args, **kwargs: iter([]))
+    with pytest.raises(ValueError):
+        average_images(images[0], 'mean')
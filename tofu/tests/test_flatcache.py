@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+import tifffile
+from tofu.flatcache import get_reduced, is_supported, reduce_images, REDUCED
+
+
+@pytest.fixture(scope='function')
+def flats(tmp_path):
+    """Seven random 10 x 6 flats in two multi-page tif files."""
+    images = np.random.randint(0, 1000, size=(7, 10, 6)).astype(np.uint16)
+    for i, (start, stop) in enumerate([(0, 4), (4, 7)]):
+        with tifffile.TiffWriter(str(tmp_path / 'flat-{}.tif'.format(i))) as writer:
+            for image in images[start:stop]:
+                writer.write(image)
+
+    return (str(tmp_path / 'flat-*.tif'), images)
+
+
+def test_is_supported(tmp_path, flats):
+    assert is_supported(flats[0])
+    assert is_supported('data.h5:/flats')
+    with open(str(tmp_path / 'flat.raw'), 'wb') as f:
+        f.write(b'\0' * 16)
+    assert not is_supported(str(tmp_path / '*.raw'))
+    assert not is_supported(str(tmp_path / '*.edf'))
+
+
+@pytest.mark.parametrize('max_bytes', [1, 7 * 6 * 4 * 3, 2 ** 30])
+def test_median(flats, max_bytes):
+    path, images = flats
+    result = reduce_images(path, 'median', max_bytes=max_bytes)
+    assert result.dtype == np.float32
+    np.testing.assert_array_equal(result, np.median(images, axis=0))
+
+
+def test_average(flats):
+    path, images = flats
+    np.testing.assert_allclose(reduce_images(path, 'average'), images.mean(axis=0), rtol=1e-6)
+
+
+@pytest.mark.parametrize('mode', ['average', 'median'])
+def test_hdf5(tmp_path, mode):
+    h5py = pytest.importorskip('h5py')
+    images = np.random.random((5, 8, 4)).astype(np.float32)
+    filename = str(tmp_path / 'data.h5')
+    with h5py.File(filename, 'w') as f:
+        f['flats'] = images
+    reference = np.median(images, axis=0) if mode == 'median' else images.mean(axis=0)
+    np.testing.assert_allclose(reduce_images(filename + ':/flats', mode, max_bytes=100),
+                               reference, rtol=1e-6)
+
+
+def test_get_reduced(tmp_path, flats, monkeypatch):
+    path, images = flats
+    directory = str(tmp_path / 'cache')
+    reduced = get_reduced(path, 'median', y=2, height=5, y_step=2, directory=directory)
+    np.testing.assert_array_equal(reduced, np.median(images, axis=0)[2:7:2])
+    # Stored in the cache, not computed again, also by another process
+    REDUCED.clear()
+    monkeypatch.setattr('tofu.flatcache.reduce_images', None)
+    np.testing.assert_array_equal(get_reduced(path, 'median', directory=directory),
+                                  np.median(images, axis=0))
+    with pytest.raises(ValueError):
+        get_reduced(path, 'mean', directory=directory)
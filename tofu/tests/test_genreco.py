@@ -0,0 +1,443 @@
+import argparse
+import json
+import os
+import numpy as np
+import pytest
+import tifffile
+from threading import Thread
+from tofu import genreco
+from tofu.genreco import (compute_all_detector_pixels, compute_all_detector_regions, Executor,
+                          get_input_nbytes, get_journal_layout, get_pass_stats,
+                          get_rotation_matrices, MappedTiffWriter, parse_ufo_trace,
+                          probe_memory_scale, RegionJournal, RegionQueue, ReorderWriter,
+                          rotate_all)
+
+
+def get_geometry(number, source_y=-np.inf, center=(50., 0, 40.)):
+    """Geometry parameters of *number* projections without any tilts."""
+    zeros = np.zeros((number, 3))
+    source = np.tile([0, source_y, 0], (number, 1))
+    axis_position = np.tile(center, (number, 1))
+    detector_position = np.tile([0, 100., 0], (number, 1))
+
+    return (source, zeros, axis_position, zeros, zeros, detector_position)
+
+
+def test_rotation_matrices():
+    angles = [0, np.pi / 2, np.pi]
+    for axis in 'xyz':
+        matrices = get_rotation_matrices(axis, angles)
+        assert matrices.shape == (3, 3, 3)
+        np.testing.assert_allclose(matrices[0], np.identity(3))
+        for matrix in matrices:
+            np.testing.assert_allclose(np.dot(matrix, matrix.T), np.identity(3), atol=1e-12)
+    # Rotation around z by 90 degrees maps x to y
+    np.testing.assert_allclose(rotate_all('z', [np.pi / 2], np.array([[1., 0, 0]])),
+                               [[0, 1, 0]], atol=1e-12)
+
+
+@pytest.mark.parametrize('source_y', [-np.inf, -100.])
+def test_compute_all_detector_pixels(source_y):
+    points = np.array([[10., 0, 5], [-3, 0, 1]]).T
+    angles = np.array([0, np.pi / 2, np.pi])
+    x, y = compute_all_detector_pixels(points.copy(), *get_geometry(3, source_y=source_y),
+                                       angles)
+    assert x.shape == y.shape == (3, 2)
+    # Points in the plane of the axis are projected to their own coordinates (shifted by the
+    # center and by half a pixel), also in cone beam geometry
+    np.testing.assert_allclose(x[0], points[0] + 50 - 0.5)
+    np.testing.assert_allclose(y[[0, 2], 0], 5 + 40 - 0.5)
+    # By 180 degrees the image is mirrored
+    np.testing.assert_allclose(x[2], -points[0] + 50 - 0.5)
+    if np.isinf(source_y):
+        # Rotated by 90 degrees, x goes along the beam
+        np.testing.assert_allclose(x[1], 50 - 0.5, atol=1e-12)
+        np.testing.assert_allclose(y[1], points[2] + 40 - 0.5)
+    else:
+        # Rotated towards the detector, i.e. magnified less
+        assert 40 - 0.5 < y[1, 0] < 5 + 40 - 0.5
+
+
+def test_compute_all_detector_regions():
+    x = np.array([[10.2, 20.7], [-5., 3.], [100., 200.]])
+    y = np.array([[1.5, 2.5], [-10., 10.], [80., 90.]])
+    regions = compute_all_detector_regions(x, y, (50, 120), overhead=2)
+    np.testing.assert_array_equal(regions, [[8, 23, 0, 5],
+                                            [0, 5, 0, 12],
+                                            [98, 120, 50, 50]])
+
+
+def get_all_regions(queue, max_slices):
+    """Get all regions from *queue* in a round robin over the consumers with *max_slices*."""
+    regions = []
+    while True:
+        for maximum in max_slices:
+            item = queue.get(maximum)
+            if item is None:
+                return regions
+            regions.append(item)
+
+
+def get_slices(regions):
+    return [z for (index, region) in regions for z in np.arange(*region)]
+
+
+class TestRegionQueue:
+    @pytest.mark.parametrize('max_slices', [[100], [10, 10], [7, 20, 3]])
+    def test_every_slice_once(self, max_slices):
+        queue = RegionQueue([-50, 50, 1], len(max_slices))
+        regions = get_all_regions(queue, max_slices)
+        assert get_slices(regions) == list(range(-50, 50))
+        assert [index for (index, region) in regions] == list(range(len(regions)))
+
+    def test_step(self):
+        regions = get_all_regions(RegionQueue([0, 50, 2], 2), [4, 4])
+        assert get_slices(regions) == list(range(0, 50, 2))
+
+    def test_sizes(self):
+        queue = RegionQueue([0, 100, 1], 2, min_fraction=0.25)
+        sizes = [len(np.arange(*region)) for (index, region) in get_all_regions(queue, [40, 40])]
+        # Limited by the maximum first, then half of the remaining slices
+        assert sizes[:3] == [40, 30, 15]
+        # Never smaller than a quarter of the maximum, except for the rest
+        assert all(size >= 10 for size in sizes[:-1])
+        assert sizes == sorted(sizes, reverse=True)
+        assert sum(sizes) == 100
+
+    def test_done(self):
+        done = set(range(0, 10)) | {15} | set(range(30, 40))
+        regions = get_all_regions(RegionQueue([0, 40, 1], 2, done=done), [20, 20])
+        assert get_slices(regions) == [i for i in range(40) if i not in done]
+        # Regions stop in front of finished slices
+        assert [10, 15, 1] in [region for (index, region) in regions]
+        assert get_all_regions(RegionQueue([0, 10, 1], 1, done=set(range(10))), [5]) == []
+
+    def test_close(self):
+        queue = RegionQueue([0, 10, 1], 1)
+        assert queue.get(0) is None
+        assert queue.get(2) == (0, [0, 2, 1])
+        queue.close()
+        assert queue.get(2) is None
+
+    def test_threads(self):
+        queue = RegionQueue([0, 1000, 1], 4)
+        regions = []
+
+        def consume(max_slices):
+            item = queue.get(max_slices)
+            while item is not None:
+                regions.append(item)
+                item = queue.get(max_slices)
+
+        threads = [Thread(target=consume, args=(max_slices,)) for max_slices in (50, 30, 20, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert sorted(get_slices(regions)) == list(range(1000))
+
+
+class TestRegionJournal:
+    @pytest.fixture(scope='function')
+    def region_files(self, tmp_path):
+        """Journal file name and files of two regions written by a finished run."""
+        files = []
+        for index in range(2):
+            files.append(str(tmp_path / 'slice-{:>03}-0000.tif'.format(index)))
+            with open(files[-1], 'w') as f:
+                f.write('region {}'.format(index))
+        filename = str(tmp_path / 'slice.journal.json')
+        journal = RegionJournal(filename, {'a': 1}, layout={'runs': [0, 10]})
+        journal.add(0, 5, index=0, files=files[:1])
+        journal.add(5, 10, index=1, files=files[1:])
+
+        return filename, files
+
+    def test_resume(self, region_files):
+        filename, files = region_files
+        journal = RegionJournal(filename, {'a': 1}, layout={'runs': [0, 10]}, resume=True)
+        assert journal.resumed
+        assert journal.is_region_done(1, 5, 10)
+        assert journal.get_done_slices() == set(range(10))
+        with open(filename) as f:
+            assert json.load(f)['layout'] == {'runs': [0, 10]}
+
+    def test_broken_file(self, region_files):
+        filename, files = region_files
+        with open(files[1], 'a') as f:
+            f.write('truncated')
+        journal = RegionJournal(filename, {'a': 1}, layout={'runs': [0, 10]}, resume=True)
+        assert journal.is_region_done(0, 0, 5)
+        assert not journal.is_region_done(1, 5, 10)
+
+    @pytest.mark.parametrize('parameters, layout', [({'a': 2}, {'runs': [0, 10]}),
+                                                    ({'a': 1}, {'runs': [0, 5]})])
+    def test_stale_regions(self, region_files, parameters, layout):
+        filename, files = region_files
+        journal = RegionJournal(filename, parameters, layout=layout, resume=True)
+        assert not journal.resumed
+        assert not any(os.path.exists(name) for name in files)
+
+    def test_no_resume(self, region_files):
+        filename, files = region_files
+        journal = RegionJournal(filename, {'a': 1}, layout={'runs': [0, 10]})
+        assert not journal.resumed
+        journal.add(0, 5, index=0, files=files[:1])
+        journal.discard()
+        # Files are removed only when resuming
+        assert all(os.path.exists(name) for name in files)
+
+    def test_layout_keeps_slices(self, tmp_path):
+        filename = str(tmp_path / 'volume.journal.json')
+        RegionJournal(filename, {'a': 1}, layout={'runs': [0, 10]}).add(0, 4)
+        journal = RegionJournal(filename, {'a': 1}, layout={'runs': [0, 5]}, resume=True)
+        # Slices written to a shared volume do not depend on the layout
+        assert journal.get_done_slices() == set(range(4))
+
+    def test_discard(self, region_files):
+        filename, files = region_files
+        journal = RegionJournal(filename, {'a': 1}, layout={'runs': [0, 10]}, resume=True)
+        journal.discard(1)
+        assert os.path.exists(files[0])
+        assert not os.path.exists(files[1])
+        assert journal.get_done_slices() == set(range(5))
+        journal.discard()
+        assert not journal.resumed
+        assert not os.path.exists(files[0])
+
+    def test_get_journal_layout(self):
+        args = argparse.Namespace(gpus=None, num_gpu_threads=2, slices_per_device=None,
+                                  slice_memory_coeff=0.8, data_splitting_policy='one',
+                                  region_scheduling='static', device_memory_model='slices')
+        runs = [[(np.int64(0), [0., 8., 1.]), (np.int64(1), [8., 16., 1.])]]
+        layout = get_journal_layout(args, runs)
+        assert layout == json.loads(json.dumps(layout))
+        assert layout['num_gpu_threads'] == 2
+        assert len(layout['runs'][0]) == 2
+        args.num_gpu_threads = 1
+        assert get_journal_layout(args, runs) != layout
+
+
+class FakeWriter(object):
+    def __init__(self, fail_at=None):
+        self.images = []
+        self.closed = False
+        self.fail_at = fail_at
+
+    def write(self, image):
+        if len(self.images) == self.fail_at:
+            raise OSError('Disk full')
+        self.images.append(image)
+
+    def close(self):
+        self.closed = True
+
+
+class TestReorderWriter:
+    def test_out_of_order(self):
+        fake = FakeWriter()
+        writer = ReorderWriter(fake, 5, 5)
+        for index in [3, 1, 4, 0, 2]:
+            writer.save(np.full((2, 2), index), index)
+        writer.close()
+        assert fake.closed
+        assert [image[0, 0] for image in fake.images] == list(range(5))
+
+    def test_copy(self):
+        fake = FakeWriter()
+        writer = ReorderWriter(fake, 1, 1)
+        image = np.zeros((2, 2))
+        writer.save(image, 0)
+        image[:] = 1
+        writer.close()
+        assert fake.images[0][0, 0] == 0
+
+    def test_threads(self):
+        fake = FakeWriter()
+        writer = ReorderWriter(fake, 40, 3)
+
+        def save(start):
+            # Every thread saves its own region in order, like an executor
+            for index in range(start, start + 10):
+                writer.save(np.full((2, 2), index), index)
+
+        threads = [Thread(target=save, args=(start,)) for start in (30, 10, 20, 0)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+            assert not thread.is_alive()
+        writer.close()
+        assert [image[0, 0] for image in fake.images] == list(range(40))
+
+    def test_bounded(self):
+        fake = FakeWriter()
+        writer = ReorderWriter(fake, 4, 2)
+        writer.save(np.zeros((2, 2)), 3)
+        writer.save(np.zeros((2, 2)), 2)
+        # Buffer is full, slice 1 must wait until slice 0 arrives
+        thread = Thread(target=writer.save, args=(np.zeros((2, 2)), 1))
+        thread.start()
+        thread.join(timeout=0.2)
+        assert thread.is_alive()
+        assert len(writer._buffer) == 2
+        # The next slice is always accepted
+        writer.save(np.zeros((2, 2)), 0)
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        writer.close()
+        assert len(fake.images) == 4
+
+    def test_abort(self):
+        fake = FakeWriter()
+        writer = ReorderWriter(fake, 4, 1)
+        writer.save(np.zeros((2, 2)), 3)
+        thread = Thread(target=writer.save, args=(np.zeros((2, 2)), 2))
+        thread.start()
+        writer.close(abort=True)
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        assert fake.closed
+        assert not fake.images
+
+    def test_error(self):
+        fake = FakeWriter(fail_at=1)
+        writer = ReorderWriter(fake, 3, 3)
+        for index in range(3):
+            writer.save(np.zeros((2, 2)), index)
+        with pytest.raises(OSError):
+            writer.close()
+        assert fake.closed
+
+
+@pytest.mark.parametrize('num_slices', [1, 3, 4, 5])
+def test_mapped_tiff_writer(tmp_path, num_slices):
+    filename = str(tmp_path / 'volume.tif')
+    writer = MappedTiffWriter(filename, (num_slices, 4, 3), np.float32)
+    for index in reversed(range(num_slices)):
+        writer.save(np.full((4, 3), index), index)
+    writer.close()
+    with tifffile.TiffFile(filename) as tif:
+        assert len(tif.pages) == num_slices
+        assert [page.asarray()[0, 0] for page in tif.pages] == list(range(num_slices))
+
+
+class FakeScheduler(object):
+    """Fails like an out-of-memory device if there are more than *max_slices* slices."""
+    def __init__(self, num_slices, max_slices):
+        self.num_slices = num_slices
+        self.max_slices = max_slices
+        self.props = argparse.Namespace(time=0.)
+
+    def run(self, graph):
+        if self.num_slices > self.max_slices:
+            raise RuntimeError('CL_MEM_OBJECT_ALLOCATION_FAILURE')
+
+
+class FakeMemoryModel(object):
+    def get_num_slices(self, gpu, memory_coeff=0.8, num_threads=1, scale=1.):
+        return int(100 / scale)
+
+
+@pytest.mark.parametrize('max_slices, expected', [(90, 1.25), (1000, 0.8), (40, None)])
+def test_probe_memory_scale(monkeypatch, max_slices, expected):
+    def setup(self, prefetch=False):
+        self.scheduler = FakeScheduler(len(np.arange(*self.region)), max_slices)
+        self.graph = object()
+        self.stats.update(gupdates=0., read_bytes=0, write_bytes=0)
+
+    monkeypatch.setattr(Executor, 'setup', setup)
+    monkeypatch.setattr(genreco, 'determine_shape', lambda *args, **kwargs: None)
+    args = argparse.Namespace(number=100, projections='projections')
+    scale = probe_memory_scale(args, None, 0, None, FakeMemoryModel(), [0, 10, 1], [0, 10, 1],
+                               [0, 1000, 1], safety_margin=0.1)
+    if expected is None:
+        assert scale is None
+    else:
+        assert scale == pytest.approx(expected * 1.1)
+
+
+def write_trace(tmp_path, name, trace):
+    filename = str(tmp_path / name)
+    with open(filename, 'w') as f:
+        json.dump(trace, f)
+
+    return filename
+
+
+def test_parse_ufo_trace(tmp_path):
+    events = [
+        {'name': 'backproject', 'ph': 'X', 'ts': 0, 'dur': 2000000, 'pid': 1, 'tid': 1},
+        {'name': 'read', 'ph': 'B', 'ts': 1000000, 'pid': 1, 'tid': 1},
+        # Same name in another thread must not be matched with the one above
+        {'name': 'read', 'ph': 'B', 'ts': 1500000, 'pid': 1, 'tid': 2},
+        {'name': 'read', 'ph': 'E', 'ts': 2000000, 'pid': 1, 'tid': 2},
+        {'name': 'read', 'ph': 'E', 'ts': 4000000, 'pid': 1, 'tid': 1},
+    ]
+    filenames = [write_trace(tmp_path, 'trace.json', {'traceEvents': events}),
+                 # Plain list of events is also valid
+                 write_trace(tmp_path, 'list.json', events[:1])]
+    totals = parse_ufo_trace(filenames)
+    assert totals['backproject'] == {'time': pytest.approx(4.), 'count': 2}
+    assert totals['read'] == {'time': pytest.approx(3.5), 'count': 2}
+
+
+def test_parse_ufo_trace_unmatched(tmp_path):
+    events = [
+        {'name': 'read', 'ph': 'E', 'ts': 1000000, 'pid': 1, 'tid': 1},
+        {'name': 'read', 'ph': 'B', 'ts': 2000000, 'pid': 1, 'tid': 1},
+        {'name': 'write', 'ph': 'E', 'ts': 3000000, 'pid': 1, 'tid': 1},
+    ]
+    filename = write_trace(tmp_path, 'trace.json', {'traceEvents': events})
+    assert parse_ufo_trace([filename]) == {}
+
+
+def test_parse_ufo_trace_bad_file(tmp_path):
+    broken = str(tmp_path / 'broken.json')
+    with open(broken, 'w') as f:
+        f.write('{"traceEvents": [')
+    events = [{'name': 'read', 'ph': 'X', 'ts': 0, 'dur': 1000000}]
+    filenames = [broken, str(tmp_path / 'missing.json'),
+                 write_trace(tmp_path, 'trace.json', events)]
+    assert parse_ufo_trace(filenames) == {'read': {'time': pytest.approx(1.), 'count': 1}}
+
+
+def test_get_pass_stats():
+    def make_stats(number, start, end, num_slices=4, gupdates=8.):
+        stats = {'start': start, 'end': end, 'num_slices': num_slices, 'gupdates': gupdates}
+        if number is not None:
+            stats['pass'] = number
+        return stats
+
+    executor_stats = [make_stats(None, 10., 12.), make_stats(1, 5., 6.), make_stats(0, 0., 3.),
+                      make_stats(0, 1., 4.), make_stats(None, 11., 14.)]
+    result = get_pass_stats(executor_stats)
+    # Executors without a pass are summarized as the last pass
+    assert [item['number'] for item in result] == [0, 1, None]
+    assert result[0] == {'number': 0, 'num_regions': 2, 'num_slices': 8, 'wall_time': 4.,
+                         'gups': 4.}
+    assert result[2]['num_regions'] == 2
+    assert result[2]['wall_time'] == 4.
+
+
+def test_get_pass_stats_zero_wall_time():
+    stats = {'pass': 0, 'start': 1., 'end': 1., 'num_slices': 4, 'gupdates': 8.}
+    result = get_pass_stats([stats])
+    assert result[0]['wall_time'] == 0
+    assert result[0]['gups'] == 0
+
+
+def test_get_input_nbytes(tmp_path):
+    directory = tmp_path / 'projections'
+    directory.mkdir()
+    for index in range(3):
+        tifffile.imwrite(str(directory / 'projection-{}.tif'.format(index)),
+                         np.zeros((4, 4), dtype=np.float32))
+    filenames = [str(name) for name in directory.iterdir()]
+    assert get_input_nbytes(str(directory)) == sum(os.path.getsize(name) for name in filenames)
+    hdf5_filename = tmp_path / 'scan.h5'
+    hdf5_filename.write_bytes(b'0' * 100)
+    assert get_input_nbytes(str(hdf5_filename) + ':/entry/data') == 100
+    (tmp_path / 'empty').mkdir()
+    assert get_input_nbytes(str(tmp_path / 'empty')) is None
+    assert get_input_nbytes(None) is None
@@ -0,0 +1,101 @@
+import json
+import os
+import numpy as np
+import pytest
+import tifffile
+from tofu import manifest
+from tofu.manifest import (get_manifest_entry, get_manifest_filename, index_directory,
+                           read_manifest)
+from tofu.util import clear_metadata_cache, get_image_shape, TiffSequenceReader
+
+
+@pytest.fixture(scope='function')
+def directory(tmp_path):
+    clear_metadata_cache()
+    for i in range(4):
+        with tifffile.TiffWriter(str(tmp_path / 'image-{}.tif'.format(i))) as writer:
+            for j in range(2):
+                writer.write(np.full((8, 6), 2 * i + j, dtype=np.uint16))
+
+    return str(tmp_path)
+
+
+def test_index_directory(directory):
+    filenames = index_directory(directory)
+    assert filenames == [get_manifest_filename(directory)]
+    with open(filenames[0]) as f:
+        contents = json.load(f)
+    assert len(contents['files']) == 4
+    entry = contents['files'][0]
+    assert entry['pages'] == 2
+    assert entry['shape'] == [8, 6]
+    assert np.dtype(entry['dtype']) == np.uint16
+    assert None not in entry['offsets']
+
+
+def test_get_manifest_entry(directory):
+    assert get_manifest_entry(os.path.join(directory, 'image-0.tif')) is None
+    index_directory(directory)
+    entry = get_manifest_entry(os.path.join(directory, 'image-1.tif'))
+    assert entry['name'] == 'image-1.tif'
+
+    # Modified file
+    filename = os.path.join(directory, 'image-2.tif')
+    tifffile.imwrite(filename, np.zeros((4, 4), dtype=np.uint16))
+    assert get_manifest_entry(filename) is None
+    assert get_image_shape(filename) == (4, 4)
+
+
+def test_outdated(directory):
+    index_directory(directory)
+    assert read_manifest(directory) is not None
+    tifffile.imwrite(os.path.join(directory, 'image-4.tif'), np.zeros((8, 6), dtype=np.uint16))
+    assert read_manifest(directory) is None
+    os.remove(os.path.join(directory, 'image-4.tif'))
+    assert read_manifest(directory) is not None
+
+
+def test_validated_once(directory, monkeypatch):
+    index_directory(directory)
+    clear_metadata_cache()
+    calls = []
+    original = manifest.get_tiff_filenames
+    monkeypatch.setattr(manifest, 'get_tiff_filenames',
+                        lambda *args: calls.append(args) or original(*args))
+
+    for i in range(4):
+        assert get_manifest_entry(os.path.join(directory, 'image-{}.tif'.format(i)))
+    with TiffSequenceReader(directory) as reader:
+        assert reader.num_images == 8
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('memmap', [False, True])
+def test_read(directory, memmap):
+    index_directory(directory)
+    with TiffSequenceReader(directory, memmap=memmap) as reader:
+        for index in range(reader.num_images):
+            np.testing.assert_array_equal(reader.read(index), index)
+            np.testing.assert_array_equal(reader.read_rows(index, 2, 5), index)
+            assert reader.read_rows(index, 2, 5).shape == (3, 6)
+
+
+def test_non_uniform_pages(tmp_path):
+    clear_metadata_cache()
+    filename = str(tmp_path / 'image.tif')
+    gray = np.arange(48, dtype=np.uint16).reshape(8, 6)
+    rgb = np.arange(8 * 6 * 3, dtype=np.uint8).reshape(8, 6, 3)
+    with tifffile.TiffWriter(filename) as writer:
+        writer.write(gray)
+        writer.write(rgb, photometric='rgb')
+        writer.write(gray.astype(np.float32))
+    index_directory(str(tmp_path))
+    entry = get_manifest_entry(filename)
+    assert entry['offsets'][0] is not None
+    assert entry['offsets'][1:] == [None, None]
+
+    with TiffSequenceReader(filename, memmap=True) as reader:
+        np.testing.assert_array_equal(reader.read(0), gray)
+        np.testing.assert_array_equal(reader.read(1), rgb)
+        np.testing.assert_array_equal(reader.read(2), gray)
+        assert reader.read(2).dtype == np.float32
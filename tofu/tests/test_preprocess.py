@@ -0,0 +1,79 @@
+import argparse
+import queue
+import sys
+import types
+import numpy as np
+import pytest
+from tofu import preprocess
+
+
+class FakeOutputTask(object):
+    def __init__(self):
+        self.buffers = queue.Queue()
+
+    def get_output_buffer(self):
+        return self.buffers.get()
+
+    def release_output_buffer(self, buf):
+        pass
+
+
+class FakeGraph(object):
+    def connect_nodes(self, *nodes):
+        pass
+
+
+class FakeScheduler(object):
+    def abort(self):
+        pass
+
+
+@pytest.fixture
+def sinos(monkeypatch):
+    """Make sinograms from 3 projections of which the graph provides *num_provided*."""
+    state = {'num_provided': 3, 'written': None}
+    outputs = []
+
+    def make_output():
+        outputs.append(FakeOutputTask())
+        return outputs[-1]
+
+    def run_scheduler(scheduler, graph):
+        if outputs:
+            for i in range(state['num_provided']):
+                outputs[0].buffers.put(np.full((2, 4), i, dtype=np.float32))
+            del outputs[:]
+        return True
+
+    fake_numpy = types.SimpleNamespace(asarray=lambda buf: buf)
+    monkeypatch.setitem(sys.modules, 'ufo', types.SimpleNamespace(numpy=fake_numpy))
+    monkeypatch.setitem(sys.modules, 'ufo.numpy', fake_numpy)
+    monkeypatch.setattr(preprocess, 'Ufo', types.SimpleNamespace(TaskGraph=FakeGraph,
+                                                                 Scheduler=FakeScheduler,
+                                                                 OutputTask=make_output))
+    monkeypatch.setattr(preprocess, 'run_scheduler', run_scheduler)
+    monkeypatch.setattr(preprocess, 'get_num_images', lambda path: 3)
+    monkeypatch.setattr(preprocess, 'get_reader', lambda path, args: None)
+    monkeypatch.setattr(preprocess, 'get_writer', lambda args: None)
+    monkeypatch.setattr(preprocess, 'get_memory_in',
+                        lambda array: state.update(written=array.copy()))
+    args = argparse.Namespace(projections='projections', darks=None, flats=None, start=0,
+                              number=None, step=1, sinos_cache='ram', sinos_cache_directory=None)
+
+    return args, state
+
+
+@pytest.mark.parametrize('number', [None, 10])
+def test_make_sinograms_from_buffer(sinos, number):
+    args, state = sinos
+    args.number = number
+    assert preprocess.make_sinograms_from_buffer(args, timeout=0.1)
+    assert state['written'].shape == (2, 3, 4)
+    np.testing.assert_equal(state['written'][0, :, 0], [0, 1, 2])
+
+
+def test_make_sinograms_from_buffer_missing(sinos):
+    args, state = sinos
+    state['num_provided'] = 2
+    with pytest.raises(RuntimeError, match='Only 2 of 3'):
+        preprocess.make_sinograms_from_buffer(args, timeout=0.1)
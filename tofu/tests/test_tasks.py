@@ -0,0 +1,64 @@
+import sys
+import types
+import numpy as np
+import pytest
+from threading import Event
+from tofu import tasks, util
+
+
+class FakeInputTask(object):
+    def __init__(self):
+        self.images = []
+        self.stopped = Event()
+
+    def get_input_buffer(self):
+        return self.images[-1]
+
+    def release_input_buffer(self, buf):
+        self.images.append(buf)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FakeScheduler(object):
+    def set_resources(self, resources):
+        pass
+
+    def run(self, graph):
+        pass
+
+
+@pytest.fixture
+def failing_reader(monkeypatch):
+    def read_hdf5_blocks(path, **kwargs):
+        yield np.zeros((2, 4, 4), dtype=np.float32)
+        raise OSError('Truncated dataset')
+
+    fake_numpy = types.SimpleNamespace(fromarray=lambda image: image.copy(),
+                                       fromarray_inplace=lambda buf, image: None)
+    monkeypatch.setitem(sys.modules, 'ufo', types.SimpleNamespace(numpy=fake_numpy))
+    monkeypatch.setitem(sys.modules, 'ufo.numpy', fake_numpy)
+    monkeypatch.setattr(tasks, 'Ufo', types.SimpleNamespace(InputTask=FakeInputTask))
+    monkeypatch.setattr(util, 'read_hdf5_blocks', read_hdf5_blocks)
+    monkeypatch.setattr(util, 'RESOURCES', object())
+    monkeypatch.setattr(tasks, 'READ_ERRORS', [])
+
+    input_task = tasks.get_hdf5_reader('foo.h5:/data', types.SimpleNamespace())
+    assert input_task.stopped.wait(5)
+
+    return input_task
+
+
+def test_check_read_errors(failing_reader):
+    # The stream ends after the images which could be read
+    assert len(failing_reader.images) == 2
+    with pytest.raises(RuntimeError, match='foo.h5:/data.*Truncated dataset'):
+        tasks.check_read_errors()
+    # Errors are raised only once
+    tasks.check_read_errors()
+
+
+def test_run_scheduler_read_error(failing_reader):
+    with pytest.raises(RuntimeError, match='Truncated dataset'):
+        util.run_scheduler(FakeScheduler(), None)
@@ -0,0 +1,343 @@
+import glob
+import numpy as np
+import pytest
+import tifffile
+from tofu.util import (allocate_projection_cache, clear_metadata_cache, correlate_rotation_axis,
+                       estimate_rotation_axis, get_filenames, get_image_shape, get_opposite_pairs,
+                       get_row_segments, is_module_available, METADATA_CACHE, prefetch_rows,
+                       read_ahead, read_hdf5_blocks, read_hdf5_images, read_image_rows,
+                       SequenceReaderError, TiffSequenceReader)
+
+
+def make_image(index, shape=(8, 6), dtype=np.float32):
+    """Image with value *index* in the first pixel and distinct values in the others."""
+    image = np.arange(np.prod(shape), dtype=dtype).reshape(shape) + 100 * index
+    image.flat[0] = index
+
+    return image
+
+
+@pytest.fixture(scope='function')
+def tiff_sequence(tmp_path):
+    """Files with 1, 3 and 2 pages, i.e. 6 images in total, image i has value i in the first
+    pixel.
+    """
+    index = 0
+    for i, num_pages in enumerate([1, 3, 2]):
+        with tifffile.TiffWriter(str(tmp_path / 'image-{}.tif'.format(i))) as writer:
+            for j in range(num_pages):
+                writer.write(make_image(index))
+                index += 1
+
+    return str(tmp_path / '*.tif')
+
+
+class TestFileSequenceReader:
+    def test_offsets(self, tiff_sequence):
+        with TiffSequenceReader(tiff_sequence) as reader:
+            assert reader.offsets == [0, 1, 4, 6]
+            assert reader.num_images == 6
+
+    def test_read(self, tiff_sequence):
+        with TiffSequenceReader(tiff_sequence) as reader:
+            for index in range(6):
+                assert reader.read(index)[0, 0] == index
+            # Back to a previous file
+            assert reader.read(2)[0, 0] == 2
+            # Negative indexing
+            assert reader.read(-1)[0, 0] == 5
+            assert reader.read(-6)[0, 0] == 0
+
+    def test_read_out_of_range(self, tiff_sequence):
+        with TiffSequenceReader(tiff_sequence) as reader:
+            with pytest.raises(SequenceReaderError):
+                reader.read(6)
+            with pytest.raises(SequenceReaderError):
+                reader.read(-7)
+
+    def test_no_files(self, tmp_path):
+        with pytest.raises(SequenceReaderError):
+            TiffSequenceReader(str(tmp_path / '*.tif'))
+
+    def test_copy(self, tiff_sequence):
+        with TiffSequenceReader(tiff_sequence) as reader:
+            reader.read(0)
+            other = reader.copy()
+            # The index is shared, the open file is not
+            assert other.offsets is reader.offsets
+            assert other._filename is None
+            assert other.read(4)[0, 0] == 4
+            assert reader.read(1)[0, 0] == 1
+            other.close()
+
+
+class TestReadAhead:
+    def test_all(self, tiff_sequence):
+        with TiffSequenceReader(tiff_sequence) as reader:
+            values = [image[0, 0] for image in read_ahead(reader)]
+        assert values == list(range(6))
+
+    @pytest.mark.parametrize('depth, num_workers', [(1, 1), (2, 3), (10, 2)])
+    def test_order(self, tiff_sequence, depth, num_workers):
+        indices = [5, 0, 3, 3, 1]
+        with TiffSequenceReader(tiff_sequence) as reader:
+            values = [image[0, 0] for image in read_ahead(reader, indices=indices, depth=depth,
+                                                          num_workers=num_workers)]
+        assert values == indices
+
+    def test_bounded(self, tiff_sequence):
+        # At most *depth* images may be requested before the first one is consumed
+        requested = []
+        with TiffSequenceReader(tiff_sequence) as reader:
+            iterator = read_ahead(reader, indices=(requested.append(i) or i for i in range(6)),
+                                  depth=2)
+            next(iterator)
+            assert len(requested) <= 3
+            iterator.close()
+
+    def test_invalid(self, tiff_sequence):
+        with TiffSequenceReader(tiff_sequence) as reader:
+            with pytest.raises(ValueError):
+                next(read_ahead(reader, depth=0))
+            with pytest.raises(ValueError):
+                next(read_ahead(reader, num_workers=0))
+
+    def test_readers_closed(self, tiff_sequence, monkeypatch):
+        copies = []
+        original = TiffSequenceReader.copy
+
+        def copy(reader):
+            copies.append(original(reader))
+            return copies[-1]
+
+        monkeypatch.setattr(TiffSequenceReader, 'copy', copy)
+        with TiffSequenceReader(tiff_sequence) as reader:
+            iterator = read_ahead(reader, num_workers=2)
+            next(iterator)
+            iterator.close()
+            # Copies are closed when the iteration ends, the original reader stays usable
+            assert copies
+            assert all(copy._filename is None for copy in copies)
+            assert reader.read(1)[0, 0] == 1
+
+
+class TestMetadataCache:
+    def test_get_filenames(self, tmp_path, monkeypatch):
+        clear_metadata_cache()
+        for i in range(3):
+            tifffile.imwrite(str(tmp_path / 'image-{}.tif'.format(2 - i)), make_image(i))
+        pattern = str(tmp_path / '*.tif')
+        calls = []
+        original = glob.glob
+        monkeypatch.setattr(glob, 'glob', lambda *args: calls.append(args) or original(*args))
+
+        filenames = get_filenames(pattern)
+        assert filenames == sorted(filenames)
+        assert len(filenames) == 3
+        assert get_filenames(pattern) == filenames
+        assert get_filenames(str(tmp_path)) == filenames
+        # Pattern and directory are both listed once
+        assert len(calls) == 2
+        # The returned list is a copy
+        filenames.append('foo')
+        assert len(get_filenames(pattern)) == 3
+
+        tifffile.imwrite(str(tmp_path / 'image-3.tif'), make_image(3))
+        assert len(get_filenames(pattern)) == 4
+        assert len(calls) == 3
+
+    def test_get_image_shape(self, tmp_path, monkeypatch):
+        clear_metadata_cache()
+        filename = str(tmp_path / 'image.tif')
+        tifffile.imwrite(filename, make_image(0, shape=(8, 6)))
+        calls = []
+        original = tifffile.TiffFile
+        monkeypatch.setattr(tifffile, 'TiffFile',
+                            lambda *args, **kwargs: calls.append(args) or original(*args,
+                                                                                   **kwargs))
+
+        assert get_image_shape(filename) == (8, 6)
+        assert get_image_shape(filename) == (8, 6)
+        assert len(calls) == 1
+
+        # Changed file is read again
+        with tifffile.TiffWriter(filename) as writer:
+            for i in range(3):
+                writer.write(make_image(i, shape=(4, 5)))
+        assert get_image_shape(filename) == (3, 4, 5)
+        assert len(calls) == 2
+
+    def test_clear(self, tmp_path):
+        tifffile.imwrite(str(tmp_path / 'image.tif'), make_image(0))
+        get_filenames(str(tmp_path))
+        assert METADATA_CACHE
+        clear_metadata_cache()
+        assert not METADATA_CACHE
+
+
+class TestHDF5:
+    @pytest.fixture(scope='function')
+    def dataset(self, tmp_path):
+        h5py = pytest.importorskip('h5py')
+        filename = str(tmp_path / 'data.h5')
+        data = np.arange(10 * 8 * 6, dtype=np.uint16).reshape(10, 8, 6)
+        with h5py.File(filename, 'w') as f:
+            f['projections'] = data
+
+        return (filename + ':/projections', data)
+
+    @pytest.mark.parametrize('kwargs', [{}, {'y': 2, 'height': 4, 'y_step': 2},
+                                        {'start': 1, 'number': 7, 'step': 2}])
+    def test_read(self, dataset, kwargs):
+        path, data = dataset
+        ground_truth = data[kwargs.get('start', 0)::kwargs.get('step', 1)][:kwargs.get('number')]
+        y = kwargs.get('y', 0)
+        height = kwargs.get('height')
+        ground_truth = ground_truth[:, y:y + height if height else None:kwargs.get('y_step', 1)]
+
+        images = read_hdf5_images(path, block_size=3, **kwargs)
+        assert images.dtype == np.float32
+        np.testing.assert_array_equal(images, ground_truth)
+        blocks = list(read_hdf5_blocks(path, block_size=3, **kwargs))
+        assert all(len(block) <= 3 for block in blocks)
+        np.testing.assert_array_equal(np.concatenate(blocks), ground_truth)
+
+    def test_read_image_rows(self, dataset):
+        path, data = dataset
+        rows = read_image_rows(path, [0, 7, -1], y=2, height=4, y_step=2)
+        np.testing.assert_array_equal(rows, data[[0, 7, -1], 2:6:2])
+
+    def test_empty(self, dataset):
+        with pytest.raises(RuntimeError):
+            read_hdf5_images(dataset[0], start=10)
+        with pytest.raises(RuntimeError):
+            next(read_hdf5_blocks(dataset[0], y=8))
+
+
+class TestReadRows:
+    @pytest.mark.parametrize('kwargs', [{},
+                                        {'byteorder': '>'},
+                                        {'rowsperstrip': 3},
+                                        {'rowsperstrip': 2, 'compression': 'zlib'},
+                                        {'tile': (16, 16)}])
+    @pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+    def test_read_rows(self, tmp_path, kwargs, dtype):
+        filename = str(tmp_path / 'image.tif')
+        images = [make_image(i, shape=(20, 17), dtype=dtype) for i in range(3)]
+        with tifffile.TiffWriter(filename, byteorder=kwargs.pop('byteorder', '<')) as writer:
+            for image in images:
+                writer.write(image, **kwargs)
+
+        with TiffSequenceReader(filename) as reader:
+            for index, image in enumerate(images):
+                for start, stop in [(0, 20), (0, 1), (2, 9), (5, 6), (19, 20), (7, 100)]:
+                    rows = reader.read_rows(index, start, stop)
+                    assert rows.dtype == np.dtype(dtype)
+                    np.testing.assert_array_equal(rows, image[start:stop])
+                np.testing.assert_array_equal(reader.read_rows(index, 4), image[4:5])
+                assert reader.read_rows(index, 6, 6).shape == (0, 17)
+
+    def test_read_ahead_rows(self, tiff_sequence):
+        with TiffSequenceReader(tiff_sequence) as reader:
+            images = list(read_ahead(reader, rows=(2, 5), num_workers=2))
+        assert len(images) == 6
+        for index, image in enumerate(images):
+            np.testing.assert_array_equal(image, make_image(index)[2:5])
+
+
+class TestPrefetch:
+    @pytest.fixture(scope='function')
+    def filename(self, tmp_path):
+        filename = str(tmp_path / 'image.tif')
+        with tifffile.TiffWriter(filename) as writer:
+            for i in range(3):
+                writer.write(make_image(i, shape=(20, 10)), rowsperstrip=4)
+
+        return filename
+
+    def test_get_row_segments(self, filename):
+        with tifffile.TiffFile(filename) as tif:
+            page = tif.pages[0]
+            segments = list(zip(page.dataoffsets, page.databytecounts))
+            assert get_row_segments(page) == segments
+            assert get_row_segments(page, y=5, height=6) == segments[1:3]
+            assert get_row_segments(page, y=4, height=4) == segments[1:2]
+            assert get_row_segments(page, y=19, height=100) == segments[4:]
+            assert get_row_segments(page, y=20, height=1) == []
+
+    def test_prefetch_rows(self, filename):
+        strip_size = 4 * 10 * 4
+        assert prefetch_rows(filename) == 3 * 5 * strip_size
+        assert prefetch_rows(filename, y=5, height=6) == 3 * 2 * strip_size
+        # Indices beyond the sequence are ignored
+        assert prefetch_rows(filename, y=5, height=6, indices=range(1, 10)) == 2 * 2 * strip_size
+        assert prefetch_rows(filename, max_bytes=strip_size) == 0
+        assert prefetch_rows(filename, abort=lambda: True) == 0
+
+
+def make_projections(axis, num_rows=3, width=64):
+    """Projections 0 and 180 degrees of an object made of Gaussians rotating around *axis*, which
+    is given in coordinates where integers are boundaries between pixels.
+    """
+    def project(x):
+        return sum(weight * np.exp(-(x - center) ** 2 / (2 * sigma ** 2))
+                   for (weight, center, sigma) in [(1., -8., 3.), (0.5, 5., 2.), (0.7, 12., 4.)])
+
+    x = np.arange(width) + 0.5
+    first = np.tile(project(x - axis), (num_rows, 1))
+    second = np.tile(project(axis - x), (num_rows, 1))
+
+    return (first, second)
+
+
+class TestRotationAxis:
+    @pytest.mark.parametrize('axis', [32., 30.3, 33.77, 25.5])
+    def test_correlate(self, axis):
+        assert abs(correlate_rotation_axis([make_projections(axis)]) - axis) < 0.05
+
+    def test_correlate_pairs(self):
+        first, second = make_projections(29.6)
+        # Sum over pairs and rows, the pairs do not need to have the same number of rows
+        pairs = [(first, second), (first[:1], second[:1])]
+        assert abs(correlate_rotation_axis(pairs) - 29.6) < 0.05
+
+    @pytest.mark.parametrize('number, overall_angle, num_pairs, expected',
+                             [(100, 180., 1, [(0, 99)]),
+                              (10, 180., 2, [(0, 9)]),
+                              (100, 360., 3, [(0, 50), (24, 74), (49, 99)]),
+                              (8, 360., 10, [(0, 4), (1, 5), (2, 6), (3, 7)])])
+    def test_get_opposite_pairs(self, number, overall_angle, num_pairs, expected):
+        assert get_opposite_pairs(number, overall_angle=overall_angle,
+                                  num_pairs=num_pairs) == expected
+
+    def test_get_opposite_pairs_invalid(self):
+        with pytest.raises(ValueError):
+            get_opposite_pairs(1)
+
+    def test_estimate(self, tmp_path):
+        axis = 30.3
+        first, second = make_projections(axis)
+        filename = str(tmp_path / 'projections.tif')
+        with tifffile.TiffWriter(filename) as writer:
+            for image in [first, first, second, second]:
+                writer.write(image.astype(np.float32))
+        estimated = estimate_rotation_axis(filename, overall_angle=360., num_pairs=2)
+        assert abs(estimated - axis) < 0.05
+
+
+def test_is_module_available():
+    assert is_module_available('numpy')
+    assert is_module_available('numpy.fft')
+    assert not is_module_available('tofu_missing_module')
+    assert not is_module_available('tofu_missing_module.submodule')
+
+
+def test_allocate_projection_cache(tmp_path, caplog):
+    caplog.set_level('INFO')
+    cache = allocate_projection_cache((2, 3, 4), 'ram', name='sinograms')
+    assert cache.shape == (2, 3, 4) and cache.dtype == np.float32
+    assert not isinstance(cache, np.memmap)
+    assert 'sinograms in host memory' in caplog.text
+    cache = allocate_projection_cache((2, 3, 4), 'disk', directory=str(tmp_path))
+    assert isinstance(cache, np.memmap)
+    assert 'projections on disk' in caplog.text
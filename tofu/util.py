@@ -1,7 +1,10 @@
 """Various utility functions."""
 import argparse
+import bisect
+import copy
 import gi
 import glob
+import importlib.util
 import logging
 import math
 import os
@@ -20,6 +23,9 @@ except ValueError as e:
 
 LOG = logging.getLogger(__name__)
 RESOURCES = None
+# Image metadata shared by all callers within one process, see :func:`get_cached_metadata`
+METADATA_CACHE = {}
+HDF5_EXTS = ('.h5', '.hdf5', '.nxs', '.nx5')
 
 
 def range_list(value):
@@ -68,15 +74,154 @@ def set_node_props(node, args):
                 node.set_property(name, getattr(args, name))
 
 
+def get_cached_metadata(kind, key, stamp_path, compute):
+    """Return metadata of type *kind* (e.g. 'filenames') for *key*, computed by calling *compute*
+    without arguments. The result is stored in :data:`METADATA_CACHE` and reused until the
+    modification time or size of *stamp_path* (the directory in case of file lists and the file
+    itself in case of image properties) changes. If *stamp_path* cannot be accessed, nothing is
+    cached.
+    """
+    try:
+        stat = os.stat(stamp_path)
+    except OSError:
+        return compute()
+
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    entry = METADATA_CACHE.get((kind, key))
+    if entry is None or entry[0] != stamp:
+        entry = (stamp, compute())
+        METADATA_CACHE[(kind, key)] = entry
+
+    return entry[1]
+
+
+def clear_metadata_cache():
+    """Forget all metadata stored by :func:`get_cached_metadata`."""
+    METADATA_CACHE.clear()
+
+
 def get_filenames(path):
     """
     Get all filenams from *path*, which could be a directory or a pattern for
-    matching files in a directory.
+    matching files in a directory. The list is cached as long as the directory does not change.
     """
     if not path:
         return []
 
-    return sorted(glob.glob(os.path.join(path, '*') if os.path.isdir(path) else path))
+    if os.path.isdir(path):
+        pattern = os.path.join(path, '*')
+        directory = path
+    else:
+        pattern = path
+        directory = os.path.dirname(path) or '.'
+
+    def find():
+        return sorted(glob.glob(pattern))
+
+    if glob.has_magic(directory):
+        # Files may come from more directories, do not cache
+        return find()
+
+    return list(get_cached_metadata('filenames', os.path.abspath(pattern), directory, find))
+
+
+def is_hdf5_path(path):
+    """Return True if *path* specifies an HDF5 dataset as file.h5:/path/to/dataset."""
+    return split_hdf5_path(path) is not None
+
+
+def split_hdf5_path(path):
+    """Split *path* given as file.h5:/path/to/dataset (.hdf5, .nxs and .nx5 extensions are also
+    recognized) to a tuple (file name, dataset name). Return None if *path* does not specify an HDF5
+    dataset.
+    """
+    if not path or ':' not in path:
+        return None
+    filename, dataset = path.rsplit(':', 1)
+    if not (dataset and os.path.splitext(filename)[1].lower() in HDF5_EXTS):
+        return None
+
+    return (filename, dataset)
+
+
+def get_num_images(path):
+    """Return the number of images in *path*, which is either a file pattern or a directory, in
+    which case the number of files is returned, or an HDF5 dataset (see :func:`split_hdf5_path`).
+    """
+    if is_hdf5_path(path):
+        shape = get_image_shape(path)
+        return shape[0] if len(shape) > 2 else 1
+
+    return len(get_filenames(path))
+
+
+def _select_hdf5_images(dset, path, y, height, y_step, start, number, step):
+    """Get image indices and the slice of rows of HDF5 dataset *dset* selected by the arguments of
+    :func:`read_hdf5_images`.
+    """
+    if dset.ndim == 2:
+        indices = range(0, 1)
+    else:
+        indices = range(start, dset.shape[0], step)[:number]
+    rows = slice(y, None if height is None else y + height, y_step)
+    if not len(indices) or not len(range(*rows.indices(dset.shape[-2]))):
+        raise RuntimeError("No images to read from `{}'".format(path))
+
+    return (indices, rows)
+
+
+def read_hdf5_images(path, y=0, height=None, y_step=1, start=0, number=None, step=1,
+                     num_workers=4, block_size=16):
+    """Read images from HDF5 dataset *path* (see :func:`split_hdf5_path`) into a float32 array
+    with shape (number of images, rows, width). Read rows from *y* to *y* + *height* with *y_step*
+    and images from *start* with *step*, at most *number* of them. Blocks of *block_size* images
+    are read and converted by *num_workers* threads.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import h5py
+    import numpy as np
+
+    filename, dataset = split_hdf5_path(path)
+    with h5py.File(filename, 'r') as f:
+        dset = f[dataset]
+        indices, rows = _select_hdf5_images(dset, path, y, height, y_step, start, number, step)
+        num_rows = len(range(*rows.indices(dset.shape[-2])))
+        result = np.empty((len(indices), num_rows, dset.shape[-1]), dtype=np.float32)
+        LOG.debug("Reading %d images with %d rows from `%s'", len(indices), num_rows, path)
+
+        def read_block(index):
+            block = indices[index:index + block_size]
+            if dset.ndim == 2:
+                result[0] = dset[rows]
+            else:
+                result[index:index + len(block)] = dset[block.start:block.stop:block.step, rows]
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(read_block, range(0, len(indices), block_size)))
+
+    return result
+
+
+def read_hdf5_blocks(path, y=0, height=None, y_step=1, start=0, number=None, step=1,
+                     block_size=16):
+    """Iterate over images from HDF5 dataset *path* selected like in :func:`read_hdf5_images`, but
+    read only *block_size* images at once and yield them as float32 arrays with shape (number of
+    images in the block, rows, width).
+    """
+    import h5py
+    import numpy as np
+
+    filename, dataset = split_hdf5_path(path)
+    with h5py.File(filename, 'r') as f:
+        dset = f[dataset]
+        indices, rows = _select_hdf5_images(dset, path, y, height, y_step, start, number, step)
+        LOG.debug("Reading %d images from `%s' in blocks of %d", len(indices), path, block_size)
+        if dset.ndim == 2:
+            yield dset[rows][np.newaxis].astype(np.float32)
+            return
+        for index in range(0, len(indices), block_size):
+            block = indices[index:index + block_size]
+            yield dset[block.start:block.stop:block.step, rows].astype(np.float32)
 
 
 def setup_read_task(task, path, args):
@@ -175,21 +320,32 @@ def next_power_of_two(number):
     return 2 ** int(math.ceil(math.log(number, 2)))
 
 
-def read_image(filename, allow_multi=False):
-    """Read image from file *filename*. In case of tif files, *filename* can be a regular expression
-    matching more files. If *allow_multi* is True and there are more images in the *filename*,
-    return them all, not only the first one.
+def is_tiff_input(filename):
+    """Return True if *filename*, which can be a directory or a pattern matching more files, points
+    to tif files.
     """
     if os.path.isdir(filename):
         format_check = glob.glob(os.path.join(filename, "*"))[0]
     else:
         format_check = filename
 
-    if format_check.lower().endswith('.tif') or format_check.lower().endswith('.tiff'):
-        reader = TiffSequenceReader(filename)
-        images = [reader.read(i) for i in range(reader.num_images)]
-        return images if allow_multi else images[0]
-    elif '.edf' in format_check.lower():
+    return format_check.lower().endswith('.tif') or format_check.lower().endswith('.tiff')
+
+
+def read_image(filename, allow_multi=False, memmap=False):
+    """Read image from file *filename*. In case of tif files, *filename* can be a regular expression
+    matching more files. If *allow_multi* is True and there are more images in the *filename*,
+    return them all, not only the first one. If *memmap* is True, uncompressed tif images are
+    returned as read-only memory-mapped arrays (see :class:`TiffSequenceReader`). Use
+    :func:`read_images` for iterating over many images without holding them all in memory.
+    """
+    if allow_multi:
+        return list(read_images(filename, memmap=memmap))
+
+    if is_tiff_input(filename):
+        with TiffSequenceReader(filename, memmap=memmap) as reader:
+            return reader.read(0)
+    elif '.edf' in filename.lower():
         import fabio
         edf = fabio.edfimage.edfimage()
         edf.read(filename)
@@ -198,6 +354,18 @@ def read_image(filename, allow_multi=False):
         raise ValueError('Unsupported image format')
 
 
+def read_images(filename, memmap=False, depth=4, num_workers=1):
+    """Lazily iterate over all images in *filename*, which can be specified like in
+    :func:`read_image`. Tif images are read in advance by :func:`read_ahead` with *depth* and
+    *num_workers*, *memmap* is passed to :class:`TiffSequenceReader`.
+    """
+    if is_tiff_input(filename):
+        with TiffSequenceReader(filename, memmap=memmap) as reader:
+            yield from read_ahead(reader, depth=depth, num_workers=num_workers)
+    else:
+        yield read_image(filename)
+
+
 def write_image(filename, image):
     import tifffile
     directory = os.path.dirname(filename)
@@ -207,26 +375,45 @@ def write_image(filename, image):
 
 
 def get_image_shape(filename):
-    """Determine image shape (numpy order) from file *filename*."""
-    if filename.lower().endswith('.tif') or filename.lower().endswith('.tiff'):
-        from tifffile import TiffFile
-        with TiffFile(filename) as tif:
-            page = tif.pages[0]
-            shape = (page.imagelength, page.imagewidth)
-            if len(tif.pages) > 1:
-                shape = (len(tif.pages),) + shape
-    else:
-        # fabio doesn't seem to be able to read the shape without reading the data
-        shape = read_image(filename).shape
-
-    return shape
+    """Determine image shape (numpy order) from file *filename*, which may also be an HDF5 dataset
+    (see :func:`split_hdf5_path`). The shape is cached as long as the file does not change.
+    """
+    hdf5_path = split_hdf5_path(filename)
+
+    def read_shape():
+        if hdf5_path:
+            import h5py
+            with h5py.File(hdf5_path[0], 'r') as f:
+                return f[hdf5_path[1]].shape
+        if filename.lower().endswith('.tif') or filename.lower().endswith('.tiff'):
+            from tifffile import TiffFile
+            from tofu.manifest import get_manifest_entry
+            entry = get_manifest_entry(filename)
+            if entry:
+                shape = tuple(entry['shape'])
+                return (entry['pages'],) + shape if entry['pages'] > 1 else shape
+            with TiffFile(filename) as tif:
+                page = tif.pages[0]
+                shape = (page.imagelength, page.imagewidth)
+                if len(tif.pages) > 1:
+                    shape = (len(tif.pages),) + shape
+        else:
+            # fabio doesn't seem to be able to read the shape without reading the data
+            shape = read_image(filename).shape
+
+        return shape
+
+    return get_cached_metadata('shape', os.path.abspath(filename),
+                               hdf5_path[0] if hdf5_path else filename, read_shape)
 
 
 def get_first_filename(path, valid_exts: list[str] = None):
     """Returns the first valid image filename in *path*. If *valid_exts* is set, only return files
-    with the extension matching *valid_exts*."""
+    with the extension matching *valid_exts*. HDF5 dataset paths are returned as they are."""
     if not path:
         raise RuntimeError("Path to sinograms or projections not set.")
+    if is_hdf5_path(path):
+        return path
 
     filenames = get_filenames(path)
 
@@ -272,6 +459,49 @@ def determine_shape(args, path=None, store=False, do_raise=False):
     return (width, height)
 
 
+def get_available_memory():
+    """Return available host memory in bytes or None if it cannot be determined."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def allocate_projection_cache(shape, mode, directory=None, memory_coeff=0.5, name='projections'):
+    """Allocate a float32 array of *shape* in host memory if *mode* is 'ram' and it fits,
+    otherwise in a temporary file in *directory*. Return None if there is not enough space. *name*
+    describes the cached data in log messages.
+    """
+    import numpy as np
+    import shutil
+    import tempfile
+
+    nbytes = int(np.prod(shape)) * 4
+    if mode == 'ram':
+        available = get_available_memory()
+        if available is None or nbytes <= available * memory_coeff:
+            LOG.info('Caching %.2f GB of %s in host memory', nbytes / 2. ** 30, name)
+            return np.empty(shape, dtype=np.float32)
+        LOG.info('%.2f GB of %s do not fit into host memory, caching them on disk',
+                 nbytes / 2. ** 30, name)
+
+    if nbytes <= shutil.disk_usage(directory or tempfile.gettempdir()).free:
+        LOG.info('Caching %.2f GB of %s on disk', nbytes / 2. ** 30, name)
+        # The file is deleted as soon as the memory map is released
+        with tempfile.TemporaryFile(dir=directory) as f:
+            return np.memmap(f, dtype=np.float32, mode='w+', shape=shape)
+    LOG.warning('%.2f GB of %s do not fit on disk, not caching them', nbytes / 2. ** 30, name)
+
+    return None
+
+
 def get_filtering_padding(width):
     """Get the number of horizontal padded pixels in order to avoid convolution artifacts."""
     return next_power_of_two(2 * width) - width
@@ -374,8 +604,17 @@ def get_scarray_value(scarray, index):
     return scarray[index]
 
 
+def is_module_available(name):
+    """Return True if module *name*, which may be a submodule, can be imported."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
 def run_scheduler(scheduler, graph):
     from threading import Thread
+    from tofu.tasks import check_read_errors
     # Reuse resources until https://github.com/ufo-kit/ufo-core/issues/191 is solved.
     global RESOURCES
     if not RESOURCES:
@@ -388,11 +627,13 @@ def run_scheduler(scheduler, graph):
 
     try:
         thread.join()
-        return True
     except KeyboardInterrupt:
         LOG.info('Processing interrupted')
         scheduler.abort()
         return False
+    check_read_errors()
+
+    return True
 
 
 def fbp_filtering_in_phase_retrieval(args):
@@ -441,10 +682,11 @@ class FileSequenceReader:
     def __init__(self, file_prefix, ext=''):
         if os.path.isdir(file_prefix):
             file_prefix = os.path.join(file_prefix, '*' + ext)
-        self._filenames = sorted(glob.glob(file_prefix))
+        self._filenames = get_filenames(file_prefix)
         if not self._filenames:
             raise SequenceReaderError("No files matching `{}' found".format(file_prefix))
         self._lengths = {}
+        self._offsets = None
         self._file = None
         self._filename = None
 
@@ -456,29 +698,60 @@ class FileSequenceReader:
 
     @property
     def num_images(self):
-        num = 0
-        for filename in self._filenames:
-            num += self._get_num_images_in_file(filename)
+        return self.offsets[-1]
 
-        return num
+    @property
+    def offsets(self):
+        """Cumulative image offsets of the files in the sequence, i.e. file *i* contains images
+        *offsets[i]* to *offsets[i + 1]* (excluded). The index is built on first access by counting
+        the images in every file and reused afterwards.
+        """
+        if self._offsets is None:
+            offsets = [0]
+            for filename in self._filenames:
+                offsets.append(offsets[-1] + self._get_num_images_in_file(filename))
+            self._offsets = offsets
+
+        return self._offsets
 
     def read(self, index):
-        if index < 0:
-            # Enables negative indexing
-            index += self.num_images
-        file_index = 0
-        while index >= 0:
-            if file_index >= len(self._filenames):
-                raise SequenceReaderError('image index greater than sequence length')
-            index -= self._get_num_images_in_file(self._filenames[file_index])
-            file_index += 1
-
-        file_index -= 1
-        index += self._lengths[self._filenames[file_index]]
+        file_index, index = self._locate(index)
         self._open(self._filenames[file_index])
 
         return self._read_real(index)
 
+    def read_rows(self, index, start, stop=None):
+        """Read rows from *start* to *stop* (excluded, only row *start* if None) of image *index*.
+        Subclasses may decode only the parts of the image which contain the rows.
+        """
+        file_index, index = self._locate(index)
+        self._open(self._filenames[file_index])
+
+        return self._read_rows_real(index, start, start + 1 if stop is None else stop)
+
+    def _locate(self, index):
+        """Convert global image *index* to a tuple (file index, image index within that file)."""
+        offsets = self.offsets
+        if index < 0:
+            # Enables negative indexing
+            index += offsets[-1]
+        if index < 0 or index >= offsets[-1]:
+            raise SequenceReaderError('image index greater than sequence length')
+        file_index = bisect.bisect_right(offsets, index) - 1
+
+        return (file_index, index - offsets[file_index])
+
+    def copy(self):
+        """Return a new reader of the same sequence which shares the image index with this one but
+        opens its own files, e.g. for reading from a different thread.
+        """
+        self.offsets
+        reader = copy.copy(self)
+        reader._file = None
+        reader._filename = None
+
+        return reader
+
     def _open(self, filename):
         if self._filename != filename:
             if self._filename:
@@ -512,10 +785,75 @@ class FileSequenceReader:
     def _read_real(self, index):
         raise NotImplementedError
 
+    def _read_rows_real(self, index, start, stop):
+        return self._read_real(index)[start:stop]
+
 
 class TiffSequenceReader(FileSequenceReader):
-    def __init__(self, file_prefix, ext='.tif'):
+
+    """TIFF sequence reader. If *memmap* is True, uncompressed and contiguously stored pages are
+    returned as read-only memory-mapped arrays, so that only the bytes which are actually accessed,
+    e.g. by slicing rows, are read from disk. Pages which cannot be memory-mapped are decoded as
+    usual. If the files have an up-to-date manifest (see :mod:`tofu.manifest`), the number of pages
+    and the data offsets are taken from it instead of the files. :meth:`.read_rows` reads only the
+    strips which contain the requested rows, and in case of uncompressed data only the rows
+    themselves.
+    """
+
+    def __init__(self, file_prefix, ext='.tif', memmap=False):
         super(TiffSequenceReader, self).__init__(file_prefix, ext=ext)
+        self.memmap = memmap
+        self._entries = {}
+
+    def read(self, index):
+        if self.memmap:
+            # Memory-map directly from the offsets stored in the manifest without parsing the file
+            file_index, page_index = self._locate(index)
+            filename = self._filenames[file_index]
+            entry = self._get_manifest_entry(filename)
+            if entry and entry['offsets'][page_index] is not None:
+                import numpy as np
+                return np.memmap(filename, dtype=entry['dtype'], mode='r',
+                                 offset=entry['offsets'][page_index], shape=tuple(entry['shape']))
+
+        return super(TiffSequenceReader, self).read(index)
+
+    def read_rows(self, index, start, stop=None):
+        import numpy as np
+
+        file_index, page_index = self._locate(index)
+        filename = self._filenames[file_index]
+        entry = self._get_manifest_entry(filename)
+        if entry and entry['offsets'][page_index] is not None:
+            # Contiguous data, read the rows directly from the offset stored in the manifest
+            height, width = entry['shape']
+            start, stop, _ = slice(start, start + 1 if stop is None else stop).indices(height)
+            dtype = np.dtype(entry['dtype'])
+            row_size = width * dtype.itemsize
+            with open(filename, 'rb') as f:
+                f.seek(entry['offsets'][page_index] + start * row_size)
+                data = f.read(max(stop - start, 0) * row_size)
+
+            data = np.frombuffer(data, dtype=dtype).reshape(-1, width)
+
+            return data.astype(dtype.newbyteorder('='))
+
+        return super(TiffSequenceReader, self).read_rows(index, start, stop=stop)
+
+    def _get_manifest_entry(self, filename):
+        if filename not in self._entries:
+            from tofu.manifest import get_manifest_entry
+            self._entries[filename] = get_manifest_entry(filename)
+
+        return self._entries[filename]
+
+    def _get_num_images_in_file(self, filename):
+        if filename not in self._lengths:
+            entry = self._get_manifest_entry(filename)
+            if entry:
+                self._lengths[filename] = entry['pages']
+
+        return super(TiffSequenceReader, self)._get_num_images_in_file(filename)
 
     def _open_real(self, filename):
         import tifffile
@@ -528,8 +866,304 @@ class TiffSequenceReader(FileSequenceReader):
         return len(self._file.pages)
 
     def _read_real(self, index):
-        return self._file.pages[index].asarray()
+        page = self._file.pages[index]
+        if self.memmap and page.is_memmappable:
+            return page.asarray(out='memmap')
+
+        return page.asarray()
+
+    def _read_rows_real(self, index, start, stop):
+        import numpy as np
+
+        page = self._file.pages[index]
+        if page.is_tiled or page.samplesperpixel != 1 or page.dtype is None:
+            return page.asarray()[start:stop]
+
+        height, width = page.imagelength, page.imagewidth
+        start, stop, _ = slice(start, stop).indices(height)
+        dtype = np.dtype(self._file.byteorder + page.dtype.char)
+        if page.bitspersample != 8 * dtype.itemsize:
+            # Packed integers
+            return page.asarray()[start:stop]
+        if stop <= start:
+            return np.empty((0, width), dtype=dtype.newbyteorder('='))
+        rows_per_strip = min(page.rowsperstrip, height)
+        row_size = width * dtype.itemsize
+        fh = self._file.filehandle
+        parts = []
+
+        for strip in range(start // rows_per_strip, (stop - 1) // rows_per_strip + 1):
+            strip_start = strip * rows_per_strip
+            first = max(start, strip_start) - strip_start
+            last = min(stop, strip_start + rows_per_strip) - strip_start
+            if page.compression == 1:
+                # Uncompressed, read only the requested rows of the strip
+                fh.seek(page.dataoffsets[strip] + first * row_size)
+                data = np.frombuffer(fh.read((last - first) * row_size), dtype=dtype)
+                parts.append(data.reshape(last - first, width))
+            else:
+                fh.seek(page.dataoffsets[strip])
+                segment = page.decode(fh.read(page.databytecounts[strip]), strip,
+                                      jpegtables=page.jpegtables)[0]
+                parts.append(segment.reshape(-1, width)[first:last])
+
+        return np.concatenate(parts).astype(dtype.newbyteorder('='))
 
 
 class SequenceReaderError(Exception):
     pass
+
+
+def get_row_segments(page, y=0, height=None):
+    """Get (offset, byte count) of the strips of tifffile *page* which contain the rows from *y* to
+    *y* + *height* (to the end if None). All segments are returned for tiled pages and pages with
+    more samples per pixel.
+    """
+    segments = list(zip(page.dataoffsets, page.databytecounts))
+    if page.is_tiled or page.samplesperpixel != 1 or not page.rowsperstrip:
+        return segments
+    stop = page.imagelength if height is None else min(y + height, page.imagelength)
+    if stop <= y:
+        return []
+    rows_per_strip = min(page.rowsperstrip, page.imagelength)
+
+    return segments[y // rows_per_strip:(stop - 1) // rows_per_strip + 1]
+
+
+def prefetch_rows(path, y=0, height=None, indices=None, max_bytes=None, abort=None,
+                  chunk_size=2 ** 24):
+    """Read the strips which contain the rows from *y* to *y* + *height* (all if None) of the tif
+    images at ascending *indices* (all by default, indices beyond the last image are ignored) in
+    *path* without decoding them, so that the operating system caches them and a subsequent reader,
+    e.g. UFO's read task, does not have to wait for the storage. Nothing is read if it would be more
+    than *max_bytes*. Reading stops when the callable *abort* returns True. Return the number of
+    read bytes.
+    """
+    segments = {}
+    with TiffSequenceReader(path) as reader:
+        for index in range(reader.num_images) if indices is None else indices:
+            if index >= reader.num_images:
+                break
+            file_index, page_index = reader._locate(index)
+            filename = reader._filenames[file_index]
+            reader._open(filename)
+            page = reader._file.pages[page_index]
+            segments.setdefault(filename, []).extend(get_row_segments(page, y=y, height=height))
+    total = sum(size for file_segments in segments.values() for offset, size in file_segments)
+    if max_bytes is not None and total > max_bytes:
+        LOG.debug("Not prefetching %.2f GB from `%s', more than %.2f GB", total / 2. ** 30, path,
+                  max_bytes / 2. ** 30)
+        return 0
+
+    buf = memoryview(bytearray(chunk_size))
+    num_read = 0
+    for filename, file_segments in segments.items():
+        with open(filename, 'rb', buffering=0) as f:
+            for offset, size in sorted(file_segments):
+                f.seek(offset)
+                while size > 0:
+                    if abort and abort():
+                        return num_read
+                    current = f.readinto(buf[:min(size, chunk_size)])
+                    if not current:
+                        break
+                    size -= current
+                    num_read += current
+
+    return num_read
+
+
+def read_image_rows(path, indices, y=0, height=None, y_step=1):
+    """Read rows from *y* to *y* + *height* (to the end if *height* is None) with step *y_step* of
+    the images at *indices* (negative ones count from the end) in *path* as float arrays. Tif
+    sequences are read by :meth:`TiffSequenceReader.read_rows`, so that only the strips containing
+    the rows are decoded, HDF5 datasets by :func:`read_hdf5_images`.
+    """
+    stop = y + height if height else None
+    if is_hdf5_path(path):
+        num_images = get_num_images(path)
+        return [read_hdf5_images(path, y=y, height=height, y_step=y_step, start=index % num_images,
+                                 number=1)[0].astype(float) for index in indices]
+    if is_tiff_input(path):
+        with TiffSequenceReader(path) as reader:
+            if stop is None:
+                return [reader.read(index)[y::y_step].astype(float) for index in indices]
+            return [reader.read_rows(index, y, stop)[::y_step].astype(float) for index in indices]
+
+    filenames = get_filenames(path)
+
+    return [read_image(filenames[index])[y:stop:y_step].astype(float) for index in indices]
+
+
+def get_opposite_pairs(number, overall_angle=180., num_pairs=1):
+    """Get at most *num_pairs* tuples (index, opposite index) of projections which are 180 degrees
+    apart (or as close as possible) out of *number* projections acquired over *overall_angle*
+    degrees. The pairs are spread evenly over the scan.
+    """
+    import numpy as np
+
+    offset = int(round(number * 180. / overall_angle))
+    if offset >= number:
+        # The last projection is the closest one to 180 degrees
+        offset = number - 1
+    if offset < 1:
+        raise ValueError('At least two projections are needed for pairs 180 degrees apart')
+    firsts = np.unique(np.round(np.linspace(0, number - 1 - offset, num_pairs)).astype(int))
+
+    return [(int(first), int(first) + offset) for first in firsts]
+
+
+def correlate_rotation_axis(pairs):
+    """Compute the rotation axis from *pairs* of projections (2D arrays with the same width) which
+    are 180 degrees apart. The second projection of every pair is flipped horizontally and the
+    normalized cross-correlation with the first one is computed for every shift over the
+    overlapping parts of all rows and pairs, shifts with less than half of the maximum overlap are
+    ignored. The maximum is refined by fitting a parabola, which gives subpixel precision. The axis
+    is returned in the coordinates where integer numbers are boundaries between pixels.
+    """
+    import numpy as np
+
+    sums = None
+    for first, second in pairs:
+        first = np.asarray(first, dtype=float)
+        second = np.asarray(second, dtype=float)[:, ::-1]
+        ones = np.ones_like(first)
+        width = first.shape[1]
+        # Zero padding prevents the correlation from wrapping around
+        size = next_power_of_two(2 * width)
+
+        def correlate(a, b):
+            # Correlations of all rows of *a* with the rows of *b* summed over rows
+            spectrum = np.conj(np.fft.rfft(a, n=size)) * np.fft.rfft(b, n=size)
+            return np.fft.irfft(spectrum.sum(axis=0), n=size)
+
+        # Sums over the overlapping parts for every shift
+        current = np.array([correlate(first, second), correlate(first, ones),
+                            correlate(ones, second), correlate(first ** 2, ones),
+                            correlate(ones, second ** 2), correlate(ones, ones)])
+        sums = current if sums is None else sums + current
+
+    products, first_sums, second_sums, first_squares, second_squares, overlaps = sums
+    overlaps = np.round(overlaps)
+    valid = overlaps >= overlaps.max() / 2
+    overlaps = np.maximum(overlaps, 1)
+    covariance = products - first_sums * second_sums / overlaps
+    variance = ((first_squares - first_sums ** 2 / overlaps) *
+                (second_squares - second_sums ** 2 / overlaps))
+    valid &= variance > 0
+    correlation = np.full(size, -1.)
+    correlation[valid] = covariance[valid] / np.sqrt(variance[valid])
+
+    peak = int(np.argmax(correlation))
+    left, center, right = correlation[[peak - 1, peak, (peak + 1) % size]]
+    denominator = left - 2 * center + right
+    shift = peak + (0.5 * (left - right) / denominator if denominator else 0)
+    if shift > size / 2:
+        shift -= size
+
+    # The flipped second projection is the first one shifted by width - 2 * axis
+    return (width - shift) / 2.
+
+
+def estimate_rotation_axis(projections, number=None, overall_angle=180., num_pairs=4, start=0,
+                           step=1, y=0, height=None, y_step=1, darks=None, flats=None,
+                           flats2=None, dark_index=0, flat_index=0, flat2_index=0):
+    """Estimate the rotation axis from *num_pairs* pairs of projections 180 degrees apart (see
+    :func:`get_opposite_pairs`) by :func:`correlate_rotation_axis`. *number* projections (all if
+    None) are taken from *projections* from *start* with *step* and they were acquired over
+    *overall_angle* degrees. Only the rows given by *y*, *height* and *y_step* are read (see
+    :func:`read_image_rows`). If *darks* and *flats* are given, the projections are flat-field
+    corrected by their images at *dark_index* and *flat_index* (negative ones count from the end),
+    if *flats2* are given too, their image at *flat2_index* is used for the second projection of
+    every pair.
+    """
+    import numpy as np
+
+    def flat_correct(flat, radio):
+        nonzero = np.where(radio != 0)
+        result = np.zeros_like(radio)
+        result[nonzero] = flat[nonzero] / radio[nonzero]
+        # log(1) = 0
+        result[result <= 0] = 1
+
+        return np.log(result)
+
+    if number is None:
+        if is_tiff_input(projections):
+            with TiffSequenceReader(projections) as reader:
+                total = reader.num_images
+        else:
+            total = get_num_images(projections)
+        number = len(range(start, total, step))
+    pairs = get_opposite_pairs(number, overall_angle=overall_angle, num_pairs=num_pairs)
+    LOG.debug('Estimating rotation axis from projection pairs %s', pairs)
+    indices = [start + index * step for pair in pairs for index in pair]
+    images = read_image_rows(projections, indices, y=y, height=height, y_step=y_step)
+
+    if darks and flats:
+        dark = read_image_rows(darks, [dark_index], y=y, height=height, y_step=y_step)[0]
+        flat = read_image_rows(flats, [flat_index], y=y, height=height, y_step=y_step)[0] - dark
+        flat2 = flat
+        if flats2:
+            flat2 = read_image_rows(flats2, [flat2_index], y=y, height=height,
+                                    y_step=y_step)[0] - dark
+        images[::2] = [flat_correct(flat, image - dark) for image in images[::2]]
+        images[1::2] = [flat_correct(flat2, image - dark) for image in images[1::2]]
+
+    return correlate_rotation_axis(list(zip(images[::2], images[1::2])))
+
+
+def read_ahead(reader, indices=None, depth=4, num_workers=1, rows=None):
+    """Iterate over images of the sequence *reader* (a :class:`FileSequenceReader`) at *indices*
+    (all images by default) and read up to *depth* images in advance by *num_workers* threads, so
+    that opening and decoding files overlaps with the processing of the already read images. If
+    *rows* is a tuple (start, stop), only these rows are read (see
+    :meth:`FileSequenceReader.read_rows`). Images are yielded in the order given by *indices*.
+    Every worker reads from its own copy of *reader*, which is closed when the iteration ends.
+    Memory-mapped images are not read in advance, only the files containing them are opened.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Lock, local
+
+    if indices is None:
+        indices = range(reader.num_images)
+    if depth < 1 or num_workers < 1:
+        raise ValueError('depth and num_workers must be positive')
+
+    readers = []
+    lock = Lock()
+    storage = local()
+
+    def read_one(index):
+        if not hasattr(storage, 'reader'):
+            storage.reader = reader.copy()
+            with lock:
+                readers.append(storage.reader)
+
+        if rows:
+            return storage.reader.read_rows(index, *rows)
+
+        return storage.reader.read(index)
+
+    indices = iter(indices)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    try:
+        for index in indices:
+            pending.append(executor.submit(read_one, index))
+            if len(pending) >= depth:
+                break
+        while pending:
+            image = pending.popleft().result()
+            for index in indices:
+                pending.append(executor.submit(read_one, index))
+                break
+            yield image
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for worker_reader in readers:
+            worker_reader.close()